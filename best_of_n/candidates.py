@@ -0,0 +1,126 @@
+import numpy as np
+
+class CandidateTable():
+    """
+    Scored candidate answers to a batch of questions, one column per field:
+
+    question_idxs: int64, index of the question in the batch
+    texts: object (str), the answer
+    scores: float32, reward of the answer
+    """
+    def __init__(self, question_idxs, texts, scores):
+        self.question_idxs = np.asarray(question_idxs, dtype=np.int64)
+        self.texts = np.empty(len(texts), dtype=object)
+        self.texts[:] = list(texts)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        assert len(self.question_idxs) == len(self.texts) == len(self.scores), \
+            "All columns must have the same length"
+
+    @classmethod
+    def from_matrix(cls, answers, scores):
+        """
+        Args:
+        answers: np.array
+            Array of str with shape [n_questions, n], n answers per question
+        scores: np.array
+            Array of float with the same shape as answers
+        """
+        n_questions, n = answers.shape
+        return cls(
+            question_idxs=np.repeat(np.arange(n_questions), n),
+            texts=answers.reshape(-1),
+            scores=np.asarray(scores).reshape(-1)
+        )
+
+    @classmethod
+    def from_lists(cls, answers, scores):
+        """
+        Args:
+        answers: [[str]]
+            Answers to every question. Questions may have different numbers of
+            answers
+        scores: [[float]]
+            Same structure as answers
+        """
+        lengths = [len(question_answers) for question_answers in answers]
+        return cls(
+            question_idxs=np.repeat(np.arange(len(answers)), lengths),
+            texts=[answer for question_answers in answers for answer in question_answers],
+            scores=np.concatenate([np.asarray(l, dtype=np.float32) for l in scores])
+                if scores else np.zeros(0, dtype=np.float32)
+        )
+
+    @classmethod
+    def concatenate(cls, tables, n_questions):
+        """
+        Args:
+        tables: [CandidateTable]
+            Tables of consecutive batches of questions
+        n_questions: [int]
+            Number of questions in each of those batches
+
+        Returns:
+        table: CandidateTable
+            One table for all the questions
+        """
+        offsets = np.concatenate([[0], np.cumsum(n_questions)[:-1]]).astype(np.int64)
+        return cls(
+            question_idxs=np.concatenate([
+                t.question_idxs + offset for t, offset in zip(tables, offsets)
+            ]),
+            texts=[text for t in tables for text in t.texts],
+            scores=np.concatenate([t.scores for t in tables])
+        )
+
+    def __len__(self):
+        return len(self.texts)
+
+    def take(self, idxs):
+        """The rows at idxs, in that order"""
+        return CandidateTable(
+            question_idxs=self.question_idxs[idxs],
+            texts=self.texts[idxs],
+            scores=self.scores[idxs]
+        )
+
+    def counts(self, n_questions):
+        """Number of candidates of every question"""
+        return np.bincount(self.question_idxs, minlength=n_questions)
+
+    def top_k(self, k):
+        """
+        The k highest-scoring candidates of every question, sorted by question
+        and then by decreasing score. Ties keep the candidates' order, and NaN
+        scores come last
+        """
+        sort_scores = np.where(np.isnan(self.scores), np.inf, -self.scores)
+        order = np.lexsort((sort_scores, self.question_idxs))
+        sorted_question_idxs = self.question_idxs[order]
+        # Rank of every candidate within its question
+        group_starts = np.flatnonzero(np.r_[True, np.diff(sorted_question_idxs) != 0])
+        group_sizes = np.diff(np.r_[group_starts, len(order)])
+        ranks = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+        return self.take(order[ranks < k])
+
+    def best(self, n_questions):
+        """
+        Returns:
+        advices: [str]
+            The top-scoring candidate of every question, None for questions
+            without candidates
+        """
+        top = self.top_k(1)
+        advices = [None] * n_questions
+        for question_idx, text in zip(top.question_idxs, top.texts):
+            advices[question_idx] = text
+        return advices
+
+    def to_dict(self):
+        """JSON-serializable columns, with null instead of NaN"""
+        def _floats(column):
+            return [None if np.isnan(x) else float(x) for x in column]
+        return {
+            "question_idx": self.question_idxs.tolist(),
+            "text": self.texts.tolist(),
+            "score": _floats(self.scores)
+        }
@@ -5,7 +5,7 @@ from absl import flags
 from datetime import datetime
 
 from data.assertions import question_is_valid
-from data.to_tfrecord_t5 import encoder, _trim_to_desired_length, _fix_reddit_text
+from data.to_tfrecord_t5 import encoder, _trim_to_desired_length, _fix_reddit_texts
 from reward.comparative.data import SELFTEXT_DESIRED_LEN
 
 QUESTIONS_OUT_PATH = "./best_of_n/data/{split}_questions.tsv"
@@ -30,14 +30,16 @@ def to_tsv_line(question):
         + ' {}, {}'.format(dt_date.day, dt_date.year)
     # Sort the answers by score
     formatted_q = "Subreddit: {} Date: {} Title: {} Selftext: {}".format(
-        _fix_reddit_text(question["subreddit"]),
-        _fix_reddit_text(str_date),
-        _fix_reddit_text(question["title"]),
-        _fix_reddit_text(_trim_to_desired_length(
-            encoder,
-            question["selftext"],
-            desired_len=SELFTEXT_DESIRED_LEN
-        ))
+        *_fix_reddit_texts([
+            question["subreddit"],
+            str_date,
+            question["title"],
+            _trim_to_desired_length(
+                encoder,
+                question["selftext"],
+                desired_len=SELFTEXT_DESIRED_LEN
+            )
+        ])
     )
     return formatted_q
 
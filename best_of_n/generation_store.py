@@ -0,0 +1,554 @@
+"""
+A compact, indexed format for sampled answers, instead of text files that
+repeat the question next to every answer.
+
+A store is a directory (local or GCS) with:
+    meta.json                   format version, counts and optional columns
+    questions.bin               UTF-8 questions, back to back
+    question_offsets.npy        int64 [n_questions + 1], byte offsets in
+                                questions.bin
+    answers.bin                 UTF-8 answers, back to back, grouped by question
+    answer_offsets.npy          int64 [n_answers + 1], byte offsets in
+                                answers.bin
+    question_answer_offsets.npy int64 [n_questions + 1], the answers of
+                                question i are rows
+                                question_answer_offsets[i]:[i + 1]
+    scores.npy                  float32 [n_answers], optional
+
+Convert a question<TAB>answer file with N answers per question:
+python best_of_n/generation_store.py --to=store --input_path=gens.tsv \
+    --output_path=gens.store --N=80
+"""
+import io
+import os
+import sys
+import json
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from best_of_n.subsample import subsample_ranks
+
+FORMAT_VERSION = 1
+# Bytes of answers read at once when iterating over a store
+DEFAULT_BLOCK_BYTES = 16 * 1024 * 1024
+
+def _path(store_dir, name):
+    return os.path.join(store_dir, name)
+
+def _save_array(store_dir, name, array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    with tf.io.gfile.GFile(_path(store_dir, name), "wb") as f:
+        f.write(buffer.getvalue())
+
+def _load_array(store_dir, name):
+    with tf.io.gfile.GFile(_path(store_dir, name), "rb") as f:
+        return np.load(io.BytesIO(f.read()))
+
+def is_store(path):
+    """Whether path is a generation store directory"""
+    return tf.io.gfile.exists(_path(path, "meta.json"))
+
+class GenerationStoreWriter():
+    """
+    Writes a generation store one question at a time. Text is streamed to
+    disk, offsets and scores are kept in memory until close()
+
+    Usage:
+        with GenerationStoreWriter(store_dir, with_scores=True) as writer:
+            writer.add(question, answers, scores)
+    """
+    def __init__(self, store_dir, with_scores=False):
+        """
+        Args:
+        store_dir: str
+            Directory to write the store to. Existing store files are
+            overwritten
+        with_scores: bool
+            Whether every answer comes with a score
+        """
+        self.store_dir = store_dir
+        self.with_scores = with_scores
+        tf.io.gfile.makedirs(store_dir)
+        if is_store(store_dir):
+            tf.io.gfile.remove(_path(store_dir, "meta.json"))
+        self._questions_file = tf.io.gfile.GFile(_path(store_dir, "questions.bin"), "wb")
+        self._answers_file = tf.io.gfile.GFile(_path(store_dir, "answers.bin"), "wb")
+        self._question_offsets = [0]
+        self._answer_offsets = [0]
+        self._question_answer_offsets = [0]
+        self._scores = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def n_questions(self):
+        return len(self._question_offsets) - 1
+
+    def add(self, question, answers, scores=None):
+        """
+        Args:
+        question: str
+        answers: [str]
+            Answers to question
+        scores: [float]
+            One per answer. Required if the writer has with_scores
+
+        Returns:
+        question_id: int
+            Index of the question in the store
+        """
+        return self.add_bytes(
+            question.encode("utf-8"),
+            [answer.encode("utf-8") for answer in answers],
+            scores
+        )
+
+    def add_bytes(self, question, answers, scores=None):
+        """
+        Like add, with UTF-8 encoded question and answers, e.g. as read by
+        GenerationStore.iter_questions(raw=True)
+        """
+        assert not self._closed, "Cannot add to a closed GenerationStoreWriter"
+        assert (scores is not None) == self.with_scores, \
+            "Scores must be given if and only if the writer has with_scores"
+        self._questions_file.write(question)
+        self._question_offsets.append(self._question_offsets[-1] + len(question))
+        for answer in answers:
+            self._answers_file.write(answer)
+            self._answer_offsets.append(self._answer_offsets[-1] + len(answer))
+        self._question_answer_offsets.append(
+            self._question_answer_offsets[-1] + len(answers)
+        )
+        if scores is not None:
+            assert len(scores) == len(answers), "Need one score per answer"
+            self._scores.extend(scores)
+        return self.n_questions - 1
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._questions_file.close()
+        self._answers_file.close()
+        _save_array(self.store_dir, "question_offsets.npy",
+            np.array(self._question_offsets, dtype=np.int64))
+        _save_array(self.store_dir, "answer_offsets.npy",
+            np.array(self._answer_offsets, dtype=np.int64))
+        _save_array(self.store_dir, "question_answer_offsets.npy",
+            np.array(self._question_answer_offsets, dtype=np.int64))
+        if self.with_scores:
+            _save_array(self.store_dir, "scores.npy",
+                np.array(self._scores, dtype=np.float32))
+        # Written last, so that a store with meta.json is complete
+        meta = {
+            "version": FORMAT_VERSION,
+            "n_questions": self.n_questions,
+            "n_answers": len(self._answer_offsets) - 1,
+            "has_scores": self.with_scores
+        }
+        with tf.io.gfile.GFile(_path(self.store_dir, "meta.json"), "w") as f:
+            f.write(json.dumps(meta))
+
+class GenerationStore():
+    """
+    Reads a generation store. Offsets and scores are loaded in memory, text
+    is read from disk on demand
+    """
+    def __init__(self, store_dir):
+        """
+        Args:
+        store_dir: str
+            Directory written by GenerationStoreWriter
+        """
+        self.store_dir = store_dir
+        with tf.io.gfile.GFile(_path(store_dir, "meta.json"), "r") as f:
+            meta = json.loads(f.read())
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"{store_dir} has format version {meta['version']}, "
+                f"expected {FORMAT_VERSION}"
+            )
+        self.n_questions = meta["n_questions"]
+        self.n_answers = meta["n_answers"]
+        self.question_offsets = _load_array(store_dir, "question_offsets.npy")
+        self.answer_offsets = _load_array(store_dir, "answer_offsets.npy")
+        self.question_answer_offsets = _load_array(store_dir, "question_answer_offsets.npy")
+        self.scores = _load_array(store_dir, "scores.npy") \
+            if meta["has_scores"] else None
+        self._questions_file = tf.io.gfile.GFile(_path(store_dir, "questions.bin"), "rb")
+        self._answers_file = tf.io.gfile.GFile(_path(store_dir, "answers.bin"), "rb")
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.n_questions
+
+    def n_answers_per_question(self):
+        """int64 array with the number of answers of every question"""
+        return np.diff(self.question_answer_offsets)
+
+    def answer_range(self, question_id):
+        """
+        Returns:
+        start, stop: int
+            Rows of the answers to question_id, e.g. in scores
+        """
+        return int(self.question_answer_offsets[question_id]), \
+            int(self.question_answer_offsets[question_id + 1])
+
+    def question(self, question_id):
+        start, stop = self.question_offsets[question_id:question_id + 2]
+        return self._read(self._questions_file, start, stop).decode("utf-8")
+
+    def answers(self, question_id):
+        """
+        Returns:
+        answers: [str]
+            Answers to question_id, in the order they were added
+        """
+        start, stop = self.answer_range(question_id)
+        return [
+            answer.decode("utf-8")
+            for answer in self._read_answers(start, stop)
+        ]
+
+    def iter_questions(self, start=0, stop=None, raw=False,
+        block_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Reads questions start:stop in order, a block of answers at a time
+
+        Args:
+        raw: bool
+            Yield UTF-8 encoded bytes instead of str
+
+        Yields:
+        question_id: int
+        question: str
+        answers: [str]
+        """
+        stop = self.n_questions if stop is None else stop
+        block_start = start
+        while block_start < stop:
+            # Extend the block until it holds block_bytes of answers, with at
+            # least one question
+            first_answer = self.question_answer_offsets[block_start]
+            max_offset = self.answer_offsets[first_answer] + block_bytes
+            block_stop = block_start + 1
+            while block_stop < stop and self.answer_offsets[
+                self.question_answer_offsets[block_stop + 1]
+                ] <= max_offset:
+                block_stop += 1
+            questions = self._read_many(
+                self._questions_file,
+                self.question_offsets[block_start:block_stop + 1]
+            )
+            answer_start, answer_stop = self.question_answer_offsets[[block_start, block_stop]]
+            answers = self._read_answers(answer_start, answer_stop)
+            for question_id, question in zip(range(block_start, block_stop), questions):
+                question_answers = answers[
+                    self.question_answer_offsets[question_id] - answer_start:
+                    self.question_answer_offsets[question_id + 1] - answer_start
+                ]
+                if raw:
+                    yield question_id, question, question_answers
+                else:
+                    yield question_id, question.decode("utf-8"), \
+                        [answer.decode("utf-8") for answer in question_answers]
+            block_start = block_stop
+
+    def close(self):
+        self._questions_file.close()
+        self._answers_file.close()
+
+    def _read_answers(self, start, stop):
+        return self._read_many(self._answers_file, self.answer_offsets[start:stop + 1])
+
+    def _read_many(self, f, offsets):
+        # One read for consecutive items, then split by offsets
+        data = self._read(f, offsets[0], offsets[-1])
+        relative_offsets = (offsets - offsets[0]).tolist()
+        return [
+            data[relative_offsets[i]:relative_offsets[i + 1]]
+            for i in range(len(relative_offsets) - 1)
+        ]
+
+    def _read(self, f, start, stop):
+        with self._lock:
+            f.seek(int(start))
+            return f.read(int(stop - start))
+
+def tsv_to_store(tsv_path, store_dir, N, scores_path=None):
+    """
+    Args:
+    tsv_path: str
+        Text file where each line looks like <question>\\t<answer>, with the
+        answers to a question on consecutive lines
+    store_dir: str
+    N: int
+        Answers per question. Needed even though every line starts with its
+        question, since a question asked twice in a row (e.g. a repost) would
+        otherwise look like one question with 2N answers
+    scores_path: str
+        Optional text file with one score per line of tsv_path, e.g. written
+        by reward/comparative/predict.py
+    """
+    scores_file = tf.io.gfile.GFile(scores_path, "r") \
+        if scores_path is not None else None
+    with tf.io.gfile.GFile(tsv_path, "r") as tsv_file, \
+        GenerationStoreWriter(store_dir, with_scores=scores_file is not None) as writer:
+        question = None
+        answers = []
+        scores = []
+        def _flush():
+            if question is not None:
+                writer.add(question, answers,
+                    scores if scores_file is not None else None)
+        for line in tsv_file:
+            line_question, answer = line.rstrip("\n").split("\t", 1)
+            if question is None or len(answers) == N:
+                _flush()
+                question, answers, scores = line_question, [], []
+            elif line_question != question:
+                raise ValueError(
+                    f"{tsv_path}: the answers of question {writer.n_questions} "
+                    f"have different questions, is N={N} right?"
+                )
+            answers.append(answer)
+            if scores_file is not None:
+                scores.append(float(scores_file.readline()))
+        if question is not None and len(answers) != N:
+            raise ValueError(
+                f"{tsv_path}: the last question has {len(answers)} answers, "
+                f"is N={N} right?"
+            )
+        _flush()
+    if scores_file is not None:
+        scores_file.close()
+
+def store_to_tsv(store_dir, tsv_path, scores_path=None):
+    """
+    Inverse of tsv_to_store
+
+    Args:
+    scores_path: str
+        If given, write the scores of the store here, one per line
+    """
+    with GenerationStore(store_dir) as store, \
+        tf.io.gfile.GFile(tsv_path, "w") as tsv_file:
+        for _, question, answers in store.iter_questions():
+            tsv_file.write("".join(question + "\t" + answer + "\n" for answer in answers))
+        if scores_path is not None:
+            if store.scores is None:
+                raise ValueError(f"{store_dir} has no scores")
+            with tf.io.gfile.GFile(scores_path, "w") as scores_file:
+                scores_file.write("".join(str(s) + "\n" for s in store.scores))
+
+def _optional_column(stores, name):
+    columns = [getattr(store, name) for store in stores]
+    return None if any(column is None for column in columns) else columns
+
+def allocate_counts(n_available, N, weights=None):
+    """
+    How many answers to take from each of several sources of answers to a
+    question, to get N answers in total
+
+    Args:
+    n_available: [int]
+        Answers available in each source
+    N: int
+    weights: [float]
+        Share of the N answers that each source should provide. Sources short
+        of their share are made up for by the others, highest weight first.
+        If None, sources are used up one after the other, in order
+
+    Returns:
+    counts: [int]
+        Answers to take from each source
+    """
+    n_available = [int(n) for n in n_available]
+    if sum(n_available) < N:
+        raise ValueError(f"Only {sum(n_available)} answers available, need {N}")
+    if weights is None:
+        counts = []
+        for n in n_available:
+            counts.append(min(n, N - sum(counts)))
+        return counts
+    assert len(weights) == len(n_available), "Need one weight per source"
+    total_weight = float(sum(weights))
+    targets = [N * w / total_weight for w in weights]
+    counts = [int(t) for t in targets]
+    # Round by largest remainder, so that the counts add up to N
+    by_remainder = sorted(
+        range(len(targets)), key=lambda i: counts[i] - targets[i]
+    )
+    for i in by_remainder[:N - sum(counts)]:
+        counts[i] += 1
+    counts = [min(c, n) for c, n in zip(counts, n_available)]
+    by_weight = sorted(range(len(weights)), key=lambda i: -weights[i])
+    for i in by_weight:
+        counts[i] += min(n_available[i] - counts[i], N - sum(counts))
+    return counts
+
+def merge_stores(store_dirs, output_dir, N, weights=None):
+    """
+    Write a store whose questions have N answers taken from those of
+    store_dirs (see allocate_counts), in order. Scores are kept if all stores
+    have them
+
+    Args:
+    store_dirs: [str]
+        Stores with the same questions
+    N: int
+    weights: [float]
+        See allocate_counts. By default, the first N answers are taken
+    """
+    stores = [GenerationStore(store_dir) for store_dir in store_dirs]
+    try:
+        n_questions = stores[0].n_questions
+        for store in stores[1:]:
+            if store.n_questions != n_questions:
+                raise ValueError(
+                    f"{store.store_dir} has {store.n_questions} questions, "
+                    f"{stores[0].store_dir} has {n_questions}"
+                )
+        n_answers = [store.n_answers_per_question() for store in stores]
+        short_ids = np.flatnonzero(sum(n_answers) < N)
+        if len(short_ids) > 0:
+            raise ValueError(
+                f"{len(short_ids)} questions have < {N} answers among the "
+                f"input stores, e.g. question {short_ids[0]}"
+            )
+        scores = _optional_column(stores, "scores")
+        with GenerationStoreWriter(output_dir, with_scores=scores is not None) as writer:
+            iterators = [store.iter_questions(raw=True) for store in stores]
+            for question_id in range(n_questions):
+                counts = allocate_counts(
+                    [store_n_answers[question_id] for store_n_answers in n_answers],
+                    N,
+                    weights
+                )
+                question = None
+                answers = []
+                question_scores = []
+                for store_idx, (store, iterator, n_taken) in enumerate(
+                    zip(stores, iterators, counts)
+                    ):
+                    _, store_question, store_answers = next(iterator)
+                    question = store_question if question is None else question
+                    answers.extend(store_answers[:n_taken])
+                    start, _ = store.answer_range(question_id)
+                    if scores is not None:
+                        question_scores.extend(scores[store_idx][start:start + n_taken])
+                writer.add_bytes(
+                    question,
+                    answers,
+                    question_scores if scores is not None else None
+                )
+    finally:
+        for store in stores:
+            store.close()
+
+def concatenate_stores(store_dirs, output_dir):
+    """
+    Write a store with the questions of store_dirs, one store after the other.
+    Scores are kept if all stores have them
+    """
+    stores = [GenerationStore(store_dir) for store_dir in store_dirs]
+    try:
+        scores = _optional_column(stores, "scores")
+        with GenerationStoreWriter(output_dir, with_scores=scores is not None) as writer:
+            for store_idx, store in enumerate(stores):
+                for question_id, question, answers in store.iter_questions(raw=True):
+                    start, stop = store.answer_range(question_id)
+                    writer.add_bytes(
+                        question,
+                        answers,
+                        scores[store_idx][start:stop] if scores is not None else None
+                    )
+    finally:
+        for store in stores:
+            store.close()
+
+def sample_store(store_dir, output_dir, n, seed=None):
+    """
+    Write a store with n answers to every question of store_dir: the first n,
+    or with a seed, those of rank < n (see best_of_n.subsample), in order
+
+    Args:
+    seed: int
+        Sample the same answers as best_of_n.subsample.SubsampleMasks and
+        sample_generations.py on the text file of the store
+    """
+    if seed is None:
+        merge_stores([store_dir], output_dir, n)
+        return
+    with GenerationStore(store_dir) as store:
+        n_answers = store.n_answers_per_question()
+        short_ids = np.flatnonzero(n_answers < n)
+        if len(short_ids) > 0:
+            raise ValueError(
+                f"{len(short_ids)} questions have < {n} answers in "
+                f"{store_dir}, e.g. question {short_ids[0]}"
+            )
+        keep = subsample_ranks(n_answers, seed) < n
+        with GenerationStoreWriter(output_dir, with_scores=store.scores is not None) as writer:
+            for question_id, question, answers in store.iter_questions(raw=True):
+                start, stop = store.answer_range(question_id)
+                question_keep = keep[start:stop]
+                writer.add_bytes(
+                    question,
+                    [answer for answer, kept in zip(answers, question_keep) if kept],
+                    store.scores[start:stop][question_keep]
+                        if store.scores is not None else None
+                )
+
+if __name__ == "__main__":
+    from absl import flags
+    flags.DEFINE_enum(
+        name="to",
+        default=None,
+        enum_values=["store", "tsv"],
+        help="Convert a question<TAB>answer file to a store, or back"
+    )
+    flags.DEFINE_string(
+        name="input_path",
+        default=None,
+        help="Text file or store directory to convert"
+    )
+    flags.DEFINE_string(
+        name="output_path",
+        default=None,
+        help="Store directory or text file to write"
+    )
+    flags.DEFINE_integer(
+        name="N",
+        default=None,
+        help="Answers per question in the text file, needed with --to=store"
+    )
+    flags.DEFINE_string(
+        name="scores_path",
+        default=None,
+        help="Text file with one score per answer, read with --to=store and "
+            "written with --to=tsv"
+    )
+    FLAGS = flags.FLAGS
+    FLAGS(sys.argv)
+    if FLAGS.to == "store":
+        if FLAGS.N is None:
+            raise ValueError("--N is needed with --to=store")
+        tsv_to_store(FLAGS.input_path, FLAGS.output_path, FLAGS.N, FLAGS.scores_path)
+    else:
+        store_to_tsv(FLAGS.input_path, FLAGS.output_path, FLAGS.scores_path)
@@ -0,0 +1,67 @@
+"""Tests for best_of_n.generation_store"""
+import numpy as np
+import pytest
+
+from best_of_n.generation_store import GenerationStore, GenerationStoreWriter, \
+    tsv_to_store, store_to_tsv
+
+# The second question is a repost of the first
+TSV = "".join(
+    f"{question}\t{answer}\n" for question, answer in [
+        ("q one", "a"), ("q one", "b\\nwith an escaped newline"), ("q one", ""),
+        ("q one", "c"), ("q one", "d"), ("q one", "e"),
+        ("q ünïcode", "f"), ("q ünïcode", "g\tafter a tab"), ("q ünïcode", "h")
+    ]
+)
+SCORES = [0.5, -1.25, 2.0, 0.0, 3.5, 1.0, -0.5, 0.25, 4.0]
+
+def _write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return str(path)
+
+def _read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def test_tsv_round_trip(tmp_path):
+    tsv_path = _write(tmp_path / "gens.tsv", TSV)
+    tsv_to_store(tsv_path, str(tmp_path / "store"), N=3)
+    store_to_tsv(str(tmp_path / "store"), str(tmp_path / "out.tsv"))
+    assert _read(tmp_path / "out.tsv") == TSV
+    with GenerationStore(str(tmp_path / "store")) as store:
+        assert len(store) == 3
+        assert store.n_answers == 9
+        assert store.question(0) == store.question(1) == "q one"
+        assert store.answers(2) == ["f", "g\tafter a tab", "h"]
+        assert store.scores is None
+
+def test_tsv_round_trip_with_scores(tmp_path):
+    tsv_path = _write(tmp_path / "gens.tsv", TSV)
+    scores_path = _write(tmp_path / "scores.txt", "".join(f"{s}\n" for s in SCORES))
+    tsv_to_store(tsv_path, str(tmp_path / "store"), N=3, scores_path=scores_path)
+    store_to_tsv(str(tmp_path / "store"), str(tmp_path / "out.tsv"),
+        scores_path=str(tmp_path / "out_scores.txt"))
+    assert _read(tmp_path / "out.tsv") == TSV
+    assert [float(s) for s in _read(tmp_path / "out_scores.txt").split()] == SCORES
+    with GenerationStore(str(tmp_path / "store")) as store:
+        np.testing.assert_array_equal(store.scores[slice(*store.answer_range(1))], SCORES[3:6])
+
+def test_tsv_with_wrong_N_is_rejected(tmp_path):
+    tsv_path = _write(tmp_path / "gens.tsv", TSV)
+    with pytest.raises(ValueError):
+        tsv_to_store(tsv_path, str(tmp_path / "store_4"), N=4)
+    with pytest.raises(ValueError):
+        tsv_to_store(tsv_path, str(tmp_path / "store_2"), N=2)
+
+def test_iter_questions_across_blocks(tmp_path):
+    questions = [f"question {i}" for i in range(20)]
+    answers = [[f"answer {i}.{j}" * (i + 1) for j in range(i % 4)] for i in range(20)]
+    with GenerationStoreWriter(str(tmp_path / "store")) as writer:
+        for question, question_answers in zip(questions, answers):
+            writer.add(question, question_answers)
+    with GenerationStore(str(tmp_path / "store")) as store:
+        read = list(store.iter_questions(start=3, stop=17, block_bytes=50))
+    assert [question_id for question_id, _, _ in read] == list(range(3, 17))
+    assert [question for _, question, _ in read] == questions[3:17]
+    assert [question_answers for _, _, question_answers in read] == answers[3:17]
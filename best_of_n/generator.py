@@ -1,24 +1,432 @@
 import os
+import re
+import uuid
+import queue
+import threading
 
+import numpy as np
 import tensorflow as tf
 
 from data.to_tfrecord_t5 import _fix_reddit_text, _trim_to_desired_length, encoder
 from reward.comparative.data import SELFTEXT_DESIRED_LEN
+from best_of_n.candidates import CandidateTable
+from best_of_n.generation_store import GenerationStoreWriter
+from best_of_n.metrics import STAGE_SECONDS, CANDIDATES_GENERATED, CANDIDATES_SCORED, \
+    CANDIDATES_DEDUPLICATED
+
+def format_instance(instance):
+    """
+    Args:
+    instance: dict
+        Dict with keys "title", "date", "selftext", "subreddit"
+
+    Returns:
+    question: str
+        T5-formatted question, i.e.
+        "Subreddit: ... Date: ... Title: ... Selftext: ..."
+    """
+    selftext = _trim_to_desired_length(
+        encoder,
+        instance["selftext"],
+        desired_len=SELFTEXT_DESIRED_LEN
+    )
+    return "Subreddit: " + _fix_reddit_text(instance["subreddit"]) \
+        + " Date: " + _fix_reddit_text(instance["date"]) \
+        + " Title: " + _fix_reddit_text(instance["title"]) \
+        + " Selftext: " + _fix_reddit_text(selftext)
+
+def normalize_answer(answer):
+    """
+    Answers that only differ in whitespace get the same reward, so they are
+    scored once
+    """
+    return re.sub(r"\s+", " ", answer).strip()
+
+def _read_questions(inputs_path):
+    with tf.io.gfile.GFile(inputs_path, "r") as inputs_file:
+        return [line.rstrip("\n") for line in inputs_file]
+
+class RerankRequest():
+    """
+    An instance to rerank, as an item of BestOfNGenerator.process_batch
+    """
+    def __init__(self, instance):
+        """
+        Args:
+        instance: dict
+            Dict with keys "title", "date", "selftext", "subreddit" and
+            "candidates" (see BestOfNGenerator.rerank_instances)
+        """
+        self.instance = instance
 
 class BestOfNGenerator():
     def __init__(
         self, N, t5_model, t5_model_ckpt_steps, sampling_keep_top_p,
-        reward_model, reward_model_ckpt_steps, tmp_dir
+        reward_model=None, reward_model_ckpt_steps=None, cache=None,
+        stopping_rule=None, round_size=16, pipeline_chunk_size=None,
+        pipeline_queue_size=2, samples_per_example=None, tmp_dir=None,
+        in_memory=False
         ):
+        """
+        Args:
+        tmp_dir: str
+            Directory for the files T5 and the reward model predict through,
+            unless in_memory
+        in_memory: bool
+            Whether T5 and the reward model predict from strings, keeping
+            their checkpoints in memory across calls, instead of from files in
+            tmp_dir, restoring them on every call. Experimental on TPUs (see
+            t5.models.mtf_model.WarmPredictLoop)
+        cache: frontend.cache.ResponseCache
+            If given, generate_from_instances only generates advice for the
+            instances that aren't cached yet
+        stopping_rule: best_of_n.stopping.StoppingRule
+            If given, samples are drawn and scored in rounds of round_size,
+            and a question stops getting samples once stopping_rule fires for
+            it or it has N samples. Otherwise, every question gets N samples.
+            Every round uses both models, so this needs in_memory and the
+            models on separate TPUs, so that neither restores its checkpoint
+            again for each round
+        round_size: int
+            Samples drawn per question and round when stopping_rule is given
+        pipeline_chunk_size: int
+            If given (and there is no stopping_rule), questions are sampled in
+            chunks of this size by a separate thread, and the reward model
+            scores each chunk while T5 samples the next ones. Only overlaps
+            the two models if they don't share devices. None to sample all
+            questions before scoring any
+        pipeline_queue_size: int
+            Maximum number of sampled chunks waiting to be scored
+        samples_per_example: int
+            If given, T5 encodes every question once per this many samples
+            (see MtfModel.sample_from_strings), and decodes this many samples
+            per question at once, so keep it small enough to fit in memory.
+            None to sample by repeating every question once per sample, which
+            encodes it every time. Needs in_memory
+        """
+        if not in_memory and tmp_dir is None:
+            raise ValueError("Predicting from files needs a tmp_dir")
+        if not in_memory and samples_per_example is not None:
+            raise ValueError("samples_per_example needs in_memory=True")
+        if stopping_rule is not None:
+            if not in_memory:
+                raise ValueError(
+                    "stopping_rule needs in_memory=True, predicting from files "
+                    "restores both checkpoints in every round"
+                )
+            t5_tpu = getattr(t5_model, "_tpu", None)
+            if t5_tpu and t5_tpu == getattr(reward_model, "_tpu", None):
+                raise ValueError(
+                    "stopping_rule needs the models on separate TPUs, they "
+                    "can't both keep their checkpoints in memory on one"
+                )
         self.N = N
         self.t5_model = t5_model
         self.t5_model_ckpt_steps = t5_model_ckpt_steps
         self.sampling_keep_top_p = sampling_keep_top_p
         self.reward_model = reward_model
         self.reward_model_ckpt_steps = reward_model_ckpt_steps
+        self.cache = cache
+        self.stopping_rule = stopping_rule
+        self.round_size = round_size
+        self.pipeline_chunk_size = pipeline_chunk_size
+        self.pipeline_queue_size = pipeline_queue_size
+        self.samples_per_example = samples_per_example
         self.tmp_dir = tmp_dir
-    
-    def generate_N(self, inputs_path, outputs_path):
+        self.in_memory = in_memory
+
+    @property
+    def model_id(self):
+        """Identifies everything the generated advice depends on"""
+        reward_model_dir = getattr(self.reward_model, "_model_dir", None)
+        return f"best_of_n:t5={self.t5_model._model_dir}@{self.t5_model_ckpt_steps}" \
+            + f":reward={reward_model_dir}@{self.reward_model_ckpt_steps}" \
+            + f":N={self.N}:p={self.sampling_keep_top_p}" \
+            + f":stopping={self.stopping_rule!r}/{self.round_size}"
+
+    def sample_N(self, questions, n=None):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+        n: int
+            Samples per question. Defaults to N
+
+        Returns:
+        answers: np.array
+            Array of str with shape [len(questions), n]
+        """
+        n = self.N if n is None else n
+        if self.samples_per_example is None:
+            repeated_questions = [q for q in questions for _ in range(n)]
+            with STAGE_SECONDS.time(stage="sample"):
+                if self.in_memory:
+                    answers = self.t5_model.predict_from_strings(
+                        repeated_questions,
+                        checkpoint_steps=self.t5_model_ckpt_steps,
+                        sampling_keep_top_p=self.sampling_keep_top_p
+                    )
+                else:
+                    answers = self._predict_through_files(repeated_questions)
+            CANDIDATES_GENERATED.inc(len(answers))
+            return np.array(answers, dtype=object).reshape(len(questions), n)
+        with STAGE_SECONDS.time(stage="sample"):
+            answers = self.t5_model.sample_from_strings(
+                questions,
+                n,
+                checkpoint_steps=self.t5_model_ckpt_steps,
+                samples_per_example=self.samples_per_example,
+                sampling_keep_top_p=self.sampling_keep_top_p
+            )
+        CANDIDATES_GENERATED.inc(len(questions) * n)
+        answers_matrix = np.empty((len(questions), n), dtype=object)
+        for i, question_answers in enumerate(answers):
+            answers_matrix[i, :] = question_answers
+        return answers_matrix
+
+    def score(self, questions, answers):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+        answers: np.array
+            Array of str with shape [len(questions), n]
+
+        Returns:
+        scores: np.array
+            Reward of every answer, with the same shape as answers
+        """
+        question_idxs = np.repeat(np.arange(len(questions)), answers.shape[1])
+        scores = self.score_candidates(questions, question_idxs, answers.reshape(-1))
+        return scores.reshape(answers.shape)
+
+    def score_candidates(self, questions, question_idxs, answers):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+        question_idxs: [int]
+            Index in questions of the question each answer is for
+        answers: [str]
+            Answers to score
+
+        Returns:
+        scores: np.array
+            Reward of every answer
+        """
+        # Only score the first of the answers to a question that normalize to
+        # the same text, and give its score to the others
+        unique_questions = []
+        unique_answers = []
+        first_idxs = {}
+        unique_idxs = np.empty(len(answers), dtype=np.int64)
+        for i, (question_idx, answer) in enumerate(zip(question_idxs, answers)):
+            key = (question_idx, normalize_answer(answer))
+            if key not in first_idxs:
+                first_idxs[key] = len(unique_answers)
+                unique_questions.append(questions[question_idx])
+                unique_answers.append(answer)
+            unique_idxs[i] = first_idxs[key]
+        with STAGE_SECONDS.time(stage="score"):
+            if self.in_memory:
+                scores = self.reward_model.predict_from_strings(
+                    inputs=unique_questions,
+                    targets=unique_answers,
+                    checkpoint_steps=self.reward_model_ckpt_steps
+                )
+            else:
+                scores = self._score_through_files(unique_questions, unique_answers)
+        CANDIDATES_SCORED.inc(len(unique_answers))
+        CANDIDATES_DEDUPLICATED.inc(len(answers) - len(unique_answers))
+        return np.asarray(scores)[unique_idxs]
+
+    def _tmp_path(self, name):
+        # Unique, since sampling and scoring may run in different threads
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}-{name}")
+
+    def _predict_through_files(self, questions):
+        questions_path = self._tmp_path("questions.txt")
+        predictions_path = self._tmp_path("t5-predictions.txt")
+        with tf.io.gfile.GFile(questions_path, "w") as questions_file:
+            for question in questions:
+                questions_file.write(question + "\n")
+        try:
+            self.t5_model.predict(
+                input_file=questions_path,
+                output_file=predictions_path,
+                checkpoint_steps=self.t5_model_ckpt_steps,
+                sampling_keep_top_p=self.sampling_keep_top_p
+            )
+            # The checkpoint step is appended to the file name
+            output_path, = tf.io.gfile.glob(predictions_path + "-*")
+            with tf.io.gfile.GFile(output_path, "r") as predictions_file:
+                answers = [line.rstrip("\n") for line in predictions_file]
+        finally:
+            for path in [questions_path] + tf.io.gfile.glob(predictions_path + "-*"):
+                tf.io.gfile.remove(path)
+        return answers[:len(questions)]
+
+    def _score_through_files(self, questions, answers):
+        pairs_path = self._tmp_path("pairs.tsv")
+        scores_path = self._tmp_path("scores.txt")
+        with tf.io.gfile.GFile(pairs_path, "w") as pairs_file:
+            for question, answer in zip(questions, answers):
+                pairs_file.write(question + "\t" + answer + "\n")
+        try:
+            self.reward_model.predict_from_file(
+                input_path=pairs_path,
+                output_path=scores_path,
+                checkpoint_steps=self.reward_model_ckpt_steps
+            )
+            with tf.io.gfile.GFile(scores_path, "r") as scores_file:
+                # The last batch is padded
+                scores = [float(line) for line in scores_file][:len(answers)]
+        finally:
+            for path in [pairs_path, scores_path]:
+                if tf.io.gfile.exists(path):
+                    tf.io.gfile.remove(path)
+        return np.array(scores, dtype=np.float32)
+
+    def candidates(self, questions):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+
+        Returns:
+        candidates: best_of_n.candidates.CandidateTable
+            Every answer sampled for every question, with its reward. Questions
+            get N answers, or fewer if there is a stopping_rule
+        """
+        if self.stopping_rule is not None:
+            return self._adaptive_candidates(questions)
+        if self.pipeline_chunk_size is not None \
+            and len(questions) > self.pipeline_chunk_size:
+            return self._pipelined_candidates(questions)
+        answers = self.sample_N(questions)
+        return CandidateTable.from_matrix(answers, self.score(questions, answers))
+
+    def rerank(self, questions, answers):
+        """
+        Score given answers instead of sampled ones
+
+        Args:
+        questions: [str]
+            T5-formatted questions
+        answers: [[str]]
+            Candidate answers to every question
+
+        Returns:
+        candidates: best_of_n.candidates.CandidateTable
+        """
+        lengths = [len(question_answers) for question_answers in answers]
+        flat_answers = [answer for question_answers in answers for answer in question_answers]
+        question_idxs = np.repeat(np.arange(len(questions)), lengths)
+        scores = self.score_candidates(questions, question_idxs, flat_answers) \
+            if flat_answers else np.zeros(0, dtype=np.float32)
+        return CandidateTable(question_idxs, flat_answers, scores)
+
+    def best_of_n(self, questions):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+
+        Returns:
+        advices: [str]
+            The top-scoring answer out of the samples of every question
+        n_samples: [int]
+            How many samples every question used. Always N, unless there is a
+            stopping_rule
+        """
+        if len(questions) == 0:
+            return [], []
+        candidates = self.candidates(questions)
+        with STAGE_SECONDS.time(stage="select"):
+            advices = candidates.best(len(questions))
+        return advices, candidates.counts(len(questions)).tolist()
+
+    def _pipelined_candidates(self, questions):
+        chunks = [
+            questions[i:i + self.pipeline_chunk_size]
+            for i in range(0, len(questions), self.pipeline_chunk_size)
+        ]
+        # Sampled chunks (or the exception that stopped sampling)
+        sampled = queue.Queue(maxsize=self.pipeline_queue_size)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    sampled.put(item, timeout=1.0)
+                    return
+                except queue.Full:
+                    pass
+
+        def _sample_chunks():
+            try:
+                for chunk in chunks:
+                    if stop.is_set():
+                        return
+                    _put(self.sample_N(chunk))
+            except Exception as e:
+                _put(e)
+
+        sampler = threading.Thread(
+            target=_sample_chunks, name="best-of-n-sampler", daemon=True
+        )
+        sampler.start()
+        tables = []
+        try:
+            for chunk in chunks:
+                answers = sampled.get()
+                if isinstance(answers, Exception):
+                    raise answers
+                tables.append(
+                    CandidateTable.from_matrix(answers, self.score(chunk, answers))
+                )
+        finally:
+            # Let the sampler exit if scoring failed
+            stop.set()
+        sampler.join()
+        return CandidateTable.concatenate(tables, [len(chunk) for chunk in chunks])
+
+    def _adaptive_candidates(self, questions):
+        answers = [[] for _ in questions]
+        scores = [[] for _ in questions]
+        # Active questions always have the same number of samples
+        active_idxs = list(range(len(questions)))
+        while active_idxs:
+            n_new = min(self.round_size, self.N - len(answers[active_idxs[0]]))
+            active_questions = [questions[i] for i in active_idxs]
+            round_answers = self.sample_N(active_questions, n_new)
+            round_scores = self.score(active_questions, round_answers)
+            still_active_idxs = []
+            for i, question_answers, question_scores in zip(
+                active_idxs, round_answers, round_scores
+                ):
+                answers[i].extend(question_answers)
+                scores[i].extend(question_scores)
+                if len(answers[i]) < self.N \
+                    and not self.stopping_rule(scores[i], n_new):
+                    still_active_idxs.append(i)
+            active_idxs = still_active_idxs
+        return CandidateTable.from_lists(answers, scores)
+
+    def generate_from_questions(self, questions):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+
+        Returns:
+        advices: [str]
+            The top-scoring answer out of N samples, for every question
+        """
+        advices, _ = self.best_of_n(questions)
+        return advices
+
+    def generate_N(self, inputs_path, outputs_path, output_format="tsv"):
         """
         Args:
         inputs_path: str
@@ -27,31 +435,22 @@ class BestOfNGenerator():
         outputs_path: str
             A text file with N answers per question, preceded by the question,
             i.e. each line looks like <question>\t<answer>
+        output_format: str
+            "tsv" for the text file above, or "store" to write a generation
+            store directory (see best_of_n/generation_store.py) instead
         """
-        # Repeat each input N times, store in temporary file
-        REPEATED_QUESTIONS_PATH = os.path.join(self.tmp_dir, "repeated-questions.txt")
-        T5_PREDICTIONS_PATH = os.path.join(self.tmp_dir, "t5-predictions.txt")
-        with tf.io.gfile.GFile(inputs_path, "r") as inputs_file, \
-             tf.io.gfile.GFile(REPEATED_QUESTIONS_PATH, "w") as repeats_file:
-            for line in inputs_file:
-                for _ in range(self.N):
-                    repeats_file.write(line)
-        # Predict over repeated inputs file
-        self.t5_model.predict(
-            input_file=REPEATED_QUESTIONS_PATH,
-            output_file=T5_PREDICTIONS_PATH,
-            checkpoint_steps=self.t5_model_ckpt_steps,
-            sampling_keep_top_p=self.sampling_keep_top_p
-        )
-        T5_PREDICTIONS_PATH += f"-{self.t5_model_ckpt_steps}"
-        # Append answers to repeated questions and write output
-        with tf.io.gfile.GFile(REPEATED_QUESTIONS_PATH, "r") as repeats_file, \
-             tf.io.gfile.GFile(T5_PREDICTIONS_PATH, "r") as predictions_file, \
-             tf.io.gfile.GFile(outputs_path, "w") as outputs_file:
-            for question, answer in zip(repeats_file, predictions_file):
-                question = question[:-1] # remove newline character
-                outputs_file.write(question + "\t" + answer)
-    
+        questions = _read_questions(inputs_path)
+        answers = self.sample_N(questions)
+        if output_format == "store":
+            with GenerationStoreWriter(outputs_path) as writer:
+                for question, question_answers in zip(questions, answers):
+                    writer.add(question, list(question_answers))
+            return
+        with tf.io.gfile.GFile(outputs_path, "w") as outputs_file:
+            for question, question_answers in zip(questions, answers):
+                for answer in question_answers:
+                    outputs_file.write(question + "\t" + answer + "\n")
+
     def generate(self, inputs_path, outputs_path):
         """
         Args:
@@ -61,65 +460,105 @@ class BestOfNGenerator():
         outputs_path: str
             A text file with one answer (no preceding question!) per line
         """
-        N_GENERATIONS_PATH = os.path.join(self.tmp_dir, "N-generations")
-        N_SCORES_PATH = os.path.join(self.tmp_dir, "N-scores")
-        self.generate_N(inputs_path, N_GENERATIONS_PATH)
-        self.reward_model.predict_from_file(
-            input_path=N_GENERATIONS_PATH,
-            output_path=N_SCORES_PATH,
-            checkpoint_steps=self.reward_model_ckpt_steps
-        )
-        # Write top-scoring answer to every question
-        with tf.io.gfile.GFile(N_GENERATIONS_PATH, "r") as gens_file, \
-             tf.io.gfile.GFile(N_SCORES_PATH, "r") as scores_file, \
-             tf.io.gfile.GFile(outputs_path, "w") as outputs_file:
-            best_score = -float("inf")
-            best_answer = None
-            answer_count = 0
-            for answer, str_score in zip(gens_file, scores_file):
-                score = float(str_score)
-                answer_count += 1
-                if score > best_score:
-                    best_score = score
-                    best_answer = answer.split("\t")[1] # Drop question text
-                if answer_count >= self.N:
-                    # Write best answer and start processing next question
-                    outputs_file.write(best_answer)
-                    answer_count = 0
-                    best_score = -float("inf")
-                    best_answer = None
-    
+        advices = self.generate_from_questions(_read_questions(inputs_path))
+        with tf.io.gfile.GFile(outputs_path, "w") as outputs_file:
+            for advice in advices:
+                outputs_file.write(advice + "\n")
+
     def generate_from_instances(self, instances):
         """
         Args:
         instances: [dict]
             Each element is a dict with keys "title", "date", "selftext",
             "subreddit"
-        
+
         Returns:
         advices: [str]
         """
-        # Write a temporary file with the instances
-        TMP_INSTANCES_FILE = os.path.join(self.tmp_dir, "instances.txt")
-        with tf.io.gfile.GFile(TMP_INSTANCES_FILE, "w") as instances_file:
-            for instance in instances:
-                instance["selftext"] = _trim_to_desired_length(
-                    encoder,
-                    instance["selftext"],
-                    desired_len=SELFTEXT_DESIRED_LEN
-                )
-                instance = {k: _fix_reddit_text(v) for k,v in instance.items()}
-                str_instance = \
-                    "Subreddit: " + instance["subreddit"] \
-                    + " Date: " + instance["date"] \
-                    + " Title: " + instance["title"] \
-                    + " Selftext: " + instance["selftext"]
-                instances_file.write(str_instance + "\n")
-        # Call self.generate
-        TMP_OUTPUTS_PATH = os.path.join(self.tmp_dir, "instance_outputs.txt")
-        self.generate(TMP_INSTANCES_FILE, TMP_OUTPUTS_PATH)
-        advices = []
-        with tf.io.gfile.GFile(TMP_OUTPUTS_PATH, "r") as outputs_file:
-            for instance_output in outputs_file:
-                advices.append(instance_output[:-1]) # Remove newline
-        return advices
\ No newline at end of file
+        return [
+            result["advice"]
+            for result in self.best_of_n_from_instances(instances)
+        ]
+
+    def best_of_n_from_instances(self, instances):
+        """
+        Args:
+        instances: [dict]
+            Each element is a dict with keys "title", "date", "selftext",
+            "subreddit"
+
+        Returns:
+        results: [dict]
+            Each element is a dict with keys "advice" and "n_samples" (see
+            best_of_n)
+        """
+        if self.cache is not None:
+            return self.cache.get_or_compute(
+                instances, self.model_id, self._best_of_n_from_instances
+            )
+        return self._best_of_n_from_instances(instances)
+
+    def _best_of_n_from_instances(self, instances):
+        with STAGE_SECONDS.time(stage="format"):
+            questions = [format_instance(instance) for instance in instances]
+        advices, n_samples = self.best_of_n(questions)
+        return [
+            {"advice": advice, "n_samples": n}
+            for advice, n in zip(advices, n_samples)
+        ]
+
+    def rerank_instances(self, instances):
+        """
+        Args:
+        instances: [dict]
+            Each element is a dict with keys "title", "date", "selftext",
+            "subreddit" and "candidates", a list of answers to score
+
+        Returns:
+        candidates: best_of_n.candidates.CandidateTable
+        """
+        with STAGE_SECONDS.time(stage="format"):
+            questions = [format_instance(instance) for instance in instances]
+        return self.rerank(
+            questions, [instance["candidates"] for instance in instances]
+        )
+
+    def process_batch(self, items):
+        """
+        Generates advice for instances and reranks the candidates of
+        RerankRequests in one call, so that a single thread (e.g. a
+        frontend.batching.MicroBatcher's) uses the models for both
+
+        Args:
+        items: list
+            Instances (see best_of_n_from_instances) and RerankRequests
+
+        Returns:
+        results: [dict]
+            One result per item. For instances, see best_of_n_from_instances.
+            For RerankRequests, a dict with keys "scores", the reward of every
+            candidate, and "best", the best-scoring candidate
+        """
+        results = [None] * len(items)
+        rerank_idxs = [
+            i for i, item in enumerate(items) if isinstance(item, RerankRequest)
+        ]
+        is_rerank = set(rerank_idxs)
+        instance_idxs = [i for i in range(len(items)) if i not in is_rerank]
+        if instance_idxs:
+            instance_results = self.best_of_n_from_instances(
+                [items[i] for i in instance_idxs]
+            )
+            for i, result in zip(instance_idxs, instance_results):
+                results[i] = result
+        if rerank_idxs:
+            candidates = self.rerank_instances(
+                [items[i].instance for i in rerank_idxs]
+            )
+            scores = [[] for _ in rerank_idxs]
+            for question_idx, score in zip(candidates.question_idxs, candidates.scores):
+                scores[question_idx].append(float(score))
+            best = candidates.best(len(rerank_idxs))
+            for j, i in enumerate(rerank_idxs):
+                results[i] = {"scores": scores[j], "best": best[j]}
+        return results
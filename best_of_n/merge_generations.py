@@ -1,8 +1,15 @@
 import sys
+import queue
+import threading
 
 from absl import flags
 import tensorflow as tf
 
+from best_of_n.generation_store import merge_stores, allocate_counts
+
+# Bytes read from, and written to, the text files at once
+BLOCK_BYTES = 16 * 1024 * 1024
+
 def _define_flags():
     flags.DEFINE_list(
         name="input_paths",
@@ -12,7 +19,8 @@ def _define_flags():
     flags.DEFINE_list(
         name="n",
         default=None,
-        help=" Comma separated list of integers. For each input path, the number of generations per question in that file"
+        help=" Comma separated list of integers. For each input path, the number of generations per question in that file. "
+            "By default, every file has N"
     )
     flags.DEFINE_string(
         name="output_path",
@@ -24,8 +32,182 @@ def _define_flags():
         default=1,
         help="The number of generations per question in the output file"
     )
+    flags.DEFINE_list(
+        name="weights",
+        default=None,
+        help="Comma-separated list of floats. For each input path, the share of the N generations to take from it, "
+            "e.g. to mix checkpoints or temperatures. By default, generations are taken from the first files first"
+    )
+    flags.DEFINE_integer(
+        name="read_ahead_blocks",
+        default=4,
+        help="Blocks of each input file read ahead of the merge"
+    )
+    flags.DEFINE_enum(
+        name="format",
+        default="tsv",
+        enum_values=["tsv", "store"],
+        help="Whether inputs and output are question<TAB>answer text files or "
+            "generation stores (see best_of_n/generation_store.py). n is not "
+            "needed for stores"
+    )
     return flags.FLAGS
 
+class QuestionGroupReader():
+    """
+    Reads a question<TAB>answer text file in a background thread, up to
+    read_ahead_blocks blocks ahead of the consumer, and yields the lines of
+    one question at a time
+    """
+    def __init__(self, path, n, read_ahead_blocks=4, block_bytes=BLOCK_BYTES):
+        """
+        Args:
+        path: str
+        n: int
+            Lines per question. Needed even though every line starts with its
+            question, since a question asked twice in a row (e.g. a repost)
+            would otherwise look like one question with twice the lines
+        """
+        self.path = path
+        self.n = n
+        self.block_bytes = block_bytes
+        # Lists of (question, lines), or the exception that stopped reading
+        self._groups = queue.Queue(maxsize=read_ahead_blocks)
+        self._stop = threading.Event()
+        self._reader = threading.Thread(
+            target=self._read, name=f"read-{path}", daemon=True
+        )
+        self._reader.start()
+
+    def __iter__(self):
+        while True:
+            groups = self._groups.get()
+            if groups is None:
+                return
+            if isinstance(groups, Exception):
+                raise groups
+            yield from groups
+
+    def close(self):
+        self._stop.set()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._groups.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def _read(self):
+        try:
+            groups = []
+            n_questions = 0
+            question = None
+            lines = []
+            for line in self._read_lines():
+                line_question = line.split("\t", 1)[0]
+                is_new_question = len(lines) == self.n
+                if lines and not is_new_question and line_question != question:
+                    raise ValueError(
+                        f"{self.path}: the lines of question {n_questions} "
+                        f"have different questions, is n={self.n} right?"
+                    )
+                if is_new_question:
+                    groups.append((question, lines))
+                    n_questions += 1
+                    lines = []
+                question = line_question
+                lines.append(line)
+                if len(groups) >= 1024:
+                    self._put(groups)
+                    groups = []
+            if lines:
+                if len(lines) != self.n:
+                    raise ValueError(
+                        f"{self.path}: the last question has {len(lines)} "
+                        f"lines, is n={self.n} right?"
+                    )
+                groups.append((question, lines))
+            self._put(groups)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _read_lines(self):
+        with tf.io.gfile.GFile(self.path, "r") as f:
+            partial_line = ""
+            while not self._stop.is_set():
+                block = f.read(self.block_bytes)
+                if not block:
+                    break
+                lines = (partial_line + block).split("\n")
+                partial_line = lines.pop()
+                yield from (line + "\n" for line in lines)
+            if partial_line:
+                yield partial_line + "\n"
+
+def merge(input_paths, output_path, N, n=None, weights=None, read_ahead_blocks=4):
+    """
+    Merge the generations in several text files, read in parallel, into one
+    file with N generations per question
+
+    Args:
+    input_paths: [str]
+        question<TAB>answer text files with the same questions, in the same
+        order
+    n: [int]
+        Generations per question in each file. By default, every file has N
+    weights: [float]
+        See best_of_n.generation_store.allocate_counts
+    """
+    if n is None:
+        n = [N] * len(input_paths)
+    readers = [
+        QuestionGroupReader(path, n[i], read_ahead_blocks)
+        for i, path in enumerate(input_paths)
+    ]
+    iterators = [iter(reader) for reader in readers]
+    try:
+        with tf.io.gfile.GFile(output_path, "w") as output_file:
+            buffer = []
+            buffer_bytes = 0
+            question_idx = 0
+            while True:
+                groups = [next(iterator, None) for iterator in iterators]
+                if all(group is None for group in groups):
+                    break
+                for path, group in zip(input_paths, groups):
+                    if group is None:
+                        raise ValueError(
+                            f"{path} ends after {question_idx} questions, "
+                            f"other input files have more"
+                        )
+                    if group[0] != groups[0][0]:
+                        raise ValueError(
+                            f"Question {question_idx} of {path} differs from "
+                            f"that of {input_paths[0]}"
+                        )
+                try:
+                    counts = allocate_counts(
+                        [len(lines) for _, lines in groups], N, weights
+                    )
+                except ValueError as e:
+                    raise ValueError(f"Question {question_idx}: {e}")
+                for (_, lines), count in zip(groups, counts):
+                    buffer.extend(lines[:count])
+                    buffer_bytes += sum(len(line) for line in lines[:count])
+                if buffer_bytes >= BLOCK_BYTES:
+                    output_file.write("".join(buffer))
+                    buffer = []
+                    buffer_bytes = 0
+                question_idx += 1
+            output_file.write("".join(buffer))
+    finally:
+        for reader in readers:
+            reader.close()
+    return question_idx
+
 if __name__ == "__main__":
     """
     Merge the text generations in several input files into a single output file
@@ -33,33 +215,13 @@ if __name__ == "__main__":
     """
     FLAGS = _define_flags()
     FLAGS(sys.argv)
-    n = [int(i) for i in FLAGS.n]
-    assert sum(n) >= FLAGS.N, "There are < N generations among the input files"
-    input_files = [tf.io.gfile.GFile(p, "r") for p in FLAGS.input_paths]
-    with tf.io.gfile.GFile(FLAGS.output_path, "w") as output_file:
-        to_next_question = True
-        while(to_next_question):
-            # Read all generations for the next question from each input file
-            all_answers_to_question = []
-            for idx, input_file in enumerate(input_files):
-                anss_from_file = [input_file.readline() for _ in range(n[idx])]
-                anss_from_file = [a for a in anss_from_file if len(a) > 0]
-                all_answers_to_question.append(anss_from_file)
-            # Write N answers to output
-            anss_to_write = []
-            n_anss_found = 0
-            for anss_from_file in all_answers_to_question:
-                if len(anss_from_file) == 0:
-                    continue
-                n_to_write = min(FLAGS.N - n_anss_found, len(anss_from_file))
-                anss_to_write.extend(anss_from_file[:n_to_write])
-                n_anss_found += n_to_write
-                if n_anss_found >= FLAGS.N:
-                    break
-            if n_anss_found == FLAGS.N:
-                for ans in anss_to_write:
-                    output_file.write(ans)
-            else:
-                to_next_question = False
-    for input_file in input_files:
-        input_file.close()
\ No newline at end of file
+    weights = None if FLAGS.weights is None else [float(w) for w in FLAGS.weights]
+    if FLAGS.format == "store":
+        merge_stores(FLAGS.input_paths, FLAGS.output_path, FLAGS.N, weights)
+        sys.exit(0)
+    n = None if FLAGS.n is None else [int(i) for i in FLAGS.n]
+    n_questions = merge(
+        FLAGS.input_paths, FLAGS.output_path, FLAGS.N, n, weights,
+        FLAGS.read_ahead_blocks
+    )
+    print(f"Merged {n_questions} questions into {FLAGS.output_path}")
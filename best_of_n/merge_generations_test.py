@@ -0,0 +1,100 @@
+"""Tests for best_of_n.merge_generations and allocate_counts"""
+import numpy as np
+import pytest
+
+from best_of_n.generation_store import allocate_counts, merge_stores, \
+    tsv_to_store, store_to_tsv
+from best_of_n.merge_generations import merge
+
+def test_allocate_counts_without_weights_uses_sources_in_order():
+    assert allocate_counts([5, 5], 4) == [4, 0]
+    assert allocate_counts([2, 5, 5], 4) == [2, 2, 0]
+
+def test_allocate_counts_follows_weights():
+    assert allocate_counts([5, 5], 4, weights=[1, 1]) == [2, 2]
+    assert allocate_counts([10, 10], 8, weights=[3, 1]) == [6, 2]
+    # Largest remainder first, ties to the first source
+    assert allocate_counts([5, 5, 5], 4, weights=[1, 1, 1]) == [2, 1, 1]
+    assert allocate_counts([5, 5], 3, weights=[1, 2]) == [1, 2]
+
+def test_allocate_counts_makes_up_shortfalls_by_weight():
+    assert allocate_counts([1, 10], 4, weights=[3, 1]) == [1, 3]
+    assert allocate_counts([10, 1, 10], 6, weights=[1, 2, 3]) == [1, 1, 4]
+
+def test_allocate_counts_adds_up_to_N():
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        n_sources = rng.randint(1, 5)
+        n_available = rng.randint(0, 10, size=n_sources)
+        N = rng.randint(0, n_available.sum() + 1)
+        weights = rng.random_sample(n_sources) + 0.01
+        counts = allocate_counts(n_available, N, weights)
+        assert sum(counts) == N
+        assert all(0 <= c <= n for c, n in zip(counts, n_available))
+
+def test_allocate_counts_rejects_too_few_answers():
+    with pytest.raises(ValueError):
+        allocate_counts([1, 2], 4, weights=[1, 1])
+
+def _write_tsv(path, questions, n, tag):
+    with open(path, "w", encoding="utf-8") as f:
+        for question in questions:
+            for i in range(n):
+                f.write(f"{question}\t{tag}{i}\n")
+    return str(path)
+
+# The second question is a repost of the first
+QUESTIONS = ["q0", "q0", "q1"]
+
+def _expected(counts_per_source):
+    return "".join(
+        f"{question}\t{tag}{i}\n"
+        for question in QUESTIONS
+        for tag, count in counts_per_source
+        for i in range(count)
+    )
+
+def test_weighted_merge(tmp_path):
+    paths = [
+        _write_tsv(tmp_path / "a.tsv", QUESTIONS, 3, "a"),
+        _write_tsv(tmp_path / "b.tsv", QUESTIONS, 2, "b")
+    ]
+    output_path = str(tmp_path / "merged.tsv")
+    n_questions = merge(paths, output_path, 3, n=[3, 2], weights=[1, 2])
+    assert n_questions == 3
+    with open(output_path, "r", encoding="utf-8") as f:
+        assert f.read() == _expected([("a", 1), ("b", 2)])
+
+def test_unweighted_merge_takes_the_first_files_first(tmp_path):
+    paths = [
+        _write_tsv(tmp_path / "a.tsv", QUESTIONS, 2, "a"),
+        _write_tsv(tmp_path / "b.tsv", QUESTIONS, 2, "b")
+    ]
+    output_path = str(tmp_path / "merged.tsv")
+    merge(paths, output_path, 3, n=[2, 2])
+    with open(output_path, "r", encoding="utf-8") as f:
+        assert f.read() == _expected([("a", 2), ("b", 1)])
+
+def test_merge_rejects_files_with_different_questions(tmp_path):
+    paths = [
+        _write_tsv(tmp_path / "a.tsv", QUESTIONS, 2, "a"),
+        _write_tsv(tmp_path / "b.tsv", ["q0", "q1", "q1"], 2, "b")
+    ]
+    with pytest.raises(ValueError):
+        merge(paths, str(tmp_path / "merged.tsv"), 3, n=[2, 2])
+
+def test_merge_stores_matches_merge(tmp_path):
+    paths = [
+        _write_tsv(tmp_path / "a.tsv", QUESTIONS, 3, "a"),
+        _write_tsv(tmp_path / "b.tsv", QUESTIONS, 2, "b")
+    ]
+    tsv_output_path = str(tmp_path / "merged.tsv")
+    merge(paths, tsv_output_path, 4, n=[3, 2], weights=[1, 1])
+    store_dirs = [str(tmp_path / "a.store"), str(tmp_path / "b.store")]
+    for path, store_dir, n in zip(paths, store_dirs, [3, 2]):
+        tsv_to_store(path, store_dir, n)
+    merge_stores(store_dirs, str(tmp_path / "merged.store"), 4, weights=[1, 1])
+    store_to_tsv(str(tmp_path / "merged.store"), str(tmp_path / "merged_store.tsv"))
+    with open(tsv_output_path, "r", encoding="utf-8") as f, \
+        open(tmp_path / "merged_store.tsv", "r", encoding="utf-8") as g:
+        assert f.read() == g.read() == _expected([("a", 2), ("b", 2)])
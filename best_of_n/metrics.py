@@ -0,0 +1,165 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Best-of-N requests take from seconds to tens of minutes
+DEFAULT_BUCKETS = (
+    0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+    1200.0, 2400.0
+)
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in pairs
+    ) + "}"
+
+class _Metric():
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}"
+        ]
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, labelvalues, value):
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"]
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # Per-bucket (not cumulative) counts, sum, count
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            bucket_counts, _, _ = self._values[key]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+                    break
+            self._values[key][1] += value
+            self._values[key][2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent in the with block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _render_value(self, labelvalues, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            labels = _format_labels(
+                self.labelnames, labelvalues, [("le", repr(float(upper_bound)))]
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, labelvalues, [("le", "+Inf")])
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry():
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name in self._metrics:
+                metric = self._metrics[name]
+                if not isinstance(metric, cls):
+                    raise ValueError(f"{name} is already registered as a {metric.type_name}")
+                return metric
+            metric = cls(name, *args, **kwargs)
+            self._metrics[name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Get or create the counter called name"""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Get or create the histogram called name"""
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "bon_stage_seconds",
+    "Wall time spent in each stage of best-of-N generation",
+    labelnames=("stage",)
+)
+CANDIDATES_GENERATED = REGISTRY.counter(
+    "bon_candidates_generated_total", "Answers sampled from T5"
+)
+CANDIDATES_SCORED = REGISTRY.counter(
+    "bon_candidates_scored_total", "Answers scored by the reward model"
+)
+CANDIDATES_DEDUPLICATED = REGISTRY.counter(
+    "bon_candidates_deduplicated_total",
+    "Answers that weren't scored because they duplicate another answer to the "
+    "same question. The dedup rate is this over itself plus "
+    "bon_candidates_scored_total"
+)
@@ -0,0 +1,293 @@
+"""
+Sample N answers per question (like test_generate_N.py) in resumable shards.
+
+The questions file is split into shards of shard_size questions. Each shard's
+output is written to work_dir, followed by a completion marker, and shards
+whose marker exists are skipped. A failed run can therefore be restarted with
+the same flags, and several workers can share work_dir by each passing its own
+worker_index. Once every shard is done, their outputs are merged in the
+original order into output_path.
+
+python best_of_n/run_sharded.py --input_path=best_of_n/data/test_questions.tsv \
+    --work_dir=gs://.../test_shards --output_path=gs://.../test_generations.tsv \
+    --model_dir=gs://... --N=80 --shard_size=256 --worker_index=0 --num_workers=2
+"""
+import os
+import sys
+import json
+import time
+from absl import flags
+
+import tensorflow as tf
+
+from t5.models.mtf_model import MtfModel, _get_latest_checkpoint_from_dir
+from best_of_n.generator import BestOfNGenerator, _read_questions
+from best_of_n.generation_store import concatenate_stores
+from best_of_n.scratch import ScratchNamespace
+
+def _define_flags():
+    flags.DEFINE_string(
+        name="input_path",
+        default=None,
+        help="Text file with one T5-formatted question per line"
+    )
+    flags.DEFINE_string(
+        name="work_dir",
+        default=None,
+        help="Directory for shard outputs and completion markers. Reuse it to "
+            "resume a run"
+    )
+    flags.DEFINE_string(
+        name="output_path",
+        default=None,
+        help="Where to merge the outputs of all shards"
+    )
+    flags.DEFINE_enum(
+        name="output_format",
+        default="tsv",
+        enum_values=["tsv", "store"],
+        help="question<TAB>answer text files, or generation stores (see "
+            "best_of_n/generation_store.py)"
+    )
+    flags.DEFINE_integer(
+        name="shard_size",
+        default=256,
+        help="Questions per shard"
+    )
+    flags.DEFINE_integer(
+        name="worker_index",
+        default=0,
+        help="This worker processes the shards with index % num_workers == "
+            "worker_index"
+    )
+    flags.DEFINE_integer(
+        name="num_workers",
+        default=1,
+        help="Number of workers sharing work_dir"
+    )
+    flags.DEFINE_boolean(
+        name="merge_only",
+        default=False,
+        help="Don't process any shard, only merge them if they are all done"
+    )
+    flags.DEFINE_integer(
+        name="N",
+        default=1,
+        help="How many outputs to generate per input?"
+    )
+    flags.DEFINE_string(
+        name="model_dir",
+        default=None,
+        help="Directory with T5 checkpoints"
+    )
+    flags.DEFINE_integer(
+        name="checkpoint_steps",
+        default=-1,
+        help="Steps in checkpoint to be used for prediction"
+    )
+    flags.DEFINE_integer(
+        name="iterations_per_loop",
+        default=1000,
+        help="How many steps to make in each estimator call."
+    )
+    flags.DEFINE_integer(
+        name="model_parallelism",
+        default=8,
+        help="Number of cores per model instance."
+    )
+    flags.DEFINE_integer(
+        name="batch_size",
+        default=1,
+        help="Batch size. Spillover samples are ignored"
+    )
+    flags.DEFINE_integer(
+        name="samples_per_example",
+        default=None,
+        help="If given, samples decoded per encoding of a question. Needs "
+            "in_memory. By default, every question is repeated and encoded "
+            "once per sample"
+    )
+    flags.DEFINE_string(
+        name="tmp_dir",
+        default=None,
+        help="Temporary dir for internal use of BestOfNGenerator"
+    )
+    flags.DEFINE_boolean(
+        name="in_memory",
+        default=False,
+        help="Predict from strings, keeping checkpoints in memory, instead of "
+            "through files in tmp_dir. Experimental on TPUs"
+    )
+    return flags.FLAGS
+
+class ShardedRun():
+    """
+    The shards of one run over a questions file, and their state in work_dir
+    """
+    def __init__(self, questions, work_dir, shard_size, output_format="tsv"):
+        """
+        Args:
+        questions: [str]
+            T5-formatted questions
+        work_dir: str
+            Local or GCS directory shared by all workers of the run
+        shard_size: int
+            Questions per shard
+        output_format: str
+            "tsv" or "store", see BestOfNGenerator.generate_N
+        """
+        self.questions = questions
+        self.work_dir = work_dir
+        self.shard_size = shard_size
+        self.output_format = output_format
+        self.n_shards = max(1, -(-len(questions) // shard_size))
+
+    def shard_name(self, shard_idx):
+        # The shard count is part of the name, so that a run resumed with a
+        # different shard_size doesn't reuse mismatched shards
+        return f"shard-{shard_idx:05d}-of-{self.n_shards:05d}"
+
+    def output_path(self, shard_idx):
+        extension = ".tsv" if self.output_format == "tsv" else ".store"
+        return os.path.join(self.work_dir, self.shard_name(shard_idx) + extension)
+
+    def marker_path(self, shard_idx):
+        return os.path.join(self.work_dir, self.shard_name(shard_idx) + "._DONE")
+
+    def shard_questions(self, shard_idx):
+        return self.questions[
+            shard_idx * self.shard_size:(shard_idx + 1) * self.shard_size
+        ]
+
+    def is_done(self, shard_idx):
+        return tf.io.gfile.exists(self.marker_path(shard_idx))
+
+    def pending_shards(self, worker_index=0, num_workers=1):
+        """Indices of this worker's shards that aren't done yet"""
+        return [
+            shard_idx for shard_idx in range(worker_index, self.n_shards, num_workers)
+            if not self.is_done(shard_idx)
+        ]
+
+    def run_shard(self, shard_idx, generate_fn):
+        """
+        Args:
+        generate_fn: callable
+            Takes the path of a file with one question per line and an output
+            path, e.g. BestOfNGenerator.generate_N
+
+        Returns:
+        stats: dict
+            Also written to the shard's completion marker
+        """
+        questions = self.shard_questions(shard_idx)
+        start = time.time()
+        with ScratchNamespace(self.work_dir, prefix=self.shard_name(shard_idx)) as scratch:
+            inputs_path = scratch.path("inputs.txt")
+            with tf.io.gfile.GFile(inputs_path, "w") as inputs_file:
+                for question in questions:
+                    inputs_file.write(question + "\n")
+            generate_fn(inputs_path, self.output_path(shard_idx))
+        secs = time.time() - start
+        stats = {
+            "shard": shard_idx,
+            "n_questions": len(questions),
+            "secs": secs,
+            "questions_per_sec": len(questions) / secs if secs > 0 else None
+        }
+        # The marker is written last, so a shard interrupted before it is
+        # reprocessed from scratch
+        with tf.io.gfile.GFile(self.marker_path(shard_idx), "w") as marker_file:
+            marker_file.write(json.dumps(stats))
+        return stats
+
+    def run(self, generate_fn, worker_index=0, num_workers=1):
+        """Process this worker's pending shards, reporting progress"""
+        pending = self.pending_shards(worker_index, num_workers)
+        n_worker_shards = len(range(worker_index, self.n_shards, num_workers))
+        print(
+            f"Worker {worker_index}/{num_workers}: {len(pending)} of its "
+            f"{n_worker_shards} shards left to process", flush=True
+        )
+        for shard_idx in pending:
+            stats = self.run_shard(shard_idx, generate_fn)
+            print(
+                f"{self.shard_name(shard_idx)}: {stats['n_questions']} questions "
+                f"in {stats['secs']:.1f}s "
+                f"({stats['questions_per_sec'] or 0:.3f} questions/s)", flush=True
+            )
+
+    def merge(self, output_path):
+        """
+        Merge the outputs of all shards, in order
+
+        Returns:
+        merged: bool
+            False if some shards aren't done yet
+        """
+        not_done = [i for i in range(self.n_shards) if not self.is_done(i)]
+        if not_done:
+            print(
+                f"Not merging, {len(not_done)} shards aren't done yet: "
+                + ", ".join(self.shard_name(i) for i in not_done[:10]), flush=True
+            )
+            return False
+        shard_paths = [self.output_path(i) for i in range(self.n_shards)]
+        if self.output_format == "store":
+            concatenate_stores(shard_paths, output_path)
+        else:
+            with tf.io.gfile.GFile(output_path, "w") as output_file:
+                for shard_path in shard_paths:
+                    with tf.io.gfile.GFile(shard_path, "r") as shard_file:
+                        while True:
+                            block = shard_file.read(16 * 1024 * 1024)
+                            if not block:
+                                break
+                            output_file.write(block)
+        print(f"Merged {self.n_shards} shards into {output_path}", flush=True)
+        return True
+
+def main(_):
+    FLAGS = _define_flags()
+    FLAGS(sys.argv)
+    run = ShardedRun(
+        _read_questions(FLAGS.input_path),
+        FLAGS.work_dir,
+        FLAGS.shard_size,
+        FLAGS.output_format
+    )
+    if not FLAGS.merge_only:
+        if FLAGS.checkpoint_steps == -1:
+            ckpt_steps = _get_latest_checkpoint_from_dir(FLAGS.model_dir)
+        else:
+            ckpt_steps = FLAGS.checkpoint_steps
+        t5_model = MtfModel(
+            model_dir=FLAGS.model_dir,
+            tpu=os.uname()[1],
+            tpu_topology='2x2', # Must be this for validation
+            model_parallelism=FLAGS.model_parallelism,
+            batch_size=FLAGS.batch_size,
+            sequence_length={"inputs": 1280, "targets": 512},
+            iterations_per_loop=FLAGS.iterations_per_loop,
+            predict_queue_feed=FLAGS.in_memory
+        )
+        generator = BestOfNGenerator(
+            t5_model=t5_model,
+            t5_model_ckpt_steps=ckpt_steps,
+            N=FLAGS.N,
+            sampling_keep_top_p=0.95,
+            samples_per_example=FLAGS.samples_per_example,
+            tmp_dir=FLAGS.tmp_dir,
+            in_memory=FLAGS.in_memory
+        )
+        run.run(
+            lambda inputs_path, outputs_path: generator.generate_N(
+                inputs_path, outputs_path, output_format=FLAGS.output_format
+            ),
+            worker_index=FLAGS.worker_index,
+            num_workers=FLAGS.num_workers
+        )
+    run.merge(FLAGS.output_path)
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -1,8 +1,12 @@
 import sys
 
 from absl import flags
+import numpy as np
 import tensorflow as tf
 
+from best_of_n.generation_store import GenerationStore, sample_store
+from best_of_n.subsample import SubsampleMasks, best_of_n_sweep
+
 def _define_flags():
     flags.DEFINE_string(
         name="input_path",
@@ -24,8 +28,44 @@ def _define_flags():
         default=None,
         help="The number of generations per question in the output file"
     )
+    flags.DEFINE_integer(
+        name="seed",
+        default=None,
+        help="Sample n random generations per question with this seed, instead "
+            "of the first n"
+    )
+    flags.DEFINE_list(
+        name="n_values",
+        default=None,
+        help="Comma-separated list of integers. With --format=store, write the "
+            "nested random subsamples for all these n (with --seed, 0 by "
+            "default) to output_path as masks over the input store, instead "
+            "of copying generations. If the store has scores, also print the "
+            "mean best-of-n score for every n"
+    )
+    flags.DEFINE_enum(
+        name="format",
+        default="tsv",
+        enum_values=["tsv", "store"],
+        help="Whether input and output are question<TAB>answer text files or "
+            "generation stores (see best_of_n/generation_store.py). N is not "
+            "needed for stores"
+    )
     return flags.FLAGS
 
+def _write_masks(FLAGS):
+    n_values = [int(n) for n in FLAGS.n_values]
+    seed = 0 if FLAGS.seed is None else FLAGS.seed
+    with GenerationStore(FLAGS.input_path) as store:
+        masks = SubsampleMasks.from_store(store, n_values, seed)
+        masks.save(FLAGS.output_path)
+        if store.scores is None:
+            return
+        best_idxs = best_of_n_sweep(store.scores, store.question_answer_offsets, masks)
+        for n, question_best_idxs in best_idxs.items():
+            best_scores = store.scores[question_best_idxs[question_best_idxs >= 0]]
+            print(f"n={n}\tmean best score={np.nanmean(best_scores):.4f}")
+
 if __name__ == "__main__":
     """
     Sample n <= N text generations per question from an input file with N
@@ -33,18 +73,33 @@ if __name__ == "__main__":
     """
     FLAGS = _define_flags()
     FLAGS(sys.argv)
+    if FLAGS.format == "store":
+        if FLAGS.n_values is not None:
+            _write_masks(FLAGS)
+        else:
+            sample_store(FLAGS.input_path, FLAGS.output_path, FLAGS.n, FLAGS.seed)
+        sys.exit(0)
     assert FLAGS.n <= FLAGS.N, "n > N"
+    # With a seed, draws the same random keys, in the same order, as
+    # best_of_n.subsample.subsample_ranks, so a text file and a store of the
+    # same generations get the same subsamples
+    rng = None if FLAGS.seed is None else np.random.RandomState(FLAGS.seed)
     with tf.io.gfile.GFile(FLAGS.input_path, "r") as input_file, \
          tf.io.gfile.GFile(FLAGS.output_path, "w") as output_file:
-        gens_written = 0
-        gens_seen = 0
+        question_lines = []
         for input_line in input_file:
-            if gens_written < FLAGS.n:
-                output_file.write(input_line)
-                gens_written += 1
-            gens_seen += 1
-            if gens_seen >= FLAGS.N:
-                gens_seen = 0
-                gens_written = 0
-
-            
+            question_lines.append(input_line)
+            if len(question_lines) < FLAGS.N:
+                continue
+            if rng is None:
+                output_file.write("".join(question_lines[:FLAGS.n]))
+            else:
+                ranks = np.argsort(np.argsort(rng.random_sample(FLAGS.N), kind="stable"), kind="stable")
+                output_file.write("".join(
+                    line for line, rank in zip(question_lines, ranks) if rank < FLAGS.n
+                ))
+            question_lines = []
+        # The original version wrote the first n lines of a last, incomplete
+        # question too
+        if question_lines and rng is None:
+            output_file.write("".join(question_lines[:FLAGS.n]))
@@ -0,0 +1,45 @@
+import os
+import uuid
+
+import tensorflow as tf
+
+class ScratchNamespace():
+    """
+    A private directory under base_dir for the temporary files of one job, so
+    that concurrent jobs sharing base_dir never overwrite each other's files.
+    The directory and everything in it is removed when the job is done.
+
+    Usage:
+        with ScratchNamespace(base_dir) as scratch:
+            inputs_path = scratch.path("inputs.txt")
+            ...
+    """
+    def __init__(self, base_dir, prefix="job", keep_on_error=False):
+        """
+        Args:
+        base_dir: str
+            Local or GCS directory shared by all jobs
+        prefix: str
+            Prefix of the job directory name, e.g. the kind of job
+        keep_on_error: bool
+            Don't remove the job directory if the job raises, for debugging
+        """
+        self.job_id = f"{prefix}-{uuid.uuid4().hex}"
+        self.dir = os.path.join(base_dir, self.job_id)
+        self.keep_on_error = keep_on_error
+
+    def __enter__(self):
+        tf.io.gfile.makedirs(self.dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or not self.keep_on_error:
+            self.cleanup()
+
+    def path(self, name):
+        """Path of a file called name inside this namespace"""
+        return os.path.join(self.dir, name)
+
+    def cleanup(self):
+        if tf.io.gfile.exists(self.dir):
+            tf.io.gfile.rmtree(self.dir)
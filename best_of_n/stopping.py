@@ -0,0 +1,79 @@
+import numpy as np
+
+class StoppingRule():
+    """
+    Decides, after each round of adaptive best-of-N, whether a question has
+    enough samples. Subclasses implement should_stop.
+    """
+    def __init__(self, min_samples=8):
+        """
+        Args:
+        min_samples: int
+            Never stop before a question has this many samples
+        """
+        self.min_samples = min_samples
+
+    def __call__(self, scores, n_new):
+        """
+        Args:
+        scores: np.array
+            Rewards of all the samples of a question so far, in sampling order
+        n_new: int
+            How many of them (at the end of scores) were drawn in the last round
+
+        Returns:
+        stop: bool
+        """
+        if len(scores) < self.min_samples:
+            return False
+        return self.should_stop(np.asarray(scores, dtype=np.float64), n_new)
+
+    def should_stop(self, scores, n_new):
+        raise NotImplementedError
+
+    def __repr__(self):
+        params = ",".join(f"{k}={v}" for k, v in sorted(vars(self).items()))
+        return f"{type(self).__name__}({params})"
+
+class MarginRule(StoppingRule):
+    """Stop once the top score beats the runner-up by at least margin"""
+    def __init__(self, margin, min_samples=8):
+        super().__init__(min_samples)
+        self.margin = margin
+
+    def should_stop(self, scores, n_new):
+        # There is no runner-up yet, e.g. with min_samples < 2
+        if len(scores) < 2:
+            return False
+        runner_up, top = np.partition(scores, -2)[-2:]
+        return top - runner_up >= self.margin
+
+class QuantilePlateauRule(StoppingRule):
+    """
+    Stop once the last round raised the q-th quantile of the scores by less
+    than tolerance, i.e. new samples have stopped improving the good tail
+    """
+    def __init__(self, q=0.9, tolerance=0.0, min_samples=8):
+        super().__init__(min_samples)
+        self.q = q
+        self.tolerance = tolerance
+
+    def should_stop(self, scores, n_new):
+        previous_scores = scores[:len(scores) - n_new]
+        if len(previous_scores) == 0:
+            return False
+        improvement = np.quantile(scores, self.q) \
+            - np.quantile(previous_scores, self.q)
+        return improvement <= self.tolerance
+
+class AnyRule(StoppingRule):
+    """Stop as soon as any of rules does"""
+    def __init__(self, *rules):
+        super().__init__(min_samples=0)
+        self.rules = rules
+
+    def should_stop(self, scores, n_new):
+        return any(rule(scores, n_new) for rule in self.rules)
+
+    def __repr__(self):
+        return f"AnyRule({','.join(repr(rule) for rule in self.rules)})"
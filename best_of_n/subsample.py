@@ -0,0 +1,121 @@
+"""
+Nested random subsamples of the answers in a generation store, for sweeps over
+n in best-of-n without copying any text.
+
+Every answer gets a random rank among the answers to its question. The answers
+with rank < n are a uniformly random subsample of n answers, and the subsample
+for n is contained in the one for every larger n, so one set of ranks encodes
+the masks for all n.
+"""
+import io
+
+import numpy as np
+import tensorflow as tf
+
+def subsample_ranks(n_answers_per_question, seed):
+    """
+    Args:
+    n_answers_per_question: np.array
+        Number of answers to every question, with answers grouped by question
+        (e.g. GenerationStore.n_answers_per_question())
+    seed: int
+
+    Returns:
+    ranks: np.array
+        int32 array with the random rank of every answer among the answers to
+        its question
+    """
+    counts = np.asarray(n_answers_per_question, dtype=np.int64)
+    question_idxs = np.repeat(np.arange(len(counts)), counts)
+    keys = np.random.RandomState(seed).random_sample(len(question_idxs))
+    order = np.lexsort((keys, question_idxs))
+    group_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    ranks = np.empty(len(order), dtype=np.int32)
+    ranks[order] = np.arange(len(order)) - group_starts
+    return ranks
+
+class SubsampleMasks():
+    """
+    Nested subsamples of the answers of a generation store, for several n
+    """
+    def __init__(self, ranks, n_values, seed):
+        """
+        Args:
+        ranks: np.array
+            See subsample_ranks
+        n_values: [int]
+            Subsample sizes of interest
+        seed: int
+            Seed the ranks were drawn with
+        """
+        self.ranks = np.asarray(ranks, dtype=np.int32)
+        self.n_values = sorted(int(n) for n in n_values)
+        self.seed = seed
+
+    @classmethod
+    def from_store(cls, store, n_values, seed):
+        """
+        Args:
+        store: best_of_n.generation_store.GenerationStore
+        """
+        return cls(subsample_ranks(store.n_answers_per_question(), seed), n_values, seed)
+
+    @classmethod
+    def load(cls, path):
+        with tf.io.gfile.GFile(path, "rb") as f:
+            arrays = np.load(io.BytesIO(f.read()))
+            return cls(arrays["ranks"], arrays["n_values"].tolist(), int(arrays["seed"]))
+
+    def save(self, path):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            ranks=self.ranks,
+            n_values=np.array(self.n_values, dtype=np.int64),
+            seed=np.array(self.seed, dtype=np.int64)
+        )
+        with tf.io.gfile.GFile(path, "wb") as f:
+            f.write(buffer.getvalue())
+
+    def mask(self, n):
+        """
+        Returns:
+        mask: np.array
+            bool array, True for the answers in the subsample of n answers per
+            question (all of them for questions with fewer answers)
+        """
+        return self.ranks < n
+
+def best_of_n_sweep(scores, question_answer_offsets, masks):
+    """
+    Pick the best answer to every question within each subsample, from a single
+    read of the scores
+
+    Args:
+    scores: np.array
+        float array with the score of every answer (e.g.
+        GenerationStore.scores). NaN scores are never picked
+    question_answer_offsets: np.array
+        See GenerationStore.question_answer_offsets
+    masks: SubsampleMasks
+
+    Returns:
+    best_idxs: {int: np.array}
+        For every n in masks.n_values, the row of the best answer to every
+        question among its subsample of n answers, or -1 for questions without
+        answers
+    """
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    counts = np.diff(question_answer_offsets)
+    question_idxs = np.repeat(np.arange(len(counts)), counts)
+    starts = question_answer_offsets[:-1]
+    best_idxs = {}
+    for n in masks.n_values:
+        masked_scores = np.where(masks.mask(n), scores, -np.inf)
+        # By question, then by decreasing score, then by rank, so that the
+        # first row of every question is its best subsampled answer
+        order = np.lexsort((masks.ranks, -masked_scores, question_idxs))
+        best = np.full(len(counts), -1, dtype=np.int64)
+        best[counts > 0] = order[starts[counts > 0]]
+        best_idxs[n] = best
+    return best_idxs
@@ -0,0 +1,83 @@
+"""Tests for best_of_n.subsample"""
+import numpy as np
+
+from best_of_n.generation_store import GenerationStore, GenerationStoreWriter, \
+    sample_store
+from best_of_n.subsample import SubsampleMasks, subsample_ranks, best_of_n_sweep
+
+N_ANSWERS = np.array([5, 0, 1, 8, 3, 8])
+OFFSETS = np.concatenate([[0], np.cumsum(N_ANSWERS)])
+
+def test_ranks_are_a_permutation_within_every_question():
+    ranks = subsample_ranks(N_ANSWERS, seed=0)
+    assert ranks.dtype == np.int32
+    for start, stop in zip(OFFSETS[:-1], OFFSETS[1:]):
+        assert sorted(ranks[start:stop]) == list(range(stop - start))
+
+def test_ranks_depend_only_on_the_seed():
+    np.testing.assert_array_equal(
+        subsample_ranks(N_ANSWERS, seed=3), subsample_ranks(N_ANSWERS, seed=3)
+    )
+    assert not np.array_equal(
+        subsample_ranks(N_ANSWERS, seed=3), subsample_ranks(N_ANSWERS, seed=4)
+    )
+
+def test_subsamples_are_nested():
+    for seed in range(20):
+        masks = SubsampleMasks(subsample_ranks(N_ANSWERS, seed), [1, 2, 4, 8], seed)
+        previous = np.zeros(OFFSETS[-1], dtype=bool)
+        for n in range(9):
+            mask = masks.mask(n)
+            assert not np.any(previous & ~mask), f"mask({n}) misses answers of mask({n - 1})"
+            sizes = [mask[start:stop].sum() for start, stop in zip(OFFSETS[:-1], OFFSETS[1:])]
+            assert sizes == [min(n, count) for count in N_ANSWERS]
+            previous = mask
+
+def test_save_and_load(tmp_path):
+    masks = SubsampleMasks(subsample_ranks(N_ANSWERS, seed=7), [4, 1, 2], seed=7)
+    masks.save(str(tmp_path / "masks.npz"))
+    loaded = SubsampleMasks.load(str(tmp_path / "masks.npz"))
+    np.testing.assert_array_equal(loaded.ranks, masks.ranks)
+    assert loaded.n_values == [1, 2, 4]
+    assert loaded.seed == 7
+
+def test_sweep_picks_the_best_answer_of_every_subsample():
+    rng = np.random.RandomState(0)
+    scores = rng.random_sample(OFFSETS[-1]).astype(np.float32)
+    scores[OFFSETS[3]] = np.nan
+    masks = SubsampleMasks(subsample_ranks(N_ANSWERS, seed=1), [1, 3, 8], seed=1)
+    best_idxs = best_of_n_sweep(scores, OFFSETS, masks)
+    for n in masks.n_values:
+        mask = masks.mask(n)
+        for question_id, (start, stop) in enumerate(zip(OFFSETS[:-1], OFFSETS[1:])):
+            rows = [
+                row for row in range(start, stop)
+                if mask[row] and not np.isnan(scores[row])
+            ]
+            best = best_idxs[n][question_id]
+            if start == stop:
+                assert best == -1
+            elif rows:
+                assert best == max(rows, key=lambda row: scores[row])
+
+def test_sample_store_keeps_the_answers_of_the_mask(tmp_path):
+    # sample_store needs n answers to every question
+    n_answers = N_ANSWERS[N_ANSWERS >= 2]
+    answers = [[f"answer {q}.{i}" for i in range(count)] for q, count in enumerate(n_answers)]
+    with GenerationStoreWriter(str(tmp_path / "store"), with_scores=True) as writer:
+        for question_id, question_answers in enumerate(answers):
+            writer.add(
+                f"question {question_id}",
+                question_answers,
+                [float(i) for i in range(len(question_answers))]
+            )
+    sample_store(str(tmp_path / "store"), str(tmp_path / "sample"), 2, seed=5)
+    mask = SubsampleMasks(subsample_ranks(n_answers, 5), [2], 5).mask(2)
+    flat_answers = [answer for question_answers in answers for answer in question_answers]
+    flat_scores = np.concatenate([np.arange(count) for count in n_answers])
+    with GenerationStore(str(tmp_path / "sample")) as sample:
+        assert [
+            answer for _, _, question_answers in sample.iter_questions()
+            for answer in question_answers
+        ] == [answer for answer, kept in zip(flat_answers, mask) if kept]
+        np.testing.assert_array_equal(sample.scores, flat_scores[mask])
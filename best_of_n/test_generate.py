@@ -59,11 +59,36 @@ def _define_flags():
         default=1,
         help="Batch size. Spillover samples are ignored"
     )
+    flags.DEFINE_integer(
+        name="pipeline_chunk_size",
+        default=None,
+        help="Score chunks of this many questions while the next ones are "
+            "sampled. By default, all questions are sampled before scoring"
+    )
+    flags.DEFINE_integer(
+        name="reward_group_size",
+        default=None,
+        help="Score up to this many answers to the same question together, "
+            "encoding the question only once"
+    )
     flags.DEFINE_string(
         name="tmp_dir",
         default=None,
         help="Temporary dir for internal use of BestOfNGenerator"
     )
+    flags.DEFINE_boolean(
+        name="in_memory",
+        default=False,
+        help="Predict from strings, keeping checkpoints in memory, instead of "
+            "through files in tmp_dir. Experimental on TPUs, and needs a "
+            "reward_tpu"
+    )
+    flags.DEFINE_string(
+        name="reward_tpu",
+        default=None,
+        help="TPU for the reward model, if not this machine's. With "
+            "in_memory, each model needs a TPU of its own"
+    )
     return flags.FLAGS
 
 def main(_):
@@ -81,7 +106,8 @@ def main(_):
         model_parallelism=FLAGS.model_parallelism,
         batch_size=FLAGS.batch_size,
         sequence_length={"inputs": 1280, "targets": 512},
-        iterations_per_loop=FLAGS.iterations_per_loop
+        iterations_per_loop=FLAGS.iterations_per_loop,
+        predict_queue_feed=FLAGS.in_memory
     )
     # Initialize reward model
     if FLAGS.t5_checkpoint_steps == -1:
@@ -90,12 +116,14 @@ def main(_):
         reward_ckpt_steps = FLAGS.reward_checkpoint_steps
     reward_model = ComparativeRewardModel(
         model_dir=FLAGS.reward_model_dir,
-        tpu=os.uname()[1],
+        tpu=FLAGS.reward_tpu or os.uname()[1],
         tpu_topology='2x2', # Must be this for validation
         model_parallelism=FLAGS.model_parallelism,
         batch_size=FLAGS.batch_size,
         sequence_length={"inputs": 1280, "targets": 512},
-        iterations_per_loop=FLAGS.iterations_per_loop
+        iterations_per_loop=FLAGS.iterations_per_loop,
+        group_size=FLAGS.reward_group_size,
+        predict_queue_feed=FLAGS.in_memory
     )
     # Generate answers
     generator = BestOfNGenerator(
@@ -105,7 +133,9 @@ def main(_):
         reward_model_ckpt_steps=reward_ckpt_steps,
         N=FLAGS.N,
         sampling_keep_top_p=0.94,
-        tmp_dir=FLAGS.tmp_dir
+        pipeline_chunk_size=FLAGS.pipeline_chunk_size,
+        tmp_dir=FLAGS.tmp_dir,
+        in_memory=FLAGS.in_memory
     )
     generator.generate(FLAGS.input_path, FLAGS.output_path)
 
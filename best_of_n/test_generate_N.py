@@ -43,6 +43,20 @@ def _define_flags():
         default=1,
         help="Batch size. Spillover samples are ignored"
     )
+    flags.DEFINE_integer(
+        name="samples_per_example",
+        default=None,
+        help="If given, samples decoded per encoding of a question. Needs "
+            "in_memory. By default, every question is repeated and encoded "
+            "once per sample"
+    )
+    flags.DEFINE_enum(
+        name="output_format",
+        default="tsv",
+        enum_values=["tsv", "store"],
+        help="Write a question<TAB>answer text file, or a generation store "
+            "directory (see best_of_n/generation_store.py)"
+    )
     flags.DEFINE_integer(
         name="checkpoint_steps",
         default=-1,
@@ -53,6 +67,12 @@ def _define_flags():
         default=None,
         help="Temporary dir for internal use of BestOfNGenerator"
     )
+    flags.DEFINE_boolean(
+        name="in_memory",
+        default=False,
+        help="Predict from strings, keeping checkpoints in memory, instead of "
+            "through files in tmp_dir. Experimental on TPUs"
+    )
     return flags.FLAGS
 
 def main(_):
@@ -70,15 +90,20 @@ def main(_):
         batch_size=FLAGS.batch_size,
         sequence_length={"inputs": 1280, "targets": 512},
         iterations_per_loop=FLAGS.iterations_per_loop,
+        predict_queue_feed=FLAGS.in_memory
     )
     generator = BestOfNGenerator(
         t5_model=t5_model,
         t5_model_ckpt_steps=ckpt_steps,
         N=FLAGS.N,
         sampling_keep_top_p=0.95,
-        tmp_dir=FLAGS.tmp_dir
+        samples_per_example=FLAGS.samples_per_example,
+        tmp_dir=FLAGS.tmp_dir,
+        in_memory=FLAGS.in_memory
+    )
+    generator.generate_N(
+        FLAGS.input_path, FLAGS.output_path, output_format=FLAGS.output_format
     )
-    generator.generate_N(FLAGS.input_path, FLAGS.output_path)
 
 if __name__ == "__main__":
     tf.app.run()
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""
+Benchmark the BPE engine of data/encoder.py against the original GPT-2 implementation on Reddit selftexts, and check
+that both give exactly the same tokens.
+
+python data/benchmark_bpe.py -input redditadvice.jsonl -num_posts 5000
+"""
+
+import argparse
+import json
+import sys
+import time
+
+sys.path.append('../')
+from data.encoder import get_encoder, get_pairs, clean_reddit_text
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-input', type=str, required=True, help='jsonl file with a selftext (or body) field per line')
+parser.add_argument('-num_posts', type=int, default=5000, help='Number of posts to encode')
+parser.add_argument('-cache_size', type=int, default=2 ** 16, help='Token cache size of the new engine')
+args = parser.parse_args()
+
+
+def reference_bpe(encoder, token):
+    """ The original Encoder.bpe, without its cache """
+    word = tuple(token)
+    pairs = get_pairs(word)
+
+    if not pairs:
+        return token
+
+    while True:
+        bigram = min(pairs, key=lambda pair: encoder.bpe_ranks.get(pair, float('inf')))
+        if bigram not in encoder.bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        new_word = tuple(new_word)
+        word = new_word
+        if len(word) == 1:
+            break
+        else:
+            pairs = get_pairs(word)
+    return ' '.join(word)
+
+
+def byte_tokens(encoder, text):
+    return [''.join(encoder.byte_encoder[b] for b in token.encode('utf-8')) for token in encoder.pat.findall(text)]
+
+
+texts = []
+with open(args.input, 'r') as f:
+    for l in f:
+        item = json.loads(l)
+        text = item.get('selftext', item.get('body', ''))
+        if text:
+            texts.append(clean_reddit_text(text))
+        if len(texts) >= args.num_posts:
+            break
+tokens = [byte_tokens(get_encoder(), text) for text in texts]
+n_tokens = sum(len(x) for x in tokens)
+print("{} posts, {} pre-tokens, {} distinct".format(len(texts), n_tokens, len({t for x in tokens for t in x})),
+      flush=True)
+
+# Both engines with a cache that starts empty, like a fresh process. The reference one gets an unbounded dict.
+reference_encoder = get_encoder()
+reference_cache = {}
+start = time.time()
+reference_words = []
+for post_tokens in tokens:
+    for token in post_tokens:
+        if token not in reference_cache:
+            reference_cache[token] = reference_bpe(reference_encoder, token)
+        reference_words.append(reference_cache[token])
+reference_secs = time.time() - start
+
+encoder = get_encoder()
+encoder.cache.max_size = args.cache_size
+start = time.time()
+words = [encoder.bpe(token) for post_tokens in tokens for token in post_tokens]
+secs = time.time() - start
+
+# Without any cache, i.e. the cost of the merges alone
+distinct_tokens = sorted({t for x in tokens for t in x})
+start = time.time()
+for token in distinct_tokens:
+    reference_bpe(reference_encoder, token)
+reference_uncached_secs = time.time() - start
+start = time.time()
+for token in distinct_tokens:
+    if len(token) > 1:
+        encoder._merge(token)
+uncached_secs = time.time() - start
+
+n_mismatches = sum(a != b for a, b in zip(reference_words, words))
+print("Mismatched tokens: {}".format(n_mismatches))
+print("Cached:   reference {:.2f}s ({:.0f} tokens/s), new {:.2f}s ({:.0f} tokens/s)".format(
+    reference_secs, n_tokens / reference_secs, secs, n_tokens / secs))
+print("Uncached: reference {:.2f}s, new {:.2f}s over {} distinct tokens".format(
+    reference_uncached_secs, uncached_secs, len(distinct_tokens)))
+print("Cache: {}".format(encoder.cache.stats()))
+
+# Longest tokens, where the quadratic behaviour of the reference shows
+long_tokens = sorted(distinct_tokens, key=len)[-100:]
+start = time.time()
+for token in long_tokens:
+    reference_bpe(reference_encoder, token)
+reference_long_secs = time.time() - start
+start = time.time()
+for token in long_tokens:
+    encoder._merge(token)
+long_secs = time.time() - start
+print("Longest 100 tokens (up to {} chars): reference {:.3f}s, new {:.3f}s".format(
+    len(long_tokens[-1]), reference_long_secs, long_secs))
+sys.exit(1 if n_mismatches else 0)
@@ -0,0 +1,97 @@
+"""
+Benchmark clean_reddit_text and _fix_reddit_text against their original implementations on Reddit posts and
+comments, and check that both give exactly the same text.
+
+python data/benchmark_cleaning.py -input redditadvice.jsonl -num_texts 20000
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import regex as re
+
+sys.path.append('../')
+from data.encoder import clean_reddit_text, clean_reddit_texts, escape_html
+from data.to_tfrecord_t5 import FAST_UNIDECODE, _fix_reddit_text, _fix_reddit_texts
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-input', type=str, required=True,
+                    help='jsonl file with selftext, body or good_comments fields (e.g. from create_redditadvice_2019.py)')
+parser.add_argument('-num_texts', type=int, default=20000, help='Number of texts to clean')
+args = parser.parse_args()
+
+
+def reference_clean_reddit_text(text):
+    """ The original clean_reddit_text """
+    text = ''.join(c for c in text if c.isprintable() or c in '\n\t').replace('\t', ' ')
+
+    prev_len = len(text) + 1
+    while len(text) < prev_len:
+        prev_len = len(text)
+        text_strip = text.strip()
+        text = re.sub(r'\n[\W ]*(edit|update).+$', '', text_strip, flags=re.IGNORECASE)
+        text = re.sub(r'^[\W ]*(edit|update)[\W\d\n ]*.+\n\n', '', text, flags=re.IGNORECASE)
+        text = re.sub(r'^[\W\n ]*\n+', '', text)
+
+    text = re.sub(r'\n[\W ]*(edit|update).*$', '', text, flags=re.IGNORECASE | re.DOTALL)
+    text2 = re.sub(r'\&[^\s]+;', escape_html, text)
+    text3 = re.sub(r'[\s\n]+\n', '\n\n', text2, flags=re.MULTILINE)
+    text3 = re.sub(r'\. +', '. ', text3)
+    return text3.strip()
+
+
+def reference_fix_reddit_text(x):
+    """ The original _fix_reddit_text """
+    x1 = x.translate(FAST_UNIDECODE)
+    x3 = re.sub(r'[\s\n]*\n\n[\s\n]*', ' » ', x1, flags=re.MULTILINE)
+    x4 = re.sub(r'[\s\n]*\n[\s\n]*', ' ', x3, flags=re.MULTILINE)
+    x4 = re.sub(r'\s+', ' ', x4)
+    return x4
+
+
+def timed(fn, *fn_args):
+    start = time.time()
+    result = fn(*fn_args)
+    return result, time.time() - start
+
+
+texts = []
+with open(args.input, 'r') as f:
+    for l in f:
+        item = json.loads(l)
+        for field in ('title', 'selftext', 'body'):
+            if item.get(field):
+                texts.append(item[field])
+        texts.extend(c['body'] for c in item.get('good_comments', []) if c.get('body'))
+        if len(texts) >= args.num_texts:
+            break
+texts = texts[:args.num_texts]
+n_chars = sum(len(x) for x in texts)
+print("{} texts, {:.1f}M characters".format(len(texts), n_chars / 1e6), flush=True)
+
+# Build the lazily loaded tables outside of the timings
+clean_reddit_text('warm up')
+_fix_reddit_text('warm up')
+
+reference_cleaned, reference_secs = timed(lambda: [reference_clean_reddit_text(x) for x in texts])
+cleaned, secs = timed(lambda: [clean_reddit_text(x) for x in texts])
+batch_cleaned, batch_secs = timed(clean_reddit_texts, texts)
+n_clean_mismatches = sum(a != b for a, b in zip(reference_cleaned, cleaned))
+n_clean_mismatches += sum(a != b for a, b in zip(reference_cleaned, batch_cleaned))
+print("clean_reddit_text: {} mismatches. reference {:.2f}s ({:.1f}M chars/s), new {:.2f}s ({:.1f}M chars/s), "
+      "batch {:.2f}s".format(n_clean_mismatches, reference_secs, n_chars / reference_secs / 1e6, secs,
+                             n_chars / secs / 1e6, batch_secs), flush=True)
+
+reference_fixed, reference_secs = timed(lambda: [reference_fix_reddit_text(x) for x in reference_cleaned])
+fixed, secs = timed(lambda: [_fix_reddit_text(x) for x in reference_cleaned])
+# In groups of 6, like the fields of an answer pair
+batch_fixed, batch_secs = timed(
+    lambda: [y for i in range(0, len(reference_cleaned), 6) for y in _fix_reddit_texts(reference_cleaned[i:i + 6])])
+n_fix_mismatches = sum(a != b for a, b in zip(reference_fixed, fixed))
+n_fix_mismatches += sum(a != b for a, b in zip(reference_fixed, batch_fixed))
+print("_fix_reddit_text: {} mismatches. reference {:.2f}s ({:.1f}M chars/s), new {:.2f}s ({:.1f}M chars/s), "
+      "batch {:.2f}s".format(n_fix_mismatches, reference_secs, n_chars / reference_secs / 1e6, secs,
+                             n_chars / secs / 1e6, batch_secs), flush=True)
+sys.exit(1 if n_clean_mismatches or n_fix_mismatches else 0)
@@ -16,7 +16,8 @@ from collections import defaultdict, OrderedDict
 from tqdm import tqdm
 
 sys.path.append('../')
-from data.encoder import get_encoder, clean_reddit_text, tokenize_for_grover_advice_training
+from data.encoder import get_encoder, clean_reddit_text, tokenize_for_grover_advice_training, \
+    _tokenize_reddit_posts_pieces
 from data.tfrecord_utils import S3TFRecordWriter, int64_list_feature
 import mistune
 from datetime import datetime
@@ -135,11 +136,23 @@ training_examples = [x for x in training_examples if x is not None]
 # Could use datetime.utcfromtimestamp
 training_examples_sorted = sorted(training_examples, key=lambda x: -x['created_utc'])
 
-print("TOKENIZING AND TRIMMING", flush=True)
+print("TOKENIZING", flush=True)
+# Everything is tokenized upfront, in parallel. Posts and comments that are too short to be used aren't.
+with encoder.worker_pool() as pool:
+    post_pieces = _tokenize_reddit_posts_pieces(
+        encoder, [{'subreddit': x['subreddit'], 'date': datetime.utcfromtimestamp(x['created_utc']),
+                   'title': x['title'], 'selftext': x['selftext']} if len(x['selftext']) >= 64 else {}
+                  for x in training_examples_sorted], pool=pool)
+    comment_pieces = _tokenize_reddit_posts_pieces(
+        encoder, [{'body': comment['body']} if len(comment['body']) >= 64 else {}
+                  for x in training_examples_sorted for comment in x['good_comments']], pool=pool)
+
+print("TRIMMING", flush=True)
 num_test = 8192
 num_val = 8192
 num_entries = 0
-for x in tqdm(training_examples_sorted):
+comment_idx = 0
+for x_idx, x in enumerate(tqdm(training_examples_sorted)):
     if num_entries < num_test:
         x['split'] = 'test'
         budget = num_test - num_entries
@@ -159,7 +172,9 @@ for x in tqdm(training_examples_sorted):
             selftext=x['selftext'],
             title=x['title'],
             body=comment['body'],
-            desired_len=1536)
+            desired_len=1536,
+            pieces=dict(post_pieces[x_idx], **comment_pieces[comment_idx]))
+        comment_idx += 1
         if tokenized_comment is not None:
             x['tokens'].append(tokenized_comment)
     x['tokens'] = x['tokens'][:budget]
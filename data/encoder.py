@@ -5,18 +5,24 @@ Some functions are adapted from OpenAI but with modifications
 https://github.com/openai/gpt-2
 """
 
+import heapq
 import html
 import json
+import multiprocessing
 import os
 import random
 import sys
+import threading
 import unicodedata
+from collections import OrderedDict
 from datetime import datetime
 from functools import lru_cache
 
 import numpy as np
 import regex as re
 
+from data.table_cache import load_or_build
+
 
 @lru_cache()
 def bytes_to_unicode():
@@ -54,8 +60,67 @@ def get_pairs(word):
     return pairs
 
 
+class BPECache:
+    """
+    Size-bounded LRU cache from tokens to their BPE, with hit-rate stats. Safe to share between threads, e.g. the
+    request handlers of the Grover server.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: Number of tokens to keep. None for no limit
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            word = self._entries.get(token)
+            if word is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(token)
+            return word
+
+    def put(self, token, word):
+        with self._lock:
+            self._entries[token] = word
+            if self.max_size is not None and len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # Pickled, e.g. to send an encoder to spawned workers, as an empty cache
+        return {'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_size'])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=2 ** 16):
         self.encoder = {k: v + 1 for k, v in encoder.items()}
         self.encoder['<|padding|>'] = 0
         self.padding = 0
@@ -80,52 +145,79 @@ class Encoder:
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = BPECache(cache_size)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        self._space_pat = re.compile(r'\s')
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
+        if len(token) < 2:
             return token
-
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
+        word = self.cache.get(token)
+        if word is not None:
+            return word
+        word = ' '.join(self._merge(token))
+        self.cache.put(token, word)
         return word
 
+    def _merge(self, token):
+        """
+        Apply the BPE merges to a token, lowest rank first.
+
+        The symbols are a linked list (by position of their first character) and the candidate merges are a heap of
+        (rank, position), so each merge costs O(log n) rather than a pass over all pairs. As in the original GPT-2
+        implementation, all non-overlapping occurrences of the best pair are merged left to right before moving on to
+        the next pair, even if a merge creates a pair with a lower rank.
+
+        :param token: byte-encoded string with at least 2 characters
+        :return: list of symbols
+        """
+        bpe_ranks = self.bpe_ranks
+        symbols = list(token)
+        n = len(symbols)
+        next_idx = list(range(1, n + 1))
+        next_idx[-1] = -1
+        prev_idx = list(range(-1, n - 1))
+
+        heap = []
+        for i in range(n - 1):
+            rank = bpe_ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i = heapq.heappop(heap)
+            # Every occurrence of a pair has the same rank, and pops in order of position
+            positions = [i]
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+
+            merged = []
+            for i in positions:
+                j = next_idx[i]
+                # Skip stale candidates: merged away, or their pair changed since they were pushed
+                if symbols[i] is None or j == -1 or bpe_ranks.get((symbols[i], symbols[j])) != rank:
+                    continue
+                symbols[i] += symbols[j]
+                symbols[j] = None
+                next_idx[i] = next_idx[j]
+                if next_idx[j] != -1:
+                    prev_idx[next_idx[j]] = i
+                merged.append(i)
+
+            # Only the pairs around merged symbols are new
+            for i in merged:
+                for left, right in ((prev_idx[i], i), (i, next_idx[i])):
+                    if left == -1 or right == -1:
+                        continue
+                    new_rank = bpe_ranks.get((symbols[left], symbols[right]))
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, left))
+
+        return [symbol for symbol in symbols if symbol is not None]
+
     def encode(self, text):
         bpe_tokens = []
         for token in re.findall(self.pat, text):
@@ -133,11 +225,97 @@ class Encoder:
             bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
+    def encode_paragraphs(self, paragraphs, cache=None):
+        """
+        Same as encode('\n\n'.join(paragraphs)), but each paragraph is only tokenized once across calls with the
+        same cache, e.g. while deleting paragraphs from a long text.
+
+        When no paragraph break touches whitespace, the text splits into the same pretokens as its paragraphs, with
+        each break as two newline tokens in between. Otherwise the whole text is tokenized.
+
+        :param paragraphs: list of strings
+        :param cache: dict from paragraph to its tokens, filled here
+        :return: tokens
+        """
+        if len(paragraphs) > 1 and not all(
+                p and q and not self._space_pat.match(p[-1]) and not self._space_pat.match(q[0])
+                for p, q in zip(paragraphs[:-1], paragraphs[1:])):
+            return self.encode('\n\n'.join(paragraphs))
+        if cache is None:
+            cache = {}
+        newline = self.encoder[self.byte_encoder[ord('\n')]]
+        tokens = []
+        for i, paragraph in enumerate(paragraphs):
+            if paragraph not in cache:
+                cache[paragraph] = self.encode(paragraph)
+            if i > 0:
+                tokens.extend((newline, newline))
+            tokens.extend(cache[paragraph])
+        return tokens
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
         return text
 
+    def encode_batch(self, texts, pool=None, chunksize=64):
+        """
+        Tokenize many texts at once
+
+        :param texts: list of strings
+        :param pool: optional worker pool from worker_pool(), to tokenize chunks of texts in parallel
+        :param chunksize: texts per task sent to the pool
+        :return: tokens: int32 array with the tokens of all texts, one after the other
+                 offsets: int64 array of length len(texts) + 1, the tokens of texts[i] are tokens[offsets[i]:offsets[i+1]]
+        """
+        if pool is None:
+            chunks = [_encode_texts(texts, encoder=self)]
+        else:
+            chunks = pool.imap(_encode_texts, [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)])
+        token_chunks = []
+        length_chunks = []
+        for tokens, lengths in chunks:
+            token_chunks.append(tokens)
+            length_chunks.append(lengths)
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        if texts:
+            np.cumsum(np.concatenate(length_chunks), out=offsets[1:])
+        tokens = np.concatenate(token_chunks) if token_chunks else np.zeros(0, dtype=np.int32)
+        return tokens, offsets
+
+    def decode_batch(self, tokens, offsets, pool=None, chunksize=64):
+        """
+        Inverse of encode_batch
+
+        :param tokens: flat array of tokens
+        :param offsets: array of length num_texts + 1
+        :param pool: optional worker pool from worker_pool()
+        :param chunksize: texts per task sent to the pool
+        :return: list of num_texts strings
+        """
+        tokens = np.asarray(tokens)
+        offsets = np.asarray(offsets)
+        chunks = [tokens[offsets[i]:offsets[min(i + chunksize, len(offsets) - 1)]].tolist()
+                  for i in range(0, len(offsets) - 1, chunksize)]
+        chunk_offsets = [(offsets[i:i + chunksize + 1] - offsets[i]).tolist()
+                         for i in range(0, len(offsets) - 1, chunksize)]
+        if pool is None:
+            decoded = (_decode_texts(c, o, encoder=self) for c, o in zip(chunks, chunk_offsets))
+        else:
+            decoded = pool.imap(_decode_texts_star, zip(chunks, chunk_offsets))
+        return [text for texts in decoded for text in texts]
+
+    def worker_pool(self, num_workers=None):
+        """
+        A multiprocessing pool for encode_batch / decode_batch. Its workers use this encoder: forked workers share
+        the loaded vocab and merges table with this process rather than loading their own copy. Use it as a context
+        manager so that the workers are shut down afterwards.
+
+        :param num_workers: defaults to the number of CPUs
+        :return: multiprocessing.Pool
+        """
+        return multiprocessing.Pool(num_workers, initializer=_init_encoder_worker, initargs=(self,))
+
     def __len__(self):
         return len(self.encoder)
 
@@ -147,6 +325,37 @@ class Encoder:
         return [(self.decoder[i].startswith('<|') and self.decoder[i].endswith('|>')) for i in range(len(self))]
 
 
+# The encoder of a worker_pool() worker
+_worker_encoder = None
+
+
+def _init_encoder_worker(encoder):
+    global _worker_encoder
+    # Don't inherit the cache (and the state of its lock) of the parent
+    encoder.cache = BPECache(encoder.cache.max_size)
+    _worker_encoder = encoder
+
+
+def _encode_texts(texts, encoder=None):
+    encoder = _worker_encoder if encoder is None else encoder
+    tokens = []
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        text_tokens = encoder.encode(text)
+        tokens.extend(text_tokens)
+        lengths[i] = len(text_tokens)
+    return np.array(tokens, dtype=np.int32), lengths
+
+
+def _decode_texts(tokens, offsets, encoder=None):
+    encoder = _worker_encoder if encoder is None else encoder
+    return [encoder.decode(tokens[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+
+
+def _decode_texts_star(args):
+    return _decode_texts(*args)
+
+
 def get_encoder():
     directory_name = os.path.dirname(__file__)
     with open(os.path.join(directory_name, 'encoder.json'), 'r') as f:
@@ -339,18 +548,95 @@ def _is_control(char):
     return False
 
 
-all_chars = [chr(i) for i in range(sys.maxunicode)]
-CONTROL_CHARACTERS = ''.join(c for c in all_chars if _is_control(c))
-sub_dict = {k: None for k in CONTROL_CHARACTERS}
-sub_dict['\t'] = ' '
-CLEAN_TABLE = str.maketrans(sub_dict)
+# Bump when _is_control changes, to rebuild the cached CONTROL_CHARACTERS
+CONTROL_CHARACTERS_VERSION = 1
+
+
+@lru_cache()
+def _control_characters():
+    """ All control characters. Scanning every code point is slow, so this is cached on disk, see data/table_cache.py"""
+    ranges = load_or_build(
+        'control_characters',
+        {'version': CONTROL_CHARACTERS_VERSION, 'unidata_version': unicodedata.unidata_version,
+         'maxunicode': sys.maxunicode},
+        _build_control_character_ranges)
+    return ''.join(''.join(map(chr, range(start, end))) for start, end in ranges)
+
+
+def _build_control_character_ranges():
+    """ [start, end) code point ranges of the control characters, as most of them are consecutive"""
+    ranges = []
+    for i in range(sys.maxunicode):
+        if _is_control(chr(i)):
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([i, i + 1])
+    return ranges
+
+
+@lru_cache()
+def _clean_table():
+    sub_dict = {k: None for k in _control_characters()}
+    sub_dict['\t'] = ' '
+    return str.maketrans(sub_dict)
+
+
+def __getattr__(name):
+    """ CONTROL_CHARACTERS and CLEAN_TABLE are only built on first use, so that importing this module is fast"""
+    if name == 'CONTROL_CHARACTERS':
+        return _control_characters()
+    if name == 'CLEAN_TABLE':
+        return _clean_table()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+# Bump when the characters that clean_reddit_text removes change, to rebuild the cached table
+NONPRINTABLE_TABLE_VERSION = 1
+
+_AMP_RE = re.compile(r'amp;(amp;)+')
+_HTML_ENTITY_RE = re.compile(r'\&[^\s]+;')
+_EDIT_WORD_RE = re.compile(r'edit|update', flags=re.IGNORECASE)
+_EDIT_SUFFIX_RE = re.compile(r'\n[\W ]*(edit|update).+$', flags=re.IGNORECASE)
+_EDIT_PREFIX_RE = re.compile(r'^[\W ]*(edit|update)[\W\d\n ]*.+\n\n', flags=re.IGNORECASE)
+_SPECIAL_PREFIX_RE = re.compile(r'^[\W\n ]*\n+')
+_EDIT_REST_RE = re.compile(r'\n[\W ]*(edit|update).*$', flags=re.IGNORECASE | re.DOTALL)
+_LAST_WORD_CHAR_RE = re.compile(r'(?r)\w')
+_NEWLINES_RE = re.compile(r'[\s\n]+\n', flags=re.MULTILINE)
+_PERIOD_SPACES_RE = re.compile(r'\. +')
+
+
+def _build_nonprintable_ranges():
+    """ [start, end) code point ranges of the characters that clean_reddit_text removes"""
+    ranges = []
+    for i in range(sys.maxunicode + 1):
+        c = chr(i)
+        if not c.isprintable() and c not in '\n\t':
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([i, i + 1])
+    return ranges
+
+
+@lru_cache()
+def _nonprintable_table():
+    """ Translation table removing the characters that aren't printable, except newlines, and replacing tabs"""
+    ranges = load_or_build(
+        'nonprintable',
+        {'version': NONPRINTABLE_TABLE_VERSION, 'unidata_version': unicodedata.unidata_version,
+         'maxunicode': sys.maxunicode},
+        _build_nonprintable_ranges)
+    table = dict.fromkeys(i for start, end in ranges for i in range(start, end))
+    table[ord('\t')] = ' '
+    return table
 
 
 def escape_html(match):
     """ Sometimes there's hidden HTML, we wanna get rid of that"""
     match_txt = match.group(0)
 
-    match_txt = re.sub(r'amp;(amp;)+', 'amp;', match_txt)
+    match_txt = _AMP_RE.sub('amp;', match_txt)
 
     # Keep in the > < overrides.
     common_cases = {
@@ -373,6 +659,41 @@ def escape_html(match):
     return html.unescape(match_txt)
 
 
+def _strip_edits(text, has_edit):
+    """
+    Strips the text, then removes an EDIT / UPDATE line at the end, an EDIT / UPDATE paragraph at the beginning and
+    lines with only special characters at the beginning, until none of these change the text anymore.
+
+    Every step only removes a prefix or a suffix of the text, so nothing is rescanned needlessly:
+     * Without the words edit or update anywhere in the text (has_edit), only the last step can match.
+     * An EDIT line at the end has to be the last line, with only special characters between it and the newline the
+       match starts at. The search for it starts after the last word character before the last line, rather than
+       at every newline of the text.
+    :param text:
+    :param has_edit: whether the words edit or update appear in the text
+    :return:
+    """
+    prev_len = len(text) + 1
+    while len(text) < prev_len:
+        prev_len = len(text)
+        text = text.strip()
+        if has_edit:
+            last_newline = text.rfind('\n')
+            if last_newline >= 0:
+                last_word_char = _LAST_WORD_CHAR_RE.search(text, 0, last_newline)
+                edit_match = _EDIT_SUFFIX_RE.search(text, 0 if last_word_char is None else last_word_char.end())
+                if edit_match is not None:
+                    text = text[:edit_match.start()]
+
+            # If EDIT is at the beginning, trim that. Sometimes people add newlines immediately after. In that case
+            # trim the next line
+            text = _EDIT_PREFIX_RE.sub('', text)
+
+        # Trim lines that only have special characters at the beginning
+        text = _SPECIAL_PREFIX_RE.sub('', text)
+    return text
+
+
 def clean_reddit_text(text):
     """
     Remove weird HTML things
@@ -383,38 +704,64 @@ def clean_reddit_text(text):
 
     # Remove these corner case chars
     # text = re.sub(r'[\u200b\ufeff]', '', text)
-    text = ''.join(c for c in text if c.isprintable() or c in '\n\t').replace('\t', ' ')
+    text = text.translate(_nonprintable_table())
     # Maybe could have done:
     # text = text.translate(CLEAN_TABLE)
 
-    # Remove 'EDIT' if it's at the end
-    prev_len = len(text) + 1
-    while len(text) < prev_len:
-        prev_len = len(text)
-        text_strip = text.strip()
-        text = re.sub(r'\n[\W ]*(edit|update).+$', '', text_strip, flags=re.IGNORECASE)
-
-        # If EDIT is at the beginning, trim that. Sometimes people add newlines immediately after. In that case
-        # trim the next line
-        text = re.sub(r'^[\W ]*(edit|update)[\W\d\n ]*.+\n\n', '', text, flags=re.IGNORECASE)
-
-        # Trim lines that only have special characters at the beginning
-        text = re.sub(r'^[\W\n ]*\n+', '', text)
+    # Remove 'EDIT' if it's at the end. Only removes a prefix and a suffix of the text, so if there's no edit or
+    # update in it now there won't be later either
+    has_edit = _EDIT_WORD_RE.search(text) is not None
+    text = _strip_edits(text, has_edit)
 
     # If edits are still in there, trim everything thereafter
-    text = re.sub(r'\n[\W ]*(edit|update).*$', '', text, flags=re.IGNORECASE | re.DOTALL)
+    if has_edit:
+        text = _EDIT_REST_RE.sub('', text)
 
     # Remove weird HTML characters
-    text2 = re.sub(r'\&[^\s]+;', escape_html, text)
+    text2 = _HTML_ENTITY_RE.sub(escape_html, text) if '&' in text else text
 
     # At most two \n's (also take out spaces before them)
-    text3 = re.sub(r'[\s\n]+\n', '\n\n', text2, flags=re.MULTILINE)
+    text3 = _NEWLINES_RE.sub('\n\n', text2) if '\n' in text2 else text2
 
     # Take out period then two spaces
-    text3 = re.sub(r'\. +', '. ', text3)
+    if '.  ' in text3:
+        text3 = _PERIOD_SPACES_RE.sub('. ', text3)
     return text3.strip()
 
 
+def clean_reddit_texts(texts, pool=None, chunksize=256):
+    """
+    clean_reddit_text for many texts
+
+    :param texts: list of selftexts or comment bodies
+    :param pool: optional multiprocessing pool, to clean chunks of texts in parallel
+    :param chunksize: texts per task sent to the pool
+    :return: list of cleaned texts
+    """
+    if pool is None:
+        return [clean_reddit_text(text) for text in texts]
+    return pool.map(clean_reddit_text, texts, chunksize=chunksize)
+
+
+# Field -> (begin token attribute, end token attribute), in the order of the pieces
+REDDIT_PIECE_TOKENS = OrderedDict([
+    ('date', ('begin_date', 'end_date')),
+    ('subreddit', ('begin_domain', 'end_domain')),
+    ('title', ('begin_title', 'end_title')),
+    ('selftext', ('begin_article', 'end_article')),
+    ('body', ('begin_summary', 'end_summary')),
+])
+
+
+def _reddit_date_text(date):
+    if not isinstance(date, datetime):
+        raise ValueError("Date must be a datetime obj. Provided {}".format(date))
+
+    return ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+            'August', 'September', 'October', 'November', 'December'][date.month - 1] + ' {}, {}'.format(
+        date.day, date.year)
+
+
 def _tokenize_reddit_post_pieces(encoder, subreddit=None, date=None, title=None, selftext=None, body=None,
                                  max_date_length=1536, max_subreddit_length=1536, max_title_length=1536,
                                  max_selftext_length=1536, max_body_length=1536):
@@ -433,31 +780,43 @@ def _tokenize_reddit_post_pieces(encoder, subreddit=None, date=None, title=None,
     :param max_body_length:   Defaults to a really HIGH length.
     :return: those fields, tokenized.
     """
-    article_pieces = {}
-    if date is not None:
-        if not isinstance(date, datetime):
-            raise ValueError("Date must be a datetime obj. Provided {}".format(date))
-
-        date_txt = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
-                    'August', 'September', 'October', 'November', 'December'][date.month - 1] + ' {}, {}'.format(
-            date.day, date.year)
-        article_pieces['date'] = [encoder.begin_date] + encoder.encode(date_txt)[:max_date_length] + [encoder.end_date]
-
-    if subreddit is not None:
-        article_pieces['subreddit'] = [encoder.begin_domain] + encoder.encode(subreddit)[:max_subreddit_length] + [
-            encoder.end_domain]
-
-    if title is not None:
-        article_pieces['title'] = [encoder.begin_title] + encoder.encode(title)[:max_title_length] + [encoder.end_title]
-
-    if selftext is not None:
-        article_pieces['selftext'] = [encoder.begin_article] + encoder.encode(selftext)[:max_selftext_length] + [
-            encoder.end_article]
-
-    if body is not None:
-        article_pieces['body'] = [encoder.begin_summary] + encoder.encode(body)[:max_body_length] + [
-            encoder.end_summary]
-    return article_pieces
+    return _tokenize_reddit_posts_pieces(
+        encoder, [{'subreddit': subreddit, 'date': date, 'title': title, 'selftext': selftext, 'body': body}],
+        max_lengths={'date': max_date_length, 'subreddit': max_subreddit_length, 'title': max_title_length,
+                     'selftext': max_selftext_length, 'body': max_body_length})[0]
+
+
+def _tokenize_reddit_posts_pieces(encoder, posts, max_lengths=None, pool=None):
+    """
+    Like _tokenize_reddit_post_pieces, for many posts with a single Encoder.encode_batch call
+
+    :param encoder:
+    :param posts: list of dicts with (some of) the fields subreddit, date, title, selftext, body. Fields that are
+                  missing or None are left out of the pieces
+    :param max_lengths: field -> max number of tokens. Defaults to 1536 for every field
+    :param pool: optional worker pool from encoder.worker_pool()
+    :return: the pieces of every post
+    """
+    texts = []
+    for post in posts:
+        for field in REDDIT_PIECE_TOKENS:
+            if post.get(field) is not None:
+                texts.append(_reddit_date_text(post[field]) if field == 'date' else post[field])
+    tokens, offsets = encoder.encode_batch(texts, pool=pool)
+
+    all_pieces = []
+    i = 0
+    for post in posts:
+        article_pieces = {}
+        for field, (begin_attr, end_attr) in REDDIT_PIECE_TOKENS.items():
+            if post.get(field) is None:
+                continue
+            max_length = 1536 if max_lengths is None else max_lengths.get(field, 1536)
+            field_tokens = tokens[offsets[i]:min(offsets[i + 1], offsets[i] + max_length)].tolist()
+            article_pieces[field] = [getattr(encoder, begin_attr)] + field_tokens + [getattr(encoder, end_attr)]
+            i += 1
+        all_pieces.append(article_pieces)
+    return all_pieces
 
 
 def trim_paragraphs(selftext, num2del=1):
@@ -479,8 +838,40 @@ def trim_paragraphs(selftext, num2del=1):
     return selftext.strip()
 
 
+def trim_paragraphs_to_length(text, desired_len, count_tokens, separator_len=0, max_error_per_paragraph=1):
+    """
+    Trims a long text like calling trim_paragraphs(text, num2del=1) until count_tokens(text) <= desired_len, with the
+    same random draws, so the same result for a given seed.
+
+    Rather than tokenizing the whole text after every deletion, each paragraph is tokenized once and the length of
+    the text is estimated from the lengths of its paragraphs. The whole text is only tokenized when that estimate is
+    within max_error_per_paragraph tokens per paragraph of desired_len.
+
+    :param text: The self text
+    :param desired_len: Max number of tokens
+    :param count_tokens: function from a string to its number of tokens
+    :param separator_len: Number of tokens that each paragraph break adds (2 for the GPT-2 encoder, 0 for
+                          SentencePiece which treats it as any other whitespace)
+    :param max_error_per_paragraph: Max difference, per paragraph, between the estimate and the actual length
+    :return: the trimmed text
+    """
+    paragraph_lens = {}
+    while True:
+        paragraphs = text.split('\n\n')
+        for paragraph in paragraphs:
+            if paragraph not in paragraph_lens:
+                paragraph_lens[paragraph] = count_tokens(paragraph)
+        estimate = sum(paragraph_lens[p] for p in paragraphs) + separator_len * (len(paragraphs) - 1)
+        max_error = max_error_per_paragraph * len(paragraphs)
+        if estimate + max_error <= desired_len:
+            return text
+        if estimate - max_error <= desired_len and count_tokens(text) <= desired_len:
+            return text
+        text = trim_paragraphs(selftext=text, num2del=1)
+
+
 def tokenize_for_grover_advice_training(encoder, subreddit=None, date=None, title=None,
-                                        selftext=None, body=None, desired_len=1536):
+                                        selftext=None, body=None, desired_len=1536, pieces=None):
     """
     Tokenizes the post title / post selftext / comment body.
     If it's too long we'll cut some paragraphs at random from the selftext.
@@ -490,6 +881,8 @@ def tokenize_for_grover_advice_training(encoder, subreddit=None, date=None, titl
     :param title:
     :param selftext:
     :param body:
+    :param pieces: optional dict with some of these fields already tokenized, e.g. by _tokenize_reddit_posts_pieces.
+                   The other fields are tokenized here
     :return:
     """
     if len(selftext) < 64:
@@ -498,52 +891,61 @@ def tokenize_for_grover_advice_training(encoder, subreddit=None, date=None, titl
     if len(body) < 64:
         return None
 
-    article_pieces = _tokenize_reddit_post_pieces(encoder, subreddit=subreddit, date=date,
-                                                  title=title, selftext=selftext, body=body)
-    context = [t for k in ['subreddit', 'date', 'title', 'selftext'] for t in article_pieces[k]]
-    context.append(encoder.begin_summary)
-
+    pieces = pieces or {}
+    fields = {'subreddit': subreddit, 'date': date, 'title': title, 'selftext': selftext, 'body': body}
+    article_pieces = _tokenize_reddit_post_pieces(encoder, **{k: v for k, v in fields.items() if k not in pieces})
+    article_pieces.update(pieces)
     target = article_pieces['body'][1:]
 
-    if len(context) + len(target) < desired_len:
-        return {'context': context, 'target': target}
-
-    # print("Title len {} selftext len {} body len {}. RECURSING".format(len(encoder.encode(title)),
-    #                                                                    len(encoder.encode(selftext)),
-    #                                                                    len(encoder.encode(body))), flush=True)
-
-    # Delete this many paragraphs.
-    # TODO: might need to rehandle the logic for super long bodys. Distribution is
-    # """
-    # ----------
-    # Key selftext
-    #   0.000%: 4.000
-    #   0.100%: 12.000
-    #   25.000%: 222.000
-    #   50.000%: 418.000
-    #   75.000%: 701.000
-    #   90.000%: 1079.000
-    #   95.000%: 1366.300
-    #   99.000%: 2187.000
-    #   99.900%: 3710.000
-    #   99.990%: 5747.000
-    # ----------
-    # Key body
-    #   0.000%: 5.000
-    #   0.100%: 9.000
-    #   25.000%: 41.000
-    #   50.000%: 78.000
-    #   75.000%: 144.000
-    #   90.000%: 242.000
-    #   95.000%: 330.000
-    #   99.000%: 596.000
-    #   99.900%: 1118.848
-    #   99.990%: 1828.224
-    #   """
-    num2del = int(max((len(context) - desired_len) / len(context) * len(selftext.split('\n\n')), 1))
-    selftext = trim_paragraphs(selftext, num2del=num2del)
-    return tokenize_for_grover_advice_training(encoder, subreddit=subreddit, date=date,
-                                               title=title, selftext=selftext, body=body, desired_len=1536)
+    # Paragraphs of the selftext -> their tokens, so that each one is only tokenized once while trimming
+    paragraph_tokens = {}
+    while True:
+        context = [t for k in ['subreddit', 'date', 'title', 'selftext'] for t in article_pieces[k]]
+        context.append(encoder.begin_summary)
+
+        if len(context) + len(target) < desired_len:
+            return {'context': context, 'target': target}
+
+        # print("Title len {} selftext len {} body len {}. RECURSING".format(len(encoder.encode(title)),
+        #                                                                    len(encoder.encode(selftext)),
+        #                                                                    len(encoder.encode(body))), flush=True)
+
+        # Delete this many paragraphs.
+        # TODO: might need to rehandle the logic for super long bodys. Distribution is
+        # """
+        # ----------
+        # Key selftext
+        #   0.000%: 4.000
+        #   0.100%: 12.000
+        #   25.000%: 222.000
+        #   50.000%: 418.000
+        #   75.000%: 701.000
+        #   90.000%: 1079.000
+        #   95.000%: 1366.300
+        #   99.000%: 2187.000
+        #   99.900%: 3710.000
+        #   99.990%: 5747.000
+        # ----------
+        # Key body
+        #   0.000%: 5.000
+        #   0.100%: 9.000
+        #   25.000%: 41.000
+        #   50.000%: 78.000
+        #   75.000%: 144.000
+        #   90.000%: 242.000
+        #   95.000%: 330.000
+        #   99.000%: 596.000
+        #   99.900%: 1118.848
+        #   99.990%: 1828.224
+        #   """
+        num2del = int(max((len(context) - desired_len) / len(context) * len(selftext.split('\n\n')), 1))
+        selftext = trim_paragraphs(selftext, num2del=num2del)
+        # Later rounds use desired_len=1536, and give up on a selftext trimmed under 64 characters
+        desired_len = 1536
+        if len(selftext) < 64:
+            return None
+        selftext_tokens = encoder.encode_paragraphs(selftext.split('\n\n'), paragraph_tokens)
+        article_pieces['selftext'] = [encoder.begin_article] + selftext_tokens[:1536] + [encoder.end_article]
 
 
 #######################################
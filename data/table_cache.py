@@ -0,0 +1,57 @@
+"""
+Disk cache for tables that are slow to build but never change, e.g. the unicode translation tables of the text
+cleaning code, which scan every code point.
+
+Tables are built on first use and written to CACHE_DIR as JSON, in a file named after a hash of everything the table
+depends on (a version number bumped when the code that builds it changes, the unicode database version, library
+versions, ...). A change to any of these builds a new file rather than reusing a stale one.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import warnings
+
+CACHE_DIR = os.environ.get('TURINGADVICE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'turingadvice'))
+
+
+def cache_path(name, version_key):
+    """
+    :param name: name of the table
+    :param version_key: json-serializable description of everything the table depends on
+    :return: the local path of the cached table
+    """
+    key_hash = hashlib.sha1(json.dumps(version_key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, '{}-{}.json'.format(name, key_hash))
+
+
+def load_or_build(name, version_key, build_fn):
+    """
+    Load a table from the cache, or build it and cache it.
+
+    :param name: name of the table
+    :param version_key: json-serializable description of everything the table depends on
+    :param build_fn: function returning the table, anything json-serializable
+    :return: the table, as loaded from json
+    """
+    path = cache_path(name, version_key)
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)['table']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    table = build_fn()
+    # Written to a temporary file first, so that concurrent processes never read a partial table
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=name, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version_key': version_key, 'table': table}, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        warnings.warn("Couldn't cache {} in {}: {}".format(name, CACHE_DIR, e))
+    # Round trip through json so that cache hits and misses return the same types
+    return json.loads(json.dumps(table))
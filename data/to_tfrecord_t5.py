@@ -4,12 +4,17 @@ Tokenization and tfrecord conversion for T5.
 
 T5 uses a small vocab, so I had to remove symbols that are OOV, etc.
 """
+import hashlib
+import os
 import sys
+import unicodedata
+from functools import lru_cache
 
 sys.path.append('../')
 import random
 from datetime import datetime
-from data.encoder import trim_paragraphs
+from data.encoder import trim_paragraphs_to_length
+from data.table_cache import CACHE_DIR, load_or_build
 from t5.data.sentencepiece_vocabulary import SentencePieceVocabulary
 from data.assertions import question_is_valid, answer_is_valid
 import sys
@@ -24,9 +29,47 @@ import warnings
 
 random.seed(123456)
 
-# Make sure unidecode doesn't touch whatever is in the sentencepiece model
-encoder = SentencePieceVocabulary(sentencepiece_model_file='gs://t5-data/vocabs/cc_all.32000/sentencepiece.model')
-valid_symbols = sorted(set(''.join(encoder.decode([x]) for x in range(encoder.vocab_size))))
+SENTENCEPIECE_MODEL_PATH = os.environ.get('T5_SENTENCEPIECE_MODEL',
+                                          'gs://t5-data/vocabs/cc_all.32000/sentencepiece.model')
+# Bump when the code building FAST_UNIDECODE changes, to rebuild its cached version
+FAST_UNIDECODE_VERSION = 1
+
+
+class LazySentencePieceVocabulary(SentencePieceVocabulary):
+    """
+    A SentencePieceVocabulary that only loads its model on first use. A model on GCS is downloaded once to a local
+    copy in data.table_cache.CACHE_DIR.
+    """
+
+    def __init__(self, sentencepiece_model_file, extra_ids=0):
+        self._sentencepiece_model_file = sentencepiece_model_file
+        self._extra_ids = extra_ids
+        self._model = None
+
+    def _load(self):
+        if self._model is None:
+            model_file = self._sentencepiece_model_file
+            if '://' in model_file:
+                local_file = os.path.join(CACHE_DIR, 'sentencepiece-{}.model'.format(
+                    hashlib.sha1(model_file.encode('utf-8')).hexdigest()[:16]))
+                if not os.path.exists(local_file):
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    tf.io.gfile.copy(model_file, local_file + '.tmp', overwrite=True)
+                    os.replace(local_file + '.tmp', local_file)
+                model_file = local_file
+            self._model = SentencePieceVocabulary(model_file, extra_ids=self._extra_ids)
+        return self._model
+
+    @property
+    def _tokenizer(self):
+        return self._load()._tokenizer
+
+    @property
+    def _sp_model(self):
+        return self._load()._sp_model
+
+
+encoder = LazySentencePieceVocabulary(sentencepiece_model_file=SENTENCEPIECE_MODEL_PATH)
 
 emoji_pattern = re.compile("["
                            u"\U0001F600-\U0001F64F"  # emoticons
@@ -36,46 +79,113 @@ emoji_pattern = re.compile("["
                            u"\U00002702-\U000027B0"
                            u"\U000024C2-\U0001F251"
                            "]+", flags=re.UNICODE)
-with warnings.catch_warnings():
-    old2new_unidecode = {}
-    for i in range(sys.maxunicode):
-        val_i = chr(i)
-        if val_i in valid_symbols:
-            continue
-        try:
-            unidecode_vali = unidecode(val_i)
-        except Warning as e:
-            # Surrogate character will be ignored?
-            continue
-        if unidecode_vali == val_i:
-            continue
-        if unidecode_vali == '[?]':
-            old2new_unidecode[val_i] = ''
-            continue
-        if emoji_pattern.match(val_i) is not None:
-            old2new_unidecode[val_i] = ''
-            continue
-        old2new_unidecode[val_i] = unidecode_vali
-old2new_unidecode['\t'] = ' '
-FAST_UNIDECODE = str.maketrans(old2new_unidecode)
+
+
+def _build_old2new_unidecode():
+    # Make sure unidecode doesn't touch whatever is in the sentencepiece model
+    valid_symbols = set(''.join(encoder.decode([x]) for x in range(encoder.vocab_size)))
+    with warnings.catch_warnings():
+        old2new_unidecode = {}
+        for i in range(sys.maxunicode):
+            val_i = chr(i)
+            if val_i in valid_symbols:
+                continue
+            try:
+                unidecode_vali = unidecode(val_i)
+            except Warning as e:
+                # Surrogate character will be ignored?
+                continue
+            if unidecode_vali == val_i:
+                continue
+            if unidecode_vali == '[?]':
+                old2new_unidecode[val_i] = ''
+                continue
+            if emoji_pattern.match(val_i) is not None:
+                old2new_unidecode[val_i] = ''
+                continue
+            old2new_unidecode[val_i] = unidecode_vali
+    old2new_unidecode['\t'] = ' '
+    return old2new_unidecode
+
+
+@lru_cache()
+def _fast_unidecode():
+    """
+    Translation table replacing the characters that are not in the T5 vocab by their unidecode version. Scanning
+    every code point is slow, so this is cached on disk, see data/table_cache.py
+    """
+    import pkg_resources
+    try:
+        unidecode_version = pkg_resources.get_distribution('unidecode').version
+    except pkg_resources.DistributionNotFound:
+        unidecode_version = None
+    table = load_or_build(
+        'fast_unidecode',
+        {'version': FAST_UNIDECODE_VERSION, 'unidata_version': unicodedata.unidata_version,
+         'maxunicode': sys.maxunicode, 'unidecode_version': unidecode_version,
+         'sentencepiece_model': SENTENCEPIECE_MODEL_PATH},
+        _build_fast_unidecode_table)
+    fast_unidecode = {i: '' for start, end in table['deleted'] for i in range(start, end)}
+    fast_unidecode.update((ord(k), v) for k, v in table['replaced'].items())
+    return fast_unidecode
+
+
+def _build_fast_unidecode_table():
+    """ The characters that map to '' as [start, end) code point ranges, as most of them are consecutive"""
+    deleted = []
+    replaced = {}
+    for k, v in _build_old2new_unidecode().items():
+        if v != '':
+            replaced[k] = v
+        elif deleted and deleted[-1][1] == ord(k):
+            deleted[-1][1] += 1
+        else:
+            deleted.append([ord(k), ord(k) + 1])
+    return {'deleted': deleted, 'replaced': replaced}
+
+
+def __getattr__(name):
+    """ FAST_UNIDECODE is only built on first use, so that importing this module is fast"""
+    if name == 'FAST_UNIDECODE':
+        return _fast_unidecode()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+_DOUBLE_NEWLINE_RE = re.compile(r'[\s\n]*\n\n[\s\n]*', flags=re.MULTILINE)
+# Runs of whitespace that r'\s+' -> ' ' would change: single spaces are left alone
+_WHITESPACE_RE = re.compile(r'\s{2,}|[^\S ]')
+# Joins the texts cleaned at once by _fix_reddit_texts. Not whitespace, and left alone by FAST_UNIDECODE
+_BATCH_SEPARATOR = '\x00'
 
 
 def _fix_reddit_text(x):
     """TSV writer will complain if I can't do newlines. note that this will return an UNK"""
-    x1 = x.translate(FAST_UNIDECODE)
-    x3 = re.sub(r'[\s\n]*\n\n[\s\n]*', ' » ', x1, flags=re.MULTILINE)  # Double newline
-    x4 = re.sub(r'[\s\n]*\n[\s\n]*', ' ', x3, flags=re.MULTILINE)  # Single newline
-    x4 = re.sub(r'\s+', ' ', x4)
+    x1 = x.translate(_fast_unidecode())
+    x3 = _DOUBLE_NEWLINE_RE.sub(' » ', x1) if '\n\n' in x1 else x1  # Double newline
+    # Single newlines, and any other whitespace
+    x4 = _WHITESPACE_RE.sub(' ', x3)
     return x4
 
 
+def _fix_reddit_texts(xs):
+    """
+    _fix_reddit_text for many texts, e.g. all fields of a question, in a single pass over all of them
+
+    :param xs: list of strings
+    :return: list of fixed strings
+    """
+    if len(xs) < 2 or any(_BATCH_SEPARATOR in x for x in xs):
+        return [_fix_reddit_text(x) for x in xs]
+    # Whitespace runs never cross a separator, so each text is fixed as if it was alone
+    fixed = _fix_reddit_text(_BATCH_SEPARATOR.join(xs)).split(_BATCH_SEPARATOR)
+    if len(fixed) != len(xs):
+        return [_fix_reddit_text(x) for x in xs]
+    return fixed
+
+
 def _trim_to_desired_length(encoder, text, desired_len=512):
     """ Trims a piece to the desired length, for sometimes long article pieces"""
-    doc_len = len(encoder.encode(text))
-    if doc_len <= desired_len:
-        return text
-    text = trim_paragraphs(selftext=text, num2del=1)
-    return _trim_to_desired_length(encoder, text, desired_len=desired_len)
+    return trim_paragraphs_to_length(text, desired_len, lambda x: len(encoder.encode(x)))
 
 
 def tokenize_for_t5_advice_training(encoder, subreddit=None, date=None, title=None,
@@ -109,7 +219,7 @@ def tokenize_for_t5_advice_training(encoder, subreddit=None, date=None, title=No
     article_pieces['title'] = title
     article_pieces['selftext'] = _trim_to_desired_length(encoder, selftext, desired_len=1250)
     article_pieces['body'] = body
-    return {k: _fix_reddit_text(v) for k, v in article_pieces.items()}
+    return dict(zip(article_pieces.keys(), _fix_reddit_texts(list(article_pieces.values()))))
 
 def write_answer(question: dict, answer: dict, file):
     """
@@ -0,0 +1,127 @@
+import math
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request would exceed the server's or its client's share of
+    the work in flight
+    """
+    def __init__(self, message, status, retry_after_secs):
+        """
+        Args:
+        status: int
+            503 if the server is full, 429 if the client has too much in flight
+        retry_after_secs: int
+            Estimated wait until the request would be admitted
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after_secs = retry_after_secs
+
+class AdmissionController():
+    """
+    Bounds the work in flight, measured in cost units (e.g. instances x N
+    samples), and rejects requests beyond the bound right away instead of
+    queueing them for hours.
+
+    A client that already has work in flight can't take more than
+    max_client_share of the capacity, so one large batch leaves room for
+    short interactive requests. A request larger than the capacity is only
+    admitted when the server is idle, so that it isn't rejected forever.
+    """
+    def __init__(
+        self, max_in_flight_cost, max_client_share=0.75,
+        throughput_window_secs=600.0, default_retry_after_secs=60
+        ):
+        """
+        Args:
+        max_in_flight_cost: float
+            Maximum total cost of the admitted requests that haven't finished
+        max_client_share: float
+            Fraction of max_in_flight_cost a single client can fill
+        throughput_window_secs: float
+            Completed costs in this window estimate the throughput used for
+            Retry-After
+        default_retry_after_secs: int
+            Retry-After before any request has completed
+        """
+        self.max_in_flight_cost = max_in_flight_cost
+        self.max_client_cost = max_client_share * max_in_flight_cost
+        self.throughput_window_secs = throughput_window_secs
+        self.default_retry_after_secs = default_retry_after_secs
+        self._in_flight_cost = 0
+        self._client_costs = defaultdict(float)
+        self._completions = deque() # (completion time, cost)
+        self._start_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, client_id, cost):
+        """
+        Hold cost units of capacity for client_id while the with block runs
+
+        Raises:
+        AdmissionRejected
+        """
+        self.acquire(client_id, cost)
+        try:
+            yield
+        finally:
+            self.release(client_id, cost)
+
+    def acquire(self, client_id, cost):
+        with self._lock:
+            client_cost = self._client_costs.get(client_id, 0)
+            if self._in_flight_cost > 0 \
+                and self._in_flight_cost + cost > self.max_in_flight_cost:
+                excess_cost = self._in_flight_cost + cost - self.max_in_flight_cost
+                raise AdmissionRejected(
+                    f"Server is busy: {self._in_flight_cost} in flight, "
+                    f"request costs {cost} (max {self.max_in_flight_cost})",
+                    status=503,
+                    retry_after_secs=self._retry_after(excess_cost)
+                )
+            if client_cost > 0 and client_cost + cost > self.max_client_cost:
+                excess_cost = client_cost + cost - self.max_client_cost
+                raise AdmissionRejected(
+                    f"Client {client_id} has {client_cost} in flight, "
+                    f"request costs {cost} (max {self.max_client_cost:g} "
+                    f"per client)",
+                    status=429,
+                    retry_after_secs=self._retry_after(excess_cost)
+                )
+            self._in_flight_cost += cost
+            self._client_costs[client_id] = client_cost + cost
+
+    def release(self, client_id, cost):
+        now = time.monotonic()
+        with self._lock:
+            self._in_flight_cost -= cost
+            self._client_costs[client_id] -= cost
+            if self._client_costs[client_id] <= 0:
+                del self._client_costs[client_id]
+            self._completions.append((now, cost))
+
+    def throughput(self):
+        """Completed cost per second over the last throughput_window_secs"""
+        with self._lock:
+            return self._throughput()
+
+    def _throughput(self):
+        now = time.monotonic()
+        while self._completions \
+            and self._completions[0][0] < now - self.throughput_window_secs:
+            self._completions.popleft()
+        if not self._completions:
+            return None
+        window_secs = min(self.throughput_window_secs, now - self._start_time)
+        return sum(cost for _, cost in self._completions) / max(window_secs, 1e-3)
+
+    def _retry_after(self, excess_cost):
+        throughput = self._throughput()
+        if throughput is None:
+            return self.default_retry_after_secs
+        return max(1, math.ceil(excess_cost / throughput))
@@ -0,0 +1,73 @@
+"""Tests for frontend.admission"""
+import pytest
+
+from frontend import admission as admission_module
+from frontend.admission import AdmissionController, AdmissionRejected
+
+class _Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(admission_module.time, "monotonic", clock)
+    return clock
+
+def test_full_server_rejects_with_503():
+    admission = AdmissionController(max_in_flight_cost=100, max_client_share=0.75)
+    admission.acquire("a", 60)
+    admission.acquire("b", 40)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire("c", 1)
+    assert e.value.status == 503
+    assert e.value.retry_after_secs == admission.default_retry_after_secs
+
+def test_client_over_its_share_is_rejected_with_429():
+    admission = AdmissionController(max_in_flight_cost=100, max_client_share=0.5)
+    admission.acquire("a", 40)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire("a", 20)
+    assert e.value.status == 429
+    # Other clients still get the remaining capacity
+    admission.acquire("b", 50)
+
+def test_client_without_work_in_flight_can_exceed_its_share():
+    admission = AdmissionController(max_in_flight_cost=100, max_client_share=0.5)
+    admission.acquire("a", 80)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire("a", 1)
+    assert e.value.status == 429
+
+def test_oversized_request_is_only_admitted_when_idle():
+    admission = AdmissionController(max_in_flight_cost=100)
+    admission.acquire("a", 1)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire("b", 500)
+    assert e.value.status == 503
+    admission.release("a", 1)
+    admission.acquire("b", 500)
+
+def test_admit_releases_capacity_on_errors():
+    admission = AdmissionController(max_in_flight_cost=100)
+    with pytest.raises(ValueError):
+        with admission.admit("a", 100):
+            raise ValueError()
+    with admission.admit("b", 100):
+        pass
+
+def test_retry_after_follows_throughput(clock):
+    admission = AdmissionController(max_in_flight_cost=100, max_client_share=1.0)
+    clock.now += 10
+    with admission.admit("a", 50):
+        clock.now += 10
+    # 50 completed in the 20 seconds since the start
+    assert admission.throughput() == pytest.approx(2.5)
+    admission.acquire("a", 100)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire("b", 10)
+    assert e.value.status == 503
+    assert e.value.retry_after_secs == 4
@@ -1,18 +1,20 @@
 import os
-import re
-import json
 import logging
-from datetime import datetime
 
 import flask
 from flask_cors import CORS
 import click
+import gevent
 from gevent.pywsgi import WSGIServer
-import tensorflow as tf
 
 from t5.models.mtf_model import MtfModel
 from reward.comparative.model import ComparativeRewardModel
 from best_of_n.generator import BestOfNGenerator
+from frontend.batching import MicroBatcher
+from frontend.admission import AdmissionController
+from frontend.cache import ResponseCache
+from frontend.log_sink import AsyncLogSink
+from frontend.routes import add_routes
 
 SAMPLING_KEEP_TOP_P = 0.95
 BEST_OF_N_N = 80
@@ -21,28 +23,65 @@ T5_MODEL_CKPT = 1010000
 REWARD_MODEL_DIR = "gs://seri2021-advice-eu/turingadvice/reward/comparative/checkpoints/3B/f2-1-small-batch"
 REWARD_MODEL_CKPT = 1019348
 BoN_TMP_DIR = "gs://seri2021-advice-eu/turingadvice/frontend"
+# Predict from strings, keeping both checkpoints in memory, instead of through
+# files in BoN_TMP_DIR. Experimental on TPUs (see
+# t5.models.mtf_model.WarmPredictLoop)
+PREDICT_IN_MEMORY = False
+T5_TPU = os.uname()[1]
+# A TPU holds one session at a time, so in memory, the reward model needs a
+# TPU of its own
+REWARD_MODEL_TPU = os.uname()[1]
 MODEL_PARALLELISM = 8
 ITERATIONS_PER_LOOP = 10
 TEMPLATE_DIR = "./frontend"
+# A best_of_n.stopping rule, e.g. MarginRule(margin=..., min_samples=16), to
+# sample and score in rounds of ROUND_SIZE and stop early for questions with a
+# clear winner. N is then only the maximum number of samples per question.
+# The margin is in reward units, so tune it per reward model. Needs
+# PREDICT_IN_MEMORY, since every round uses both models. None to always draw N
+# samples
+STOPPING_RULE = None
+ROUND_SIZE = 16
+# Instances from concurrent requests are batched together
+BATCH_MAX_SIZE = 8
+BATCH_MAX_DELAY_SECS = 1.0
+BATCH_MAX_QUEUE_SIZE = 256
+# Requests beyond this many samples (instances x N) in flight are rejected
+# with a Retry-After, and a client with work in flight can't take more than
+# ADMISSION_MAX_CLIENT_SHARE of it. Clients identify with an X-Client-Id
+# header, or by their address
+ADMISSION_MAX_IN_FLIGHT_COST = BATCH_MAX_QUEUE_SIZE * BEST_OF_N_N
+ADMISSION_MAX_CLIENT_SHARE = 0.75
+# Jobs submitted to /api/jobs are kept here, and resumed after a restart.
+# Not shared with the other server in frontend/, whose runner would take them
+JOBS_DB_PATH = "./frontend/jobs-gevent.sqlite"
+# Repeated instances are answered from the cache instead of re-generated
+CACHE_MAX_ENTRIES = 10000
+CACHE_TTL_SECS = None
+CACHE_DIR = None # Local directory, to keep the cache across restarts
 
 # Initialize models and Best-of-N generator
+if PREDICT_IN_MEMORY and REWARD_MODEL_TPU == T5_TPU:
+    raise ValueError("PREDICT_IN_MEMORY needs a REWARD_MODEL_TPU of its own")
 t5_model = MtfModel(
     model_dir=T5_MODEL_DIR,
-    tpu=os.uname()[1],
+    tpu=T5_TPU,
     tpu_topology="2x2", # Must be this for validation (Rowan)
     model_parallelism=MODEL_PARALLELISM,
     batch_size=1,
     sequence_length={"inputs": 1280, "targets": 512},
-    iterations_per_loop=ITERATIONS_PER_LOOP
+    iterations_per_loop=ITERATIONS_PER_LOOP,
+    predict_queue_feed=PREDICT_IN_MEMORY
 )
 reward_model = ComparativeRewardModel(
     model_dir=REWARD_MODEL_DIR,
-    tpu=os.uname()[1],
+    tpu=REWARD_MODEL_TPU,
     tpu_topology="2x2", # Must be this for validation (Rowan)
     model_parallelism=MODEL_PARALLELISM,
     batch_size=1,
     sequence_length={"inputs": 1280, "targets": 512},
-    iterations_per_loop=ITERATIONS_PER_LOOP
+    iterations_per_loop=ITERATIONS_PER_LOOP,
+    predict_queue_feed=PREDICT_IN_MEMORY
 )
 BoN_generator = BestOfNGenerator(
     t5_model=t5_model,
@@ -51,34 +90,48 @@ BoN_generator = BestOfNGenerator(
     reward_model_ckpt_steps=REWARD_MODEL_CKPT,
     N=BEST_OF_N_N,
     sampling_keep_top_p=SAMPLING_KEEP_TOP_P,
-    tmp_dir=BoN_TMP_DIR
+    stopping_rule=STOPPING_RULE,
+    round_size=ROUND_SIZE,
+    tmp_dir=BoN_TMP_DIR,
+    in_memory=PREDICT_IN_MEMORY,
+    cache=ResponseCache(
+        max_entries=CACHE_MAX_ENTRIES,
+        ttl_secs=CACHE_TTL_SECS,
+        disk_dir=CACHE_DIR
+    )
+)
+# Reranking goes through the batcher too, so that only its thread uses the
+# models
+batcher = MicroBatcher(
+    BoN_generator.process_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_delay_secs=BATCH_MAX_DELAY_SECS,
+    max_queue_size=BATCH_MAX_QUEUE_SIZE
+)
+# Requests wait for their batch in gevent's native threadpool, so the event
+# loop keeps accepting other requests in the meantime
+gevent.get_hub().threadpool.maxsize = BATCH_MAX_QUEUE_SIZE
+
+admission = AdmissionController(
+    max_in_flight_cost=ADMISSION_MAX_IN_FLIGHT_COST,
+    max_client_share=ADMISSION_MAX_CLIENT_SHARE
 )
 
+# Requests are logged to segments in BoN_TMP_DIR in the background
+request_log = AsyncLogSink(BoN_TMP_DIR, prefix="log")
+
 # Initialize API
 app = flask.Flask(__name__, template_folder=TEMPLATE_DIR)
 CORS(app, resources={r'/api/*': {'origins': '*'}})
 logger = logging.getLogger(__name__)
 
-def _datetime_to_str(date):
-    return [
-        'January', 'February', 'March', 'April', 'May', 'June', 'July',
-        'August', 'September', 'October', 'November', 'December'
-        ][date.month - 1] + ' {}, {}'.format(date.day, date.year)
+def _run_in_threadpool(fn, *args, **kwargs):
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
 
-@app.route('/api/askbatch', methods=['POST'])
-def api_askbatch():
-    request_dict = dict(flask.request.json)
-    instances = request_dict["instances"]
-    date = datetime.utcnow()
-    date_str = _datetime_to_str(date)
-    for instance in instances:
-        instance["date"] = date_str
-    advices = BoN_generator.generate_from_instances(instances)
-    advices = [re.sub(r'\s+»\s+', '\n\n', advice).strip() for advice in advices]
-    request_dict.update({"advices": advices})
-    with tf.io.gfile.GFile(os.path.join(BoN_TMP_DIR, "log.jsonl"), "a+") as logfile:
-        logfile.write(json.dumps(request_dict) + "\n")
-    return flask.jsonify({"gens": advices}), 200
+job_runner = add_routes(
+    app, batcher, admission, request_log, JOBS_DB_PATH, BEST_OF_N_N,
+    run_blocking=_run_in_threadpool
+)
 
 @click.command()
 def serve():
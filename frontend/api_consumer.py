@@ -17,6 +17,11 @@ from datetime import datetime
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-date_tag', type=str, default="Sep-03-21", help='Default date tag to use')
+parser.add_argument('-mode', type=str, default='askbatch', choices=['askbatch', 'jobs'],
+                    help='askbatch holds one connection open for the whole run. jobs submits a job to '
+                         '/api/jobs and polls it, so dropped connections (or restarts of this script) lose nothing. '
+                         'Servers without /api/jobs fall back to askbatch')
+parser.add_argument('-poll_interval', type=float, default=60.0, help='Seconds between job status polls')
 
 args = parser.parse_args()
 
@@ -55,6 +60,62 @@ async def generate_from_model_async(items, model_type: str):
     return tuple(response['gens'])
 
 
+async def generate_from_model_job_async(items, model_type: str):
+    """
+    Like generate_from_model_async, but through the job API. The job id is saved next to the questions,
+    so that rerunning this script picks up the same job. Falls back to generate_from_model_async if the
+    server has no /api/jobs
+    :param items:
+    :param model_type:
+    :return:
+    """
+    jobs_url = model_to_url[model_type].replace('/api/askbatch', '/api/jobs')
+    job_id_fn = f'{cache_fn}.{model_type}.job'
+    data = {
+        'instances': [{'title': x['title'], 'selftext': x['selftext'],
+                       'subreddit': x['subreddit']} for x in items],
+    }
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10 * 60)) as session:
+        if os.path.exists(job_id_fn):
+            with open(job_id_fn, 'r') as f:
+                job_id = f.read().strip()
+            print(f"RESUMING JOB {job_id} FOR {model_type}", flush=True)
+        else:
+            async with session.post(jobs_url, json=data) as resp:
+                if resp.status == 404:
+                    job_id = None
+                else:
+                    job_id = (await resp.json())['job_id']
+            if job_id is None:
+                # Servers without the job API (e.g. Grover, TF-IDF) only have /api/askbatch
+                print(f"NO JOB API FOR {model_type}, FALLING BACK TO ASKBATCH", flush=True)
+                return await generate_from_model_async(items, model_type)
+            with open(job_id_fn, 'w') as f:
+                f.write(job_id)
+            print(f"SUBMITTED JOB {job_id} FOR {model_type}", flush=True)
+
+        while True:
+            try:
+                async with session.get(f'{jobs_url}/{job_id}') as resp:
+                    job = await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"COULDN'T POLL {model_type}: {e!r}", flush=True)
+                await asyncio.sleep(args.poll_interval)
+                continue
+            print(f"{model_type}: {job['status']}, {job['n_done']}/{job['n_total']} done", flush=True)
+            if job['status'] == 'done':
+                break
+            if job['status'] in ('failed', 'cancelled'):
+                raise ValueError(f"Job {job_id} for {model_type} is {job['status']}: {job.get('error')}")
+            await asyncio.sleep(args.poll_interval)
+
+        async with session.get(f'{jobs_url}/{job_id}/results') as resp:
+            response = await resp.json()
+    os.remove(job_id_fn)
+    print(f"DONE WITH {model_type}", flush=True)
+    return tuple(response['gens'])
+
+
 def generate_from_all_models(items):
     """
     Generates from all of the models, in parallel
@@ -63,7 +124,8 @@ def generate_from_all_models(items):
     """
     loop = asyncio.get_event_loop()
     model_list = sorted(model_to_url.keys())
-    task_list = [generate_from_model_async(items, model_type=m) for m in model_list]
+    generate_fn = generate_from_model_job_async if args.mode == 'jobs' else generate_from_model_async
+    task_list = [generate_fn(items, model_type=m) for m in model_list]
     result_list = loop.run_until_complete(asyncio.gather(*task_list))
     loop.close()
     return {k: r for k, r in zip(model_list, result_list)}
@@ -0,0 +1,157 @@
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """Raised when a MicroBatcher can't take any more pending items"""
+
+class MicroBatcher():
+    """
+    Collects items submitted by concurrent requests into model-sized batches,
+    runs each batch through a single call to process_batch_fn, and sends every
+    result back to the request that submitted the item.
+
+    A batch is processed as soon as it has max_batch_size items, or once its
+    oldest item has waited for max_delay_secs, whichever comes first. Batches
+    take items from the clients with pending items in turn, so a client's
+    large submission doesn't hold back the small ones of other clients.
+    """
+    def __init__(
+        self, process_batch_fn, max_batch_size=8, max_delay_secs=0.1,
+        max_queue_size=1024, name="batcher"
+        ):
+        """
+        Args:
+        process_batch_fn: callable
+            Takes a list of items and returns a list with one result per item
+        max_batch_size: int
+            Maximum number of items passed to process_batch_fn at once
+        max_delay_secs: float
+            Maximum time an item waits for its batch to fill up
+        max_queue_size: int
+            Maximum number of items waiting to be processed. Submitting more
+            raises QueueFullError
+        name: str
+            Name of the worker thread
+        """
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.process_batch_fn = process_batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay_secs = max_delay_secs
+        self.max_queue_size = max_queue_size
+        self._pending = OrderedDict() # client_id -> deque of (item, future, enqueue_time)
+        self._n_pending = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def qsize(self):
+        with self._cond:
+            return self._n_pending
+
+    def submit(self, items, client_id=None):
+        """
+        Args:
+        items: list
+            Items to process. Either all of them are queued or none is
+        client_id: hashable
+            Who submits the items, for fair batching
+
+        Returns:
+        futures: [concurrent.futures.Future]
+            One future per item, resolved with that item's result
+        """
+        futures = [Future() for _ in items]
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Cannot submit to a closed MicroBatcher")
+            if self._n_pending + len(items) > self.max_queue_size:
+                raise QueueFullError(
+                    f"{self._n_pending} items pending, can't queue "
+                    f"{len(items)} more (max_queue_size={self.max_queue_size})"
+                )
+            client_pending = self._pending.setdefault(client_id, deque())
+            for item, future in zip(items, futures):
+                client_pending.append((item, future, now))
+            self._n_pending += len(items)
+            self._cond.notify()
+        return futures
+
+    def map(self, items, timeout=None, client_id=None):
+        """
+        Blocking version of submit, which returns the results of all items
+        """
+        return [
+            f.result(timeout=timeout)
+            for f in self.submit(items, client_id=client_id)
+        ]
+
+    def close(self):
+        """Process the items already queued, then stop the worker thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._n_pending:
+                    oldest_time = min(
+                        client_pending[0][2]
+                        for client_pending in self._pending.values()
+                    )
+                    timeout = oldest_time + self.max_delay_secs - time.monotonic()
+                    if self._n_pending >= self.max_batch_size \
+                        or timeout <= 0 or self._closed:
+                        return self._pop_round_robin()
+                    self._cond.wait(timeout)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _pop_round_robin(self):
+        """
+        Up to max_batch_size items, taking one item per client in turn. Clients
+        are kept in the order they were last served, so the next batch starts
+        with the ones this batch didn't reach
+        """
+        batch = []
+        while self._n_pending and len(batch) < self.max_batch_size:
+            client_id, client_pending = next(iter(self._pending.items()))
+            batch.append(client_pending.popleft())
+            self._n_pending -= 1
+            if client_pending:
+                self._pending.move_to_end(client_id)
+            else:
+                del self._pending[client_id]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            items = [item for item, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+            try:
+                results = self.process_batch_fn(items)
+                if len(results) != len(items):
+                    raise ValueError(
+                        f"process_batch_fn returned {len(results)} results "
+                        f"for {len(items)} items"
+                    )
+            except Exception as e:
+                logger.exception("Batch of %d items failed", len(items))
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,74 @@
+"""Tests for frontend.batching"""
+import threading
+
+import pytest
+
+from frontend.batching import MicroBatcher, QueueFullError
+
+class _BlockedBatcher():
+    """
+    A MicroBatcher whose worker is held on a first batch until release(), so
+    that the items submitted in the meantime are batched all at once
+    """
+    def __init__(self, max_batch_size, max_queue_size=1024):
+        self.batches = []
+        self._started = threading.Event()
+        self._released = threading.Event()
+        self.batcher = MicroBatcher(
+            self._process,
+            max_batch_size=max_batch_size,
+            max_delay_secs=0.0,
+            max_queue_size=max_queue_size
+        )
+        self._blocker = self.batcher.submit(["blocker"], client_id="blocker")[0]
+        assert self._started.wait(5)
+
+    def _process(self, items):
+        if items == ["blocker"]:
+            self._started.set()
+            assert self._released.wait(5)
+        else:
+            self.batches.append(list(items))
+        return [item.upper() for item in items]
+
+    def release(self):
+        self._released.set()
+        self._blocker.result(timeout=5)
+        self.batcher.close()
+        return self.batches
+
+def test_batches_take_clients_in_turn():
+    blocked = _BlockedBatcher(max_batch_size=3)
+    blocked.batcher.submit(["a1", "a2", "a3", "a4"], client_id="a")
+    blocked.batcher.submit(["b1"], client_id="b")
+    blocked.batcher.submit(["c1", "c2"], client_id="c")
+    assert blocked.release() == [
+        ["a1", "b1", "c1"],
+        ["a2", "c2", "a3"],
+        ["a4"]
+    ]
+
+def test_large_submission_does_not_hold_back_later_clients():
+    blocked = _BlockedBatcher(max_batch_size=2)
+    blocked.batcher.submit([f"a{i}" for i in range(6)], client_id="a")
+    blocked.batcher.submit(["b0"], client_id="b")
+    batches = blocked.release()
+    assert batches[0] == ["a0", "b0"]
+    assert [item for batch in batches for item in batch if item.startswith("a")] \
+        == [f"a{i}" for i in range(6)]
+
+def test_results_go_back_to_their_items():
+    blocked = _BlockedBatcher(max_batch_size=4)
+    a_futures = blocked.batcher.submit(["x", "y"], client_id="a")
+    b_futures = blocked.batcher.submit(["z"], client_id="b")
+    blocked.release()
+    assert [f.result(timeout=5) for f in a_futures] == ["X", "Y"]
+    assert [f.result(timeout=5) for f in b_futures] == ["Z"]
+
+def test_full_queue_rejects_the_whole_submission():
+    blocked = _BlockedBatcher(max_batch_size=2, max_queue_size=3)
+    blocked.batcher.submit(["a0", "a1"], client_id="a")
+    with pytest.raises(QueueFullError):
+        blocked.batcher.submit(["b0", "b1"], client_id="b")
+    assert blocked.batcher.qsize() == 2
+    assert blocked.release() == [["a0", "a1"]]
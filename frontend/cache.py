@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from best_of_n.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "response_cache_lookups_total",
+    "Response cache lookups, by result (hit or miss)",
+    labelnames=("result",)
+)
+
+KEY_FIELDS = ["subreddit", "title", "selftext", "date"]
+
+def normalize_instance(instance):
+    """
+    The fields of an instance that determine its response, with surrounding
+    whitespace removed
+    """
+    return {k: str(instance.get(k) or "").strip() for k in KEY_FIELDS}
+
+def instance_key(instance, model_id):
+    """
+    Args:
+    instance: dict
+        Dict with keys "subreddit", "title", "selftext" and (optionally) "date"
+    model_id: str
+        Identifies everything else the response depends on, e.g. model
+        directories, checkpoint steps and sampling parameters
+
+    Returns:
+    key: str
+        Hex digest of the normalized instance and model_id
+    """
+    content = json.dumps(
+        [model_id, normalize_instance(instance)],
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+class ResponseCache():
+    """
+    Content-addressed cache of model responses. Responses live in an in-memory
+    LRU and, optionally, in a directory on local disk that survives restarts.
+    Values must be JSON-serializable.
+    """
+    def __init__(
+        self, max_entries=10000, max_bytes=None, ttl_secs=None, disk_dir=None,
+        max_disk_entries=100000
+        ):
+        """
+        Args:
+        max_entries: int
+            Maximum number of responses kept in memory
+        max_bytes: int
+            Maximum total size of the (JSON-encoded) responses kept in memory.
+            None for no limit
+        ttl_secs: float
+            Responses older than this are treated as missing. None for no
+            expiration
+        disk_dir: str
+            Local directory for the on-disk tier. None to only cache in memory
+        max_disk_entries: int
+            Maximum number of responses kept on disk. The oldest ones are
+            removed first
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (value, created, n_bytes)
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._n_disk_entries = len(self._disk_keys())
+
+    def get(self, key):
+        """Returns the cached value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[1]):
+                self._remove(key)
+                entry = None
+            if entry is None and self.disk_dir is not None:
+                entry = self._read_disk(key)
+                if entry is not None:
+                    self._insert(key, *entry)
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result="hit")
+            return entry[0]
+
+    def put(self, key, value):
+        created = time.time()
+        n_bytes = len(json.dumps(value))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._insert(key, value, created, n_bytes)
+            if self.disk_dir is not None:
+                self._write_disk(key, value, created)
+
+    def get_or_compute(self, instances, model_id, compute_fn):
+        """
+        Args:
+        instances: [dict]
+            Instances to get responses for
+        model_id: str
+            See instance_key
+        compute_fn: callable
+            Takes a list of instances and returns one response per instance.
+            Only called on the instances that aren't cached, each one once
+
+        Returns:
+        responses: list
+            One response per instance
+        """
+        keys = [instance_key(instance, model_id) for instance in instances]
+        responses = [self.get(key) for key in keys]
+        missing = OrderedDict() # key -> index of first instance with that key
+        for idx, (key, response) in enumerate(zip(keys, responses)):
+            if response is None and key not in missing:
+                missing[key] = idx
+        if missing:
+            computed = compute_fn([instances[idx] for idx in missing.values()])
+            computed = dict(zip(missing.keys(), computed))
+            for key, response in computed.items():
+                self.put(key, response)
+            responses = [
+                computed[key] if response is None else response
+                for key, response in zip(keys, responses)
+            ]
+        return responses
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._n_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def _is_expired(self, created):
+        return self.ttl_secs is not None \
+            and time.time() - created > self.ttl_secs
+
+    def _insert(self, key, value, created, n_bytes):
+        self._entries[key] = (value, created, n_bytes)
+        self._n_bytes += n_bytes
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._n_bytes > self.max_bytes
+            and len(self._entries) > 1
+            ):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, n_bytes = self._entries.pop(key)
+        self._n_bytes -= n_bytes
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _disk_keys(self):
+        return [f for f in os.listdir(self.disk_dir) if f.endswith(".json")]
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), "r") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._is_expired(record["created"]):
+            return None
+        return record["value"], record["created"], len(json.dumps(record["value"]))
+
+    def _write_disk(self, key, value, created):
+        path = self._disk_path(key)
+        existed = os.path.exists(path)
+        tmp_path = path + f".tmp-{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"value": value, "created": created}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Couldn't write cache entry %s to disk", key)
+            return
+        if not existed:
+            self._n_disk_entries += 1
+        if self._n_disk_entries > self.max_disk_entries:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """Remove the oldest 10% of the entries on disk"""
+        paths = [os.path.join(self.disk_dir, f) for f in self._disk_keys()]
+        paths.sort(key=os.path.getmtime)
+        n_to_keep = int(self.max_disk_entries * 0.9)
+        for path in paths[:max(len(paths) - n_to_keep, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._n_disk_entries = min(len(paths), n_to_keep)
@@ -0,0 +1,89 @@
+"""Tests for frontend.cache"""
+import json
+
+import pytest
+
+from frontend import cache as cache_module
+from frontend.cache import ResponseCache, instance_key
+
+class _Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    return clock
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+def test_put_refreshes_an_existing_key():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 10)
+    cache.put("c", 3)
+    assert cache.get("a") == 10
+    assert cache.get("b") is None
+    assert cache.stats()["entries"] == 2
+
+def test_max_bytes_evicts_oldest_but_keeps_the_newest():
+    n_bytes = len(json.dumps("x" * 10))
+    cache = ResponseCache(max_entries=100, max_bytes=2 * n_bytes)
+    for key in "abc":
+        cache.put(key, key * 10)
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 2 * n_bytes
+    # An entry larger than max_bytes on its own is still kept
+    cache.put("big", "x" * 100)
+    assert cache.get("big") == "x" * 100
+    assert cache.stats()["entries"] == 1
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResponseCache(ttl_secs=10)
+    cache.put("a", 1)
+    clock.now += 10
+    assert cache.get("a") == 1
+    clock.now += 0.5
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+def test_expired_disk_entries_are_not_loaded(clock, tmp_path):
+    ResponseCache(ttl_secs=10, disk_dir=str(tmp_path)).put("a", 1)
+    assert ResponseCache(ttl_secs=10, disk_dir=str(tmp_path)).get("a") == 1
+    clock.now += 11
+    assert ResponseCache(ttl_secs=10, disk_dir=str(tmp_path)).get("a") is None
+
+def test_disk_is_pruned_to_max_disk_entries(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), max_disk_entries=10)
+    for i in range(11):
+        cache.put(str(i), i)
+    assert len(list(tmp_path.glob("*.json"))) == 9
+
+def test_get_or_compute_only_computes_missing_instances_once():
+    cache = ResponseCache()
+    instances = [
+        {"subreddit": "r", "title": "t1", "selftext": "s"},
+        {"subreddit": "r", "title": " t1 ", "selftext": "s"},
+        {"subreddit": "r", "title": "t2", "selftext": "s"}
+    ]
+    cache.put(instance_key(instances[2], "m"), "cached")
+    computed = []
+    def _compute(xs):
+        computed.extend(xs)
+        return [x["title"].strip().upper() for x in xs]
+    assert cache.get_or_compute(instances, "m", _compute) == ["T1", "T1", "cached"]
+    assert computed == instances[:1]
+    assert cache.get_or_compute(instances, "other", _compute) == ["T1", "T1", "T2"]
@@ -0,0 +1,269 @@
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+class JobStore():
+    """
+    Batch generation jobs and their per-instance results, in a local SQLite
+    file so that they survive a restart
+    """
+    def __init__(self, path):
+        """
+        Args:
+        path: str
+            Local path of the SQLite database. Created if it doesn't exist
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    client_id TEXT,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    n_total INTEGER NOT NULL,
+                    n_done INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    instances TEXT NOT NULL
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    result TEXT NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                )""")
+
+    def create(self, instances, client_id=None):
+        """
+        Args:
+        instances: [dict]
+            JSON-serializable instances to generate for
+
+        Returns:
+        job_id: str
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, client_id, status, created, updated, "
+                "n_total, instances) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, client_id, QUEUED, now, now, len(instances),
+                    json.dumps(instances))
+            )
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns:
+        job: dict
+            Keys "id", "client_id", "status", "created", "updated", "n_total",
+            "n_done" and "error". None if there is no such job
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, client_id, status, created, updated, n_total, "
+                "n_done, error FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        return None if row is None else dict(row)
+
+    def instances(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT instances FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return json.loads(row["instances"])
+
+    def results(self, job_id):
+        """
+        Returns:
+        results: {int: object}
+            Result of every instance done so far, by index
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, result FROM results WHERE job_id = ? ORDER BY idx",
+                (job_id,)
+            ).fetchall()
+        return {row["idx"]: json.loads(row["result"]) for row in rows}
+
+    def add_results(self, job_id, results):
+        """
+        Args:
+        results: {int: object}
+            JSON-serializable results, by instance index
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results (job_id, idx, result) "
+                "VALUES (?, ?, ?)",
+                [(job_id, idx, json.dumps(result)) for idx, result in results.items()]
+            )
+            self._conn.execute(
+                "UPDATE jobs SET n_done = (SELECT COUNT(*) FROM results "
+                "WHERE job_id = ?), updated = ? WHERE id = ?",
+                (job_id, time.time(), job_id)
+            )
+
+    def set_status(self, job_id, status, error=None, from_statuses=None):
+        """
+        Args:
+        from_statuses: [str]
+            Only change the status if it is currently one of these
+
+        Returns:
+        changed: bool
+        """
+        query = "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?"
+        params = [status, error, time.time(), job_id]
+        if from_statuses is not None:
+            query += f" AND status IN ({','.join('?' * len(from_statuses))})"
+            params += list(from_statuses)
+        with self._lock, self._conn:
+            return self._conn.execute(query, params).rowcount > 0
+
+    def unfinished(self):
+        """Ids of the queued and running jobs, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created",
+                (QUEUED, RUNNING)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+class JobRunner():
+    """
+    Runs the jobs of a JobStore in a background thread, one chunk of
+    instances at a time. Results are stored after every chunk, so a
+    restarted runner resumes unfinished jobs where they were left, and a
+    cancelled job stops after its current chunk.
+    """
+    def __init__(
+        self, store, process_fn, chunk_size=8, poll_interval_secs=1.0,
+        retryable_errors=(), retry_delay_secs=1.0, max_retry_delay_secs=60.0
+        ):
+        """
+        Args:
+        store: JobStore
+        process_fn: callable
+            Takes a list of instances and the job's client_id, and returns one
+            JSON-serializable result per instance
+        chunk_size: int
+            Instances processed between progress updates
+        poll_interval_secs: float
+            How often to look for new jobs when idle
+        retryable_errors: tuple of Exception types
+            Errors of process_fn that don't fail the job, e.g. a full queue.
+            The chunk is retried until it succeeds, waiting retry_delay_secs
+            before the first retry and twice as long before every next one,
+            up to max_retry_delay_secs. Other errors fail the job
+        """
+        self.store = store
+        self.process_fn = process_fn
+        self.chunk_size = chunk_size
+        self.poll_interval_secs = poll_interval_secs
+        self.retryable_errors = tuple(retryable_errors)
+        self.retry_delay_secs = retry_delay_secs
+        self.max_retry_delay_secs = max_retry_delay_secs
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name="job-runner", daemon=True)
+        self._worker.start()
+
+    def submit(self, instances, client_id=None):
+        """
+        Returns:
+        job_id: str
+        """
+        job_id = self.store.create(instances, client_id=client_id)
+        self._wakeup.set()
+        return job_id
+
+    def cancel(self, job_id):
+        """
+        Returns:
+        cancelled: bool
+            False if the job had already finished
+        """
+        return self.store.set_status(
+            job_id, CANCELLED, from_statuses=(QUEUED, RUNNING)
+        )
+
+    def stop(self):
+        """Stop after the current chunk. Unfinished jobs resume on restart"""
+        self._stopped = True
+        self._wakeup.set()
+        self._worker.join()
+
+    def _run(self):
+        while not self._stopped:
+            job_ids = self.store.unfinished()
+            if not job_ids:
+                self._wakeup.wait(self.poll_interval_secs)
+                self._wakeup.clear()
+                continue
+            self._run_job(job_ids[0])
+
+    def _run_job(self, job_id):
+        if not self.store.set_status(job_id, RUNNING, from_statuses=(QUEUED, RUNNING)):
+            return
+        job = self.store.get(job_id)
+        instances = self.store.instances(job_id)
+        done = self.store.results(job_id)
+        todo_idxs = [i for i in range(len(instances)) if i not in done]
+        try:
+            for start in range(0, len(todo_idxs), self.chunk_size):
+                if self._stopped or self.store.get(job_id)["status"] != RUNNING:
+                    return
+                chunk_idxs = todo_idxs[start:start + self.chunk_size]
+                results = self._process_chunk(
+                    job_id, [instances[i] for i in chunk_idxs], job["client_id"]
+                )
+                if results is None:
+                    return
+                self.store.add_results(job_id, dict(zip(chunk_idxs, results)))
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self.store.set_status(job_id, FAILED, error=str(e), from_statuses=(RUNNING,))
+            return
+        self.store.set_status(job_id, DONE, from_statuses=(RUNNING,))
+
+    def _process_chunk(self, job_id, instances, client_id):
+        """
+        Returns:
+        results: list
+            None if the runner stopped or the job was cancelled while waiting
+            to retry
+        """
+        delay_secs = self.retry_delay_secs
+        while True:
+            try:
+                return self.process_fn(instances, client_id)
+            except self.retryable_errors as e:
+                logger.warning(
+                    "Job %s: retrying a chunk in %.1fs (%s)", job_id, delay_secs, e
+                )
+            # Woken up early by stop(), or by new jobs
+            self._wakeup.wait(delay_secs)
+            self._wakeup.clear()
+            if self._stopped or self.store.get(job_id)["status"] != RUNNING:
+                return None
+            delay_secs = min(2 * delay_secs, self.max_retry_delay_secs)
@@ -0,0 +1,160 @@
+"""
+Load generator and latency benchmark for the advice servers (frontend/api.py, t5/run_server.py, ...), or for
+frontend/stub_server.py, which needs no TPUs.
+
+Example:
+python frontend/load_test.py -url http://127.0.0.1:5000/api/askbatch -questions data/redditadvice2019.jsonl \
+    -concurrency 4 -rate 0.5 -batch_size 2 -num_requests 50 -length_mix 500:0.5,2000:0.4,100000:0.1
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import time
+from collections import Counter
+
+import aiohttp
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-url', type=str, default='http://127.0.0.1:5000/api/askbatch', help='askbatch endpoint')
+parser.add_argument('-questions', type=str, required=True,
+                    help='jsonl file with title / selftext / subreddit fields, e.g. redditadvice2019.jsonl')
+parser.add_argument('-max_questions', type=int, default=10000, help='Only read this many questions')
+parser.add_argument('-concurrency', type=int, default=4, help='Max requests in flight')
+parser.add_argument('-rate', type=float, default=None,
+                    help='Requests per second, with Poisson arrivals. By default, each of the concurrency '
+                         'workers sends its next request as soon as the previous one is answered')
+parser.add_argument('-batch_size', type=int, default=1, help='Instances per request')
+parser.add_argument('-num_requests', type=int, default=100)
+parser.add_argument('-length_mix', type=str, default=None,
+                    help='Mix of selftext lengths, as max_chars:weight pairs, e.g. 500:0.5,2000:0.4,100000:0.1. '
+                         'Each instance draws a bucket by weight, then a question from that bucket. '
+                         'By default, questions are drawn uniformly')
+parser.add_argument('-timeout', type=float, default=12 * 60 * 60, help='Per-request timeout in seconds')
+parser.add_argument('-client_id', type=str, default='load_test', help='Sent as X-Client-Id')
+parser.add_argument('-out', type=str, default=None, help='Write one json line per request here')
+parser.add_argument('-seed', type=int, default=123456)
+
+
+def read_questions(path, max_questions):
+    questions = []
+    with open(path, 'r') as f:
+        for l in f:
+            item = json.loads(l)
+            questions.append({'title': item['title'], 'selftext': item['selftext'],
+                              'subreddit': item.get('subreddit', 'Advice')})
+            if len(questions) >= max_questions:
+                break
+    return questions
+
+
+class QuestionSampler(object):
+    """
+    Draws questions, optionally following a mix of selftext lengths
+    """
+
+    def __init__(self, questions, length_mix=None, rng=random):
+        """
+        :param questions: dicts with title / selftext / subreddit fields
+        :param length_mix: 'max_chars:weight,...' or None
+        :param rng: random.Random
+        """
+        self.rng = rng
+        if length_mix is None:
+            self.buckets = [questions]
+            self.weights = [1.0]
+            return
+        bounds_weights = sorted((int(b), float(w)) for b, w in (x.split(':') for x in length_mix.split(',')))
+        bounds = [b for b, _ in bounds_weights]
+        self.buckets = [[] for _ in bounds]
+        for question in questions:
+            i = bisect.bisect_left(bounds, len(question['selftext']))
+            if i < len(bounds):
+                self.buckets[i].append(question)
+        # Buckets without any question can't be drawn
+        self.weights = [w if bucket else 0.0 for (_, w), bucket in zip(bounds_weights, self.buckets)]
+        if sum(self.weights) == 0:
+            raise ValueError("No question fits in length_mix {}".format(length_mix))
+        for (bound, _), bucket in zip(bounds_weights, self.buckets):
+            print("{} questions with selftext <= {} chars".format(len(bucket), bound), flush=True)
+
+    def sample(self, n):
+        buckets = self.rng.choices(self.buckets, weights=self.weights, k=n)
+        return [self.rng.choice(bucket) for bucket in buckets]
+
+
+async def send_request(session, url, instances, client_id, timeout):
+    """
+    :return: dict with the status, latency and size of the request
+    """
+    start = time.monotonic()
+    try:
+        async with session.post(url, json={'instances': instances, 'target': 'advice'},
+                                headers={'X-Client-Id': client_id},
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            await resp.read()
+            status = resp.status
+    except asyncio.TimeoutError:
+        status = 'timeout'
+    except aiohttp.ClientError as e:
+        status = type(e).__name__
+    return {'start': start, 'latency': time.monotonic() - start, 'status': status,
+            'n_instances': len(instances),
+            'selftext_chars': sum(len(x['selftext']) for x in instances)}
+
+
+async def run_load(sampler, rng):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def _one_request():
+        async with semaphore:
+            results.append(await send_request(session, args.url, sampler.sample(args.batch_size),
+                                              args.client_id, args.timeout))
+            print("{}/{} requests done".format(len(results), args.num_requests), end='\r', flush=True)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency, force_close=False)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        for _ in range(args.num_requests):
+            tasks.append(asyncio.ensure_future(_one_request()))
+            if args.rate is not None:
+                await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    print(flush=True)
+    return results
+
+
+def summarize(results, wall_secs):
+    statuses = Counter(r['status'] for r in results)
+    ok = [r for r in results if r['status'] == 200]
+    print("Requests: {} in {:.1f}s, status counts: {}".format(len(results), wall_secs, dict(statuses)))
+    if not ok:
+        print("No successful requests")
+        return
+    latencies = np.array([r['latency'] for r in ok])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print("Latency of successful requests (s): mean={:.2f} p50={:.2f} p95={:.2f} p99={:.2f} max={:.2f}".format(
+        latencies.mean(), p50, p95, p99, latencies.max()))
+    print("Throughput: {:.3f} requests/s, {:.3f} instances/s".format(
+        len(ok) / wall_secs, sum(r['n_instances'] for r in ok) / wall_secs))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    sampler = QuestionSampler(read_questions(args.questions, args.max_questions), args.length_mix, rng=rng)
+
+    start = time.monotonic()
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run_load(sampler, rng))
+    loop.close()
+    wall_secs = time.monotonic() - start
+
+    summarize(results, wall_secs)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import atexit
+import socket
+import logging
+import threading
+
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+class AsyncLogSink():
+    """
+    Writes JSON records to size-capped .jsonl segments in log_dir from a
+    background thread, so that logging never blocks a request.
+
+    Object storage can't append to a file, so the current segment is kept in
+    memory and rewritten on every flush. Once it reaches max_segment_bytes a
+    new segment is started, which bounds the cost of each write. Segment names
+    include the host, process and start time, so several servers can share
+    log_dir.
+    """
+    def __init__(
+        self, log_dir, prefix="log", max_segment_bytes=4 * 1024 * 1024,
+        flush_interval_secs=10.0, max_pending_records=10000
+        ):
+        """
+        Args:
+        log_dir: str
+            Local or GCS directory for the segments
+        prefix: str
+            Prefix of the segment file names
+        max_segment_bytes: int
+            Size after which a segment is closed and a new one started
+        flush_interval_secs: float
+            Maximum time a record waits before it is written
+        max_pending_records: int
+            Records logged while this many are already waiting to be written
+            are dropped (and counted in n_dropped)
+        """
+        self.log_dir = log_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.flush_interval_secs = flush_interval_secs
+        self.max_pending_records = max_pending_records
+        self.n_dropped = 0
+        self._segment_prefix = "{}-{}-{}-{}".format(
+            prefix, socket.gethostname(), os.getpid(),
+            time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        )
+        self._segment_idx = 0
+        self._segment_lines = []
+        self._segment_bytes = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(
+            target=self._run, name="log-sink", daemon=True
+        )
+        self._worker.start()
+        atexit.register(self.close)
+
+    def log(self, record):
+        """
+        Queue a JSON-serializable record to be written. Never blocks on I/O
+        """
+        line = json.dumps(record) + "\n"
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Cannot log to a closed AsyncLogSink")
+            if len(self._pending) >= self.max_pending_records:
+                self.n_dropped += 1
+                return
+            self._pending.append(line)
+
+    def flush(self):
+        """Write the queued records now, from the calling thread"""
+        with self._cond:
+            lines, self._pending = self._pending, []
+        self._write(lines)
+
+    def close(self):
+        """Write the queued records and stop the background thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _write(self, lines):
+        if not lines:
+            return
+        with self._write_lock:
+            for line in lines:
+                if self._segment_lines \
+                    and self._segment_bytes + len(line) > self.max_segment_bytes:
+                    self._write_segment()
+                    self._segment_idx += 1
+                    self._segment_lines = []
+                    self._segment_bytes = 0
+                self._segment_lines.append(line)
+                self._segment_bytes += len(line)
+            self._write_segment()
+
+    def _write_segment(self):
+        path = os.path.join(
+            self.log_dir, f"{self._segment_prefix}-{self._segment_idx:05d}.jsonl"
+        )
+        try:
+            with tf.io.gfile.GFile(path, "w") as f:
+                f.write("".join(self._segment_lines))
+        except Exception:
+            logger.exception("Couldn't write log segment %s", path)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval_secs)
+                lines, self._pending = self._pending, []
+                closed = self._closed
+            self._write(lines)
+            if closed:
+                return
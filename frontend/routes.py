@@ -0,0 +1,191 @@
+"""
+The /api/askbatch, /api/jobs, /api/rerank and /metrics routes, shared by
+frontend/api.py (gevent) and frontend/api_werkzeug.py (threads)
+"""
+import re
+from datetime import datetime
+
+import flask
+
+from best_of_n.generator import RerankRequest
+from best_of_n.metrics import REGISTRY, STAGE_SECONDS
+from frontend.batching import QueueFullError
+from frontend.admission import AdmissionRejected
+from frontend.jobs import JobStore, JobRunner
+
+REQUESTS = REGISTRY.counter(
+    "askbatch_requests_total", "Requests to /api/askbatch, by HTTP status",
+    labelnames=("status",)
+)
+INSTANCES = REGISTRY.counter(
+    "askbatch_instances_total", "Instances received by /api/askbatch"
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "askbatch_request_seconds", "Wall time of /api/askbatch requests"
+)
+
+def _clean_advice(advice):
+    return re.sub(r'\s+»\s+', '\n\n', advice).strip()
+
+def _datetime_to_str(date):
+    return [
+        'January', 'February', 'March', 'April', 'May', 'June', 'July',
+        'August', 'September', 'October', 'November', 'December'
+        ][date.month - 1] + ' {}, {}'.format(date.day, date.year)
+
+def _client_id():
+    return flask.request.headers.get("X-Client-Id", flask.request.remote_addr)
+
+def _call(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+def add_routes(
+    app, batcher, admission, request_log, jobs_db_path, N, run_blocking=_call
+    ):
+    """
+    Args:
+    app: flask.Flask
+    batcher: frontend.batching.MicroBatcher
+        Batches instances and RerankRequests for
+        BestOfNGenerator.process_batch
+    admission: frontend.admission.AdmissionController
+    request_log: frontend.log_sink.AsyncLogSink
+        Where /api/askbatch requests and their advice are logged
+    jobs_db_path: str
+        The JobStore of /api/jobs. Every server needs its own
+    N: int
+        Samples per instance, the cost of an instance for admission
+    run_blocking: callable
+        Called as run_blocking(fn, *args, **kwargs) to wait for a batch, e.g.
+        in a threadpool so that an event loop keeps serving other requests
+
+    Returns:
+    job_runner: frontend.jobs.JobRunner
+    """
+    def _process_job_instances(instances, client_id):
+        # Job instances share batches with interactive requests, as one more
+        # client
+        return [
+            {"advice": _clean_advice(result["advice"]), "n_samples": result["n_samples"]}
+            for result in batcher.map(instances, client_id=client_id)
+        ]
+
+    job_runner = JobRunner(
+        JobStore(jobs_db_path),
+        _process_job_instances,
+        chunk_size=batcher.max_batch_size,
+        retryable_errors=(QueueFullError,)
+    )
+
+    @app.route('/api/askbatch', methods=['POST'])
+    def api_askbatch():
+        with REQUEST_SECONDS.time():
+            response = _askbatch(dict(flask.request.json))
+        REQUESTS.inc(status=response[1])
+        return response
+
+    def _askbatch(request_dict):
+        instances = request_dict["instances"]
+        client_id = _client_id()
+        INSTANCES.inc(len(instances))
+        date_str = _datetime_to_str(datetime.utcnow())
+        for instance in instances:
+            instance["date"] = date_str
+        try:
+            with admission.admit(client_id, len(instances) * N):
+                # Includes the time waiting for the batch to fill up
+                with STAGE_SECONDS.time(stage="batch"):
+                    results = run_blocking(
+                        batcher.map, instances, client_id=client_id
+                    )
+        except AdmissionRejected as e:
+            return flask.jsonify({"error": str(e)}), e.status, \
+                {"Retry-After": str(e.retry_after_secs)}
+        except QueueFullError as e:
+            return flask.jsonify({"error": str(e)}), 503
+        advices = [_clean_advice(result["advice"]) for result in results]
+        n_samples = [result["n_samples"] for result in results]
+        request_dict.update({"advices": advices, "n_samples": n_samples})
+        with STAGE_SECONDS.time(stage="log"):
+            request_log.log(request_dict)
+        return flask.jsonify({"gens": advices, "n_samples": n_samples}), 200
+
+    @app.route('/api/jobs', methods=['POST'])
+    def api_submit_job():
+        """
+        Queue a batch of instances, like /api/askbatch, and return its job id
+        right away. The job survives restarts
+        """
+        request_dict = dict(flask.request.json)
+        instances = request_dict["instances"]
+        date_str = _datetime_to_str(datetime.utcnow())
+        for instance in instances:
+            instance["date"] = date_str
+        job_id = job_runner.submit(instances, client_id="job:" + _client_id())
+        return flask.jsonify({"job_id": job_id}), 202
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def api_job_status(job_id):
+        """Status and progress (n_done out of n_total instances) of a job"""
+        job = job_runner.store.get(job_id)
+        if job is None:
+            return flask.jsonify({"error": f"No job {job_id}"}), 404
+        return flask.jsonify(job), 200
+
+    @app.route('/api/jobs/<job_id>/results', methods=['GET'])
+    def api_job_results(job_id):
+        """The advice generated so far, null for the instances not done yet"""
+        job = job_runner.store.get(job_id)
+        if job is None:
+            return flask.jsonify({"error": f"No job {job_id}"}), 404
+        results = job_runner.store.results(job_id)
+        return flask.jsonify({
+            "job": job,
+            "gens": [results[i]["advice"] if i in results else None for i in range(job["n_total"])],
+            "n_samples": [results[i]["n_samples"] if i in results else None for i in range(job["n_total"])]
+        }), 200
+
+    @app.route('/api/jobs/<job_id>', methods=['DELETE'])
+    def api_cancel_job(job_id):
+        """Cancel a job. Instances already done keep their results"""
+        if job_runner.store.get(job_id) is None:
+            return flask.jsonify({"error": f"No job {job_id}"}), 404
+        return flask.jsonify({"cancelled": job_runner.cancel(job_id)}), 200
+
+    @app.route('/api/rerank', methods=['POST'])
+    def api_rerank():
+        """
+        Score caller-supplied answers with the reward model, without sampling
+        any. Each instance has a "candidates" field with the answers to score
+        """
+        instances = dict(flask.request.json)["instances"]
+        date_str = _datetime_to_str(datetime.utcnow())
+        for instance in instances:
+            instance.setdefault("date", date_str)
+        client_id = _client_id()
+        n_candidates = sum(len(instance["candidates"]) for instance in instances)
+        try:
+            with admission.admit(client_id, n_candidates):
+                results = run_blocking(
+                    batcher.map,
+                    [RerankRequest(instance) for instance in instances],
+                    client_id=client_id
+                )
+        except AdmissionRejected as e:
+            return flask.jsonify({"error": str(e)}), e.status, \
+                {"Retry-After": str(e.retry_after_secs)}
+        except QueueFullError as e:
+            return flask.jsonify({"error": str(e)}), 503
+        return flask.jsonify({
+            "scores": [result["scores"] for result in results],
+            "best": [result["best"] for result in results]
+        }), 200
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Stage latencies and counters, in the Prometheus text format"""
+        return flask.Response(
+            REGISTRY.render(), mimetype="text/plain; version=0.0.4"
+        )
+
+    return job_runner
@@ -0,0 +1,107 @@
+"""
+A stand-in for frontend/api.py that needs no TPUs (nor TensorFlow): best-of-N generation is replaced by a sleep
+proportional to the number of tokens T5 would sample and the reward model would score. Batching, admission control,
+caching and metrics are the real ones, so frontend/load_test.py can benchmark the serving stack on a laptop.
+
+python frontend/stub_server.py -N 16 -sample_secs_per_token 0.0005
+"""
+import argparse
+import re
+import time
+from datetime import datetime
+
+import flask
+
+from frontend.batching import MicroBatcher, QueueFullError
+from frontend.admission import AdmissionController, AdmissionRejected
+from frontend.cache import ResponseCache
+from best_of_n.metrics import REGISTRY, STAGE_SECONDS, CANDIDATES_GENERATED, CANDIDATES_SCORED
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-port', type=int, default=5000)
+parser.add_argument('-N', type=int, default=80, help='Samples per question')
+parser.add_argument('-answer_tokens', type=int, default=150, help='Tokens in every sampled answer')
+parser.add_argument('-max_input_tokens', type=int, default=1280, help='Questions are truncated to this many tokens')
+parser.add_argument('-sample_secs_per_token', type=float, default=0.0002,
+                    help='Seconds T5 takes per sampled token, amortized over its batch')
+parser.add_argument('-score_secs_per_token', type=float, default=0.00002,
+                    help='Seconds the reward model takes per (question + answer) token')
+parser.add_argument('-max_batch_size', type=int, default=8)
+parser.add_argument('-max_batch_delay', type=float, default=1.0)
+parser.add_argument('-max_queue_size', type=int, default=256)
+parser.add_argument('-max_client_share', type=float, default=0.75)
+parser.add_argument('-cache_size', type=int, default=0, help='0 to disable the response cache')
+
+
+def _n_tokens(text):
+    # About 4 characters per sentencepiece token for English text
+    return max(1, len(text) // 4)
+
+
+class StubBestOfNGenerator(object):
+    """
+    Has the interface of BestOfNGenerator.best_of_n_from_instances, and takes as long as the token counts say
+    """
+
+    def __init__(self, N, answer_tokens, max_input_tokens, sample_secs_per_token, score_secs_per_token):
+        self.N = N
+        self.answer_tokens = answer_tokens
+        self.max_input_tokens = max_input_tokens
+        self.sample_secs_per_token = sample_secs_per_token
+        self.score_secs_per_token = score_secs_per_token
+
+    def best_of_n_from_instances(self, instances):
+        input_tokens = [min(_n_tokens(x['title']) + _n_tokens(x['selftext']), self.max_input_tokens)
+                        for x in instances]
+        with STAGE_SECONDS.time(stage='sample'):
+            time.sleep(len(instances) * self.N * self.answer_tokens * self.sample_secs_per_token)
+        CANDIDATES_GENERATED.inc(len(instances) * self.N)
+        with STAGE_SECONDS.time(stage='score'):
+            time.sleep(sum(self.N * (n + self.answer_tokens) * self.score_secs_per_token for n in input_tokens))
+        CANDIDATES_SCORED.inc(len(instances) * self.N)
+        return [{'advice': 'Stub advice for "{}"'.format(x['title']), 'n_samples': self.N} for x in instances]
+
+
+args = parser.parse_args()
+generator = StubBestOfNGenerator(N=args.N, answer_tokens=args.answer_tokens, max_input_tokens=args.max_input_tokens,
+                                 sample_secs_per_token=args.sample_secs_per_token,
+                                 score_secs_per_token=args.score_secs_per_token)
+cache = ResponseCache(max_entries=args.cache_size) if args.cache_size > 0 else None
+batcher = MicroBatcher(generator.best_of_n_from_instances, max_batch_size=args.max_batch_size,
+                       max_delay_secs=args.max_batch_delay, max_queue_size=args.max_queue_size)
+admission = AdmissionController(max_in_flight_cost=args.max_queue_size * args.N,
+                                max_client_share=args.max_client_share)
+model_id = 'stub:N={}'.format(args.N)
+
+app = flask.Flask(__name__)
+
+
+@app.route('/api/askbatch', methods=['POST'])
+def api_askbatch():
+    instances = dict(flask.request.json)['instances']
+    date_str = datetime.utcnow().strftime('%Y-%m-%d')
+    for instance in instances:
+        instance['date'] = date_str
+    client_id = flask.request.headers.get('X-Client-Id', flask.request.remote_addr)
+    try:
+        with admission.admit(client_id, len(instances) * args.N):
+            def _map(xs):
+                return batcher.map(xs, client_id=client_id)
+            results = _map(instances) if cache is None else cache.get_or_compute(instances, model_id, _map)
+    except AdmissionRejected as e:
+        return flask.jsonify({'error': str(e)}), e.status, {'Retry-After': str(e.retry_after_secs)}
+    except QueueFullError as e:
+        return flask.jsonify({'error': str(e)}), 503
+    return flask.jsonify({
+        'gens': [re.sub(r'\s+»\s+', '\n\n', r['advice']).strip() for r in results],
+        'n_samples': [r['n_samples'] for r in results],
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return flask.Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
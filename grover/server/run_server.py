@@ -9,6 +9,16 @@ parser.add_argument('-gpu', type=int, default=0)
 parser.add_argument('-size', type=str, default="mega")
 parser.add_argument('-tag', type=str, default="")
 parser.add_argument('-batch_size', type=int, default=1)
+parser.add_argument('-max_batch_delay', type=float, default=0.5,
+                    help='Max seconds an instance waits for a batch to fill up with instances from other requests')
+parser.add_argument('-max_queue_size', type=int, default=256,
+                    help='Max number of instances waiting to be decoded')
+parser.add_argument('-cache_size', type=int, default=10000,
+                    help='Max number of generations kept in the response cache')
+parser.add_argument('-cache_ttl', type=float, default=None,
+                    help='Seconds after which a cached generation expires. Never by default')
+parser.add_argument('-cache_dir', type=str, default=None,
+                    help='Local directory to keep the response cache in across restarts')
 
 args = parser.parse_args()
 GPUID = args.gpu
@@ -24,11 +34,16 @@ import sys
 
 sys.path.append('../../')
 from grover.lm.modeling import GroverConfig, sample_seq2seq
-from data.encoder import get_encoder, extract_generated_target, _tokenize_reddit_post_pieces, trim_paragraphs
+from data.encoder import get_encoder, extract_generated_target, _tokenize_reddit_posts_pieces, trim_paragraphs
 from data.tfrecord_utils import batch_index_iterator
+from frontend.batching import MicroBatcher, QueueFullError
+from frontend.cache import ResponseCache
 import logging
+import functools
+import threading
 from datetime import datetime
 import click
+import gevent
 from gevent.pywsgi import WSGIServer
 import numpy as np
 import pandas as pd
@@ -43,23 +58,39 @@ encoder = get_encoder()
 news_config = GroverConfig.from_json_file(f'../lm/configs/{SIZE}.json')
 batch_size = args.batch_size
 top_p = 0.94
+TARGET_TO_FIELD = {'subreddit': 'domain', 'date': 'date', 'title': 'title', 'selftext': 'article', 'advice': 'summary'}
 
-def _prepare_instance(instance, date, target='advice'):
+def _prepare_instances(instances, date, target='advice'):
     """
-    Process each instance
-    :param instance:
+    Process several instances, tokenizing all of them at once
+    :param instances:
     :param target:
     :return:
     """
-    if 'subreddit' not in instance:
-        instance['subreddit'] = 'Advice'
+    for instance in instances:
+        if 'subreddit' not in instance:
+            instance['subreddit'] = 'Advice'
 
     # Tokenize into pieces
-    pieces = _tokenize_reddit_post_pieces(encoder, subreddit=instance['subreddit'], date=date,
-                                          title=instance['title'],
-                                          selftext=instance['selftext'] if target in ('selftext', 'advice') else '',
-                                          max_date_length=5, max_subreddit_length=5, max_title_length=80,
-                                          max_selftext_length=6000)
+    all_pieces = _tokenize_reddit_posts_pieces(
+        encoder, [{'subreddit': instance['subreddit'], 'date': date, 'title': instance['title'],
+                   'selftext': instance['selftext'] if target in ('selftext', 'advice') else ''}
+                  for instance in instances],
+        max_lengths={'date': 5, 'subreddit': 5, 'title': 80, 'selftext': 6000})
+    return [_prepare_instance(instance, date, target=target, pieces=pieces)
+            for instance, pieces in zip(instances, all_pieces)]
+
+
+def _prepare_instance(instance, date, target='advice', pieces=None):
+    """
+    Process each instance
+    :param instance:
+    :param target:
+    :param pieces: the instance, already tokenized by _prepare_instances
+    :return:
+    """
+    if pieces is None:
+        return _prepare_instances([instance], date, target=target)[0]
     # If too long, keep trimming the selftext
     while sum([len(x) for x in pieces]) > 1280:
         instance['selftext'] = trim_paragraphs(instance['selftext'], num2del=1)
@@ -125,6 +156,69 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph
     # create a server endpoint to answer requests
     print("READY FOR GENERATION", flush=True)
 
+    def _generate_batch(instances, target):
+        """
+        Decode a batch of prepared instances, which must all have the same target
+        :param instances: dicts with fields context_formatted and eos_token
+        :param target: what to generate
+        :return: the generated target for every instance
+        """
+        eos_token_val = instances[0]['eos_token']
+        # Indices we definitely DONT WANT TO PREDICT
+        ignore_ids_np = np.array(encoder.special_tokens_onehot)
+        ignore_ids_np[eos_token_val] = 0
+
+        things_to_process = pd.DataFrame({'context_formatted': [x['context_formatted'] for x in instances]})
+        things_to_process['ind'] = np.arange(len(instances))
+        things_to_process['len'] = things_to_process['context_formatted'].apply(lambda x: len(x))
+        things_to_process['out'] = ''
+        things_to_process.sort_values(by='len', ascending=False, inplace=True)
+
+        for b_start, b_end in batch_index_iterator(things_to_process.shape[0], batch_size=args.batch_size,
+                                                   skip_end=False):
+            these_ctx = things_to_process['context_formatted'].iloc[b_start:b_end].tolist()
+
+            ctx_array = np.zeros((args.batch_size, max([len(x) for x in these_ctx])), dtype=np.int32) + encoder.padding
+            for i, ctx_i in enumerate(these_ctx):
+                ctx_array[i, :len(ctx_i)] = ctx_i
+
+            out = sess.run(tokens, feed_dict={initial_context: ctx_array,
+                                              eos_token: eos_token_val,
+                                              ignore_ids: ignore_ids_np})
+            for i, out_i in enumerate(out[:(b_end-b_start)]):
+                out_decoded = extract_generated_target(
+                    output_tokens=out_i, encoder=encoder, target=TARGET_TO_FIELD[target])['extraction'].strip()
+                things_to_process.at[things_to_process.iloc[b_start + i].name, 'out'] = out_decoded
+
+        # Sort back
+        things_to_process.sort_values(by='ind', ascending=True, inplace=True)
+        return things_to_process['out'].tolist()
+
+    # One batcher per target, so that concurrent requests share sampling batches
+    batchers = {}
+    batchers_lock = threading.Lock()
+    gevent.get_hub().threadpool.maxsize = args.max_queue_size
+    response_cache = ResponseCache(max_entries=args.cache_size, ttl_secs=args.cache_ttl, disk_dir=args.cache_dir)
+
+    def generate(instances, target='advice'):
+        """
+        Queue prepared instances to be decoded with those of concurrent requests. Only blocks the calling greenlet.
+        :param instances: outputs of _prepare_instance
+        :param target: what to generate
+        :return: the generated target for every instance
+        """
+        items = [{'context_formatted': x.pop('context_formatted'), 'eos_token': x.pop('eos_token')}
+                 for x in instances]
+        with batchers_lock:
+            if target not in batchers:
+                batchers[target] = MicroBatcher(functools.partial(_generate_batch, target=target),
+                                                max_batch_size=args.batch_size,
+                                                max_delay_secs=args.max_batch_delay,
+                                                max_queue_size=args.max_queue_size,
+                                                name='batcher-{}'.format(target))
+            batcher = batchers[target]
+        return gevent.get_hub().threadpool.apply(batcher.map, (items,))
+
 
     @app.route('/', methods=['GET'])
     def form_ask():
@@ -146,21 +240,10 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph
                 'gen': 'error',
             }), 200
 
-        eos_token_val = instance.pop('eos_token')
-        context_formatted = instance.pop('context_formatted')
-
-        # Indices we definitely DONT WANT TO PREDICT
-        ignore_ids_np = np.array(encoder.special_tokens_onehot)
-        ignore_ids_np[eos_token_val] = 0
-
-        out = sess.run(tokens, feed_dict={initial_context: np.stack([context_formatted]*batch_size),
-                                          eos_token: eos_token_val,
-                                          ignore_ids: ignore_ids_np})
-
-        out_decoded = extract_generated_target(
-            output_tokens=out[0], encoder=encoder,
-            target={'subreddit': 'domain', 'date': 'date',
-                    'title': 'title', 'selftext': 'article', 'advice': 'summary'}[target])['extraction'].strip()
+        try:
+            out_decoded = generate([instance], target=target)[0]
+        except QueueFullError as e:
+            return flask.jsonify({'error': str(e)}), 503
         print("SENDING BACK {}".format(out_decoded), flush=True)
 
         new_instance = {k: v for k, v in instance.items()}
@@ -188,45 +271,23 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph
         target = orig_instance.get('target', 'advice')
         date = datetime.utcnow()
 
-        instances = [_prepare_instance(x, date=date, target=target) for x in orig_instance.pop('instances')]
-        if any(x is None for x in instances):
+        if target not in TARGET_TO_FIELD:
             return flask.jsonify({
                 'gens': 'error',
             }), 200
 
-        eos_token_val = [x.pop('eos_token') for x in instances][0]
-        ignore_ids_np = np.array(encoder.special_tokens_onehot)
-        ignore_ids_np[eos_token_val] = 0
-
-        things_to_process = pd.DataFrame(instances)
-        things_to_process['ind'] = np.arange(len(instances))
-        things_to_process['len'] = things_to_process['context_formatted'].apply(lambda x: len(x))
-        things_to_process['out'] = ''
-        things_to_process.sort_values(by='len', ascending=False, inplace=True)
-
-        for b_start, b_end in batch_index_iterator(things_to_process.shape[0], batch_size=args.batch_size,
-                                                   skip_end=False):
-            these_ctx = things_to_process['context_formatted'].iloc[b_start:b_end].tolist()
-
-            ctx_array = np.zeros((args.batch_size, max([len(x) for x in these_ctx])), dtype=np.int32) + encoder.padding
-            for i, ctx_i in enumerate(these_ctx):
-                ctx_array[i, :len(ctx_i)] = ctx_i
-
-            out = sess.run(tokens, feed_dict={initial_context: ctx_array,
-                                              eos_token: eos_token_val,
-                                              ignore_ids: ignore_ids_np})
-            for i, out_i in enumerate(out[:(b_end-b_start)]):
-                # item = things_to_process.iloc[b_start + i]
-                out_decoded = extract_generated_target(
-                    output_tokens=out_i, encoder=encoder,
-                    target={'subreddit': 'domain', 'date': 'date',
-                            'title': 'title', 'selftext': 'article', 'advice': 'summary'}[target])['extraction'].strip()
-                things_to_process.at[things_to_process.iloc[b_start + i].name, 'out'] = out_decoded
+        def _prepare_and_generate(raw_instances):
+            return generate(_prepare_instances(raw_instances, date=date, target=target), target=target)
 
-        # Sort back
-        things_to_process.sort_values(by='ind', ascending=True, inplace=True)
+        # Only instances that weren't already answered today are generated
+        model_id = 'grover-{}{}:target={}:p={}'.format(SIZE, TAG, target, top_p)
+        keyed_instances = [dict(x, date=date.strftime('%Y-%m-%d')) for x in orig_instance.pop('instances')]
+        try:
+            gens = response_cache.get_or_compute(keyed_instances, model_id, _prepare_and_generate)
+        except QueueFullError as e:
+            return flask.jsonify({'error': str(e)}), 503
         return flask.jsonify({
-            'gens': things_to_process['out'].tolist(),
+            'gens': gens,
         }), 200
 
 
@@ -9,7 +9,7 @@ from datetime import datetime
 from contextlib import ExitStack
 
 from data.assertions import question_is_valid, answer_is_valid, answer_pair_is_valid
-from data.to_tfrecord_t5 import encoder, _trim_to_desired_length, _fix_reddit_text
+from data.to_tfrecord_t5 import encoder, _trim_to_desired_length, _fix_reddit_texts
 from reward.comparative.data import SELFTEXT_DESIRED_LEN, LOCAL_TSV_PATH, SPLITS
 
 META_OUT_PATH = os.path.join(os.path.dirname(LOCAL_TSV_PATH), "meta.json")
@@ -76,21 +76,22 @@ def to_tsv_line(question, ans1, ans2):
     # Sort the answers by score
     if ans1["score"] > ans2["score"]:
         ans1, ans2 = ans2, ans1
-    inputs = "Subreddit: {} Date: {} Title: {} Selftext: {}".format(
-        _fix_reddit_text(question["subreddit"]),
-        _fix_reddit_text(str_date),
-        _fix_reddit_text(question["title"]),
-        _fix_reddit_text(_trim_to_desired_length(
+    subreddit, date, title, selftext, body1, body2 = _fix_reddit_texts([
+        question["subreddit"],
+        str_date,
+        question["title"],
+        _trim_to_desired_length(
             encoder,
             question["selftext"],
             desired_len=SELFTEXT_DESIRED_LEN
-        ))
-    )
-    return "\t".join([
-        inputs,
-        _fix_reddit_text(ans1["body"]),
-        _fix_reddit_text(ans2["body"])
+        ),
+        ans1["body"],
+        ans2["body"]
     ])
+    inputs = "Subreddit: {} Date: {} Title: {} Selftext: {}".format(
+        subreddit, date, title, selftext
+    )
+    return "\t".join([inputs, body1, body2])
 
 if __name__ == "__main__":
     FLAGS = _define_flags()
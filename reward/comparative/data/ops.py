@@ -155,8 +155,28 @@ def get_prediction_dataset(tsv_path, batch_size=1):
     tsv_dataset = tsv_dataset.map(
         lambda *x: {c: x[i] for i, c in enumerate(PREDICTION_TSV_COLNAMES)}
     )
+    return _batch_prediction_dataset(tsv_dataset, batch_size)
+
+def _batch_prediction_dataset(str_dataset, batch_size):
+    """
+    Tokenize, pad and batch a dataset of {"inputs": str, "targets": str}
+    """
+    padded_dataset = tokenize_prediction_dataset(str_dataset)
+    batched_dataset = padded_dataset.batch(batch_size, drop_remainder=False)
+    batched_dataset = batched_dataset.map(
+        lambda d: {
+            k: tf.pad(v, paddings=[[0, batch_size - tf.shape(v)[0]], [0, 0]])
+            for k, v in d.items()
+        }
+    )
+    return batched_dataset
+
+def tokenize_prediction_dataset(str_dataset):
+    """
+    Tokenize and pad an unbatched dataset of {"inputs": str, "targets": str}
+    """
     tokens_dataset = encode_string_features(
-        dataset=tsv_dataset,
+        dataset=str_dataset,
         vocabulary=TOKENIZER,   
         copy_plaintext=False,
         keys=PREDICTION_TSV_COLNAMES
@@ -171,14 +191,30 @@ def get_prediction_dataset(tsv_path, batch_size=1):
         dataset=unpadded_dataset,
         length=_sequence_length
     )
-    batched_dataset = padded_dataset.batch(batch_size, drop_remainder=False)
-    batched_dataset = batched_dataset.map(
-        lambda d: {
-            k: tf.pad(v, paddings=[[0, batch_size - tf.shape(v)[0]], [0, 0]])
-            for k, v in d.items()
-        }
+    return padded_dataset
+
+def tokenize_grouped_prediction_dataset(str_dataset, group_size):
+    """
+    Tokenize and pad an unbatched dataset of
+    {"inputs": str, "targets": [group_size] str}, i.e. several answers to one
+    question. Every answer is padded to SEQUENCE_LENGTH["targets"] and then
+    the answers are concatenated, like answer pairs for training
+    """
+    pairs_dataset = str_dataset.flat_map(
+        lambda sample: tf.data.Dataset.from_tensor_slices({
+            "inputs": tf.fill([group_size], sample["inputs"]),
+            "targets": sample["targets"]
+        })
     )
-    return batched_dataset
+    grouped_length = group_size * SEQUENCE_LENGTH["targets"]
+    def _concat_targets(samples):
+        return {
+            k: tf.reshape(v, [grouped_length]) if k.startswith("targets") else v[0]
+            for k, v in samples.items()
+        }
+    return tokenize_prediction_dataset(pairs_dataset) \
+        .batch(group_size, drop_remainder=True) \
+        .map(_concat_targets)
 
 def _add_position_and_segmentation(sample):
     """
@@ -1,9 +1,11 @@
 import os
+import functools
 from reward.comparative.data.ops import SEQUENCE_LENGTH
 from tqdm import tqdm
 from copy import deepcopy
 
 import gin
+import numpy as np
 import tensorflow.compat.v1 as tf
 import mesh_tensorflow
 from mesh_tensorflow.transformer import utils
@@ -13,36 +15,51 @@ from reward.comparative.mtf_extensions import\
   make_reward_bitransformer, _tpu_estimator_model_fn
 from t5.data import get_mixture_or_task
 from t5.models.mtf_model import \
-  MtfModel, _get_latest_checkpoint_from_dir, _operative_config_path
+  MtfModel, WarmPredictLoop, _GRAPH_BUILD_LOCK, \
+  _get_latest_checkpoint_from_dir, _operative_config_path
 from reward.comparative.data import \
-  get_dataset, get_prediction_dataset, get_checkpoint_paths
+  get_dataset, get_prediction_dataset, tokenize_prediction_dataset, \
+  tokenize_grouped_prediction_dataset, get_checkpoint_paths
 from reward.comparative.mtf_extensions import \
-  make_reward_bitransformer, _tpu_estimator_model_fn, _predict_reward_fn
+  make_reward_bitransformer, _tpu_estimator_model_fn, _predict_reward_fn, \
+  _predict_grouped_reward_fn
 
 REDDIT_TASK_NAME = "reddit_v002"
 
 class ComparativeRewardModel(MtfModel):
-  def __init__(self, *args, **kwargs):
+  def __init__(self, *args, group_size=None, **kwargs):
+    """
+    Args:
+    group_size: int
+      If given, predictions score up to this many answers to the same
+      question together, running the encoder once for all of them. Each
+      example then holds group_size answers, so this multiplies the memory
+      taken by the decoder
+    """
     super(ComparativeRewardModel, self).__init__(*args, **kwargs)
     self._predict_fn = _predict_reward_fn
+    self._group_size = group_size
 
   def with_custom_mtf(function):
     """
     Execute function with monkey-patched Mesh-Tensorflow, then restore before
-    returning.
+    returning. Holds the graph build lock meanwhile, so that other models
+    don't build their graphs with the patched functions.
     """
     def monkey_patch_wrapper(*args, **kwargs):
-      make_bitransformer = mesh_tensorflow.transformer.transformer.make_bitransformer
-      tpu_estimator_model_fn = mesh_tensorflow.transformer.utils.tpu_estimator_model_fn
-      # Monkey-patch Mesh-Tensorflow
-      mesh_tensorflow.transformer.transformer.make_bitransformer = make_reward_bitransformer
-      mesh_tensorflow.transformer.utils.tpu_estimator_model_fn = _tpu_estimator_model_fn
-      # Execute function
-      result = function(*args, **kwargs)
-      # Restore Mesh-Tensorflow
-      mesh_tensorflow.transformer.transformer.make_bitransformer = make_bitransformer
-      mesh_tensorflow.transformer.utils.tpu_estimator_model_fn = tpu_estimator_model_fn
-      return result
+      with _GRAPH_BUILD_LOCK:
+        make_bitransformer = mesh_tensorflow.transformer.transformer.make_bitransformer
+        tpu_estimator_model_fn = mesh_tensorflow.transformer.utils.tpu_estimator_model_fn
+        # Monkey-patch Mesh-Tensorflow
+        mesh_tensorflow.transformer.transformer.make_bitransformer = make_reward_bitransformer
+        mesh_tensorflow.transformer.utils.tpu_estimator_model_fn = _tpu_estimator_model_fn
+        try:
+          # Execute function
+          return function(*args, **kwargs)
+        finally:
+          # Restore Mesh-Tensorflow
+          mesh_tensorflow.transformer.transformer.make_bitransformer = make_bitransformer
+          mesh_tensorflow.transformer.utils.tpu_estimator_model_fn = tpu_estimator_model_fn
     return monkey_patch_wrapper
 
   @with_custom_mtf
@@ -159,17 +176,52 @@ class ComparativeRewardModel(MtfModel):
       init_checkpoint=os.path.join(pretrained_model_dir, model_ckpt)
     )
   
-  @with_custom_mtf
-  def predict_from_file(self, input_path, output_path, checkpoint_steps=-1):
+  def predict_from_file(
+    self, input_path, output_path, checkpoint_steps=-1, chunk_size=1024,
+    in_memory=False
+    ):
     """
     Args:
     input_file: str
       Path to a tab-separated text file with columns [inputs, targets]
+    chunk_size: int
+      Number of lines to read and score at a time, if in_memory
+    in_memory: bool
+      Whether to score the file in chunks with predict_from_strings, keeping
+      the checkpoint in memory for later calls. Experimental on a TPU (see
+      t5.models.mtf_model.WarmPredictLoop). Otherwise the estimator reads the
+      file itself, and the last batch is padded, so output_path can have a
+      few more lines than input_path. Scoring groups of answers (group_size)
+      needs in_memory
     """
+    if not in_memory:
+      self._predict_from_file(input_path, output_path, checkpoint_steps)
+      return
+    predictor = self._get_predictor(checkpoint_steps)
+    if tf.io.gfile.exists(output_path):
+      tf.io.gfile.remove(output_path)
+    with tf.io.gfile.GFile(input_path, "r") as input_file, \
+      tf.io.gfile.GFile(output_path, "w") as output_file:
+      def _write_rewards(chunk):
+        inputs, targets = zip(*chunk)
+        for reward in predictor.predict(inputs, targets):
+          output_file.write(str(reward) + "\n")
+      chunk = []
+      for line in input_file:
+        chunk.append(line.rstrip("\n").split("\t"))
+        if len(chunk) >= chunk_size:
+          _write_rewards(chunk)
+          chunk = []
+      if chunk:
+        _write_rewards(chunk)
+
+  @with_custom_mtf
+  def _predict_from_file(self, input_path, output_path, checkpoint_steps):
+    if self._group_size is not None:
+      raise ValueError("Scoring groups of answers needs in_memory=True")
     if checkpoint_steps == -1:
       checkpoint_steps = _get_latest_checkpoint_from_dir(self._model_dir)
-    with gin.unlock_config():
-      gin.parse_config_file(_operative_config_path(self._model_dir))
+    self._parse_operative_config()
     vocabulary = get_mixture_or_task(REDDIT_TASK_NAME).get_vocabulary()
     estimator = self.estimator(vocabulary, sequence_length=SEQUENCE_LENGTH)
     def _input_fn(params):
@@ -191,7 +243,92 @@ class ComparativeRewardModel(MtfModel):
         else:
           output_file.write(str(predictions["outputs"]) + "\n")
 
-  def estimator(self, vocabulary, init_checkpoint=None, sequence_length=None):
+  def predict_from_strings(self, inputs, targets, checkpoint_steps=-1):
+    """
+    In-memory version of predict_from_file. The checkpoint is restored on the
+    first call, and kept in memory for later calls with the same
+    checkpoint_steps.
+
+    Args:
+    inputs: [str]
+      T5-formatted questions
+    targets: [str]
+      Answers to score, one per element of inputs
+
+    Returns:
+    rewards: np.array
+      Float array with one reward per (input, target) pair
+    """
+    return self._get_predictor(checkpoint_steps).predict(inputs, targets)
+
+  @with_custom_mtf
+  def predictor(self, checkpoint_steps=-1):
+    """
+    Returns a RewardPredictor that keeps the checkpoint weights in memory
+    """
+    if checkpoint_steps == -1:
+      checkpoint_steps = _get_latest_checkpoint_from_dir(self._model_dir)
+    self._parse_operative_config()
+    vocabulary = get_mixture_or_task(REDDIT_TASK_NAME).get_vocabulary()
+    checkpoint_path = f"{self._model_dir}/model.ckpt-{checkpoint_steps}"
+    if self._group_size is None:
+      loop = WarmPredictLoop(
+        estimator=self.estimator(vocabulary, sequence_length=SEQUENCE_LENGTH),
+        checkpoint_path=checkpoint_path,
+        batch_size=self.batch_size,
+        output_types={"inputs": tf.string, "targets": tf.string},
+        output_shapes={
+          "inputs": tf.TensorShape([]),
+          "targets": tf.TensorShape([])
+        },
+        dataset_fn=tokenize_prediction_dataset,
+        # Other models may have parsed their own config in the meantime
+        before_first_run=self._parse_operative_config,
+        queue_feed=self._predict_queue_feed
+      )
+      return RewardPredictor(loop)
+    loop = WarmPredictLoop(
+      estimator=self.estimator(
+        vocabulary,
+        sequence_length={
+          "inputs": SEQUENCE_LENGTH["inputs"],
+          "targets": SEQUENCE_LENGTH["targets"] * self._group_size
+        },
+        predict_fn=functools.partial(
+          _predict_grouped_reward_fn, group_size=self._group_size
+        )
+      ),
+      checkpoint_path=checkpoint_path,
+      batch_size=self.batch_size,
+      output_types={"inputs": tf.string, "targets": tf.string},
+      output_shapes={
+        "inputs": tf.TensorShape([]),
+        "targets": tf.TensorShape([self._group_size])
+      },
+      dataset_fn=functools.partial(
+        tokenize_grouped_prediction_dataset, group_size=self._group_size
+      ),
+      before_first_run=self._parse_operative_config,
+      queue_feed=self._predict_queue_feed
+    )
+    return RewardPredictor(loop, group_size=self._group_size)
+
+  def _get_predictor(self, checkpoint_steps):
+    if checkpoint_steps == -1:
+      checkpoint_steps = _get_latest_checkpoint_from_dir(self._model_dir)
+    with self._predictors_lock:
+      if checkpoint_steps not in self._predictors:
+        self._predictors[checkpoint_steps] = self.predictor(checkpoint_steps)
+      return self._predictors[checkpoint_steps]
+
+  def _parse_operative_config(self):
+    with gin.unlock_config():
+      gin.parse_config_file(_operative_config_path(self._model_dir))
+
+  def estimator(
+    self, vocabulary, init_checkpoint=None, sequence_length=None,
+    predict_fn=None
+    ):
     """
     A version of MtfModel.estimator which also accepts the `sequence_length`
     parameter.
@@ -210,11 +347,70 @@ class ComparativeRewardModel(MtfModel):
         keep_checkpoint_max=self._keep_checkpoint_max,
         save_checkpoints_steps=self._save_checkpoints_steps,
         optimizer=self._optimizer,
-        predict_fn=self._predict_fn,
+        predict_fn=predict_fn or self._predict_fn,
         variable_filter=self._variable_filter,
         ensemble_inputs=self._ensemble_inputs,
         use_tpu=self._tpu,
         tpu_job_name=self._tpu_job_name,
         iterations_per_loop=self._iterations_per_loop,
         cluster=self._cluster,
-        init_checkpoint=init_checkpoint)
\ No newline at end of file
+        init_checkpoint=init_checkpoint)
+
+class RewardPredictor():
+  """
+  Scores (question, answer) pairs, restoring the checkpoint weights only once
+  """
+  def __init__(self, loop, group_size=None):
+    """
+    Args:
+    loop: t5.models.mtf_model.WarmPredictLoop
+    group_size: int
+      If given, loop scores examples of one question and group_size answers
+      (see ComparativeRewardModel)
+    """
+    self._loop = loop
+    self._group_size = group_size
+
+  def predict(self, inputs, targets):
+    """
+    Args:
+    inputs: [str]
+      T5-formatted questions
+    targets: [str]
+      Answers to score, one per element of inputs
+
+    Returns:
+    rewards: np.array
+      Float array with one reward per (input, target) pair
+    """
+    assert len(inputs) == len(targets), "Need one target per input"
+    if self._group_size is not None:
+      return self._predict_grouped(list(zip(inputs, targets)))
+    predictions = self._loop.predict(
+      {"inputs": i, "targets": t} for i, t in zip(inputs, targets)
+    )
+    return np.array([p["outputs"] for p in predictions], dtype=np.float32)
+
+  def _predict_grouped(self, pairs):
+    # Answers to the same question are scored together, group_size at a time.
+    # Groups that come up short are padded with copies of their last answer
+    pair_idxs_by_input = {}
+    for pair_idx, (input_, _) in enumerate(pairs):
+      pair_idxs_by_input.setdefault(input_, []).append(pair_idx)
+    groups = []
+    for input_, pair_idxs in pair_idxs_by_input.items():
+      for start in range(0, len(pair_idxs), self._group_size):
+        group_pair_idxs = pair_idxs[start:start + self._group_size]
+        targets = [pairs[i][1] for i in group_pair_idxs]
+        targets += [targets[-1]] * (self._group_size - len(targets))
+        groups.append((input_, targets, group_pair_idxs))
+    predictions = self._loop.predict(
+      {"inputs": input_, "targets": targets} for input_, targets, _ in groups
+    )
+    rewards = np.zeros(len(pairs), dtype=np.float32)
+    for (_, _, group_pair_idxs), p in zip(groups, predictions):
+      rewards[group_pair_idxs] = p["outputs"][:len(group_pair_idxs)]
+    return rewards
+
+  def close(self):
+    self._loop.close()
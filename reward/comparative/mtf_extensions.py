@@ -242,6 +242,76 @@ def _predict_reward_fn(model, features, variable_dtype):
     **position_kwargs
   )[0]
 
+def _predict_grouped_reward_fn(model, features, variable_dtype, group_size):
+  """
+  Like _predict_reward_fn, for features whose targets are group_size answers
+  to the same question, concatenated along the length dimension (see
+  tokenize_grouped_prediction_dataset). The encoder runs once per question,
+  and its output is broadcast to the decoder passes of all answers.
+
+  Returns:
+  rewards: mtf.Tensor
+    Shape [batch, candidates], one reward per answer
+  """
+  inputs = features["inputs"]
+  batch_dim = inputs.shape.dims[0]
+  candidates_dim = mtf.Dimension("candidates", group_size)
+  def _add_candidates_dim(x):
+    return mtf.broadcast(
+      x, mtf.Shape([batch_dim, candidates_dim] + x.shape.dims[1:])
+    )
+  def _split_candidates(x):
+    return mtf.stack(
+      [
+        mtf.slice(
+          x,
+          begin=SEQUENCE_LENGTH["targets"] * i,
+          size=SEQUENCE_LENGTH["targets"],
+          slice_dim_name="length",
+          name="split_candidates"
+        )
+        for i in range(group_size)
+      ],
+      dim_name=candidates_dim.name,
+      axis=1
+    )
+  shared_params = model._shared_params(inputs.mesh, variable_dtype)
+  encoder_sequence_id = features.get("inputs_segmentation", None)
+  if encoder_sequence_id is None:
+    encoder_sequence_id = mtf.minimum(inputs, 1)
+  encoder_output, _ = model.encoder.call_simple(
+    inputs=inputs,
+    targets=None,
+    compute_loss=False,
+    mode=tf.estimator.ModeKeys.PREDICT,
+    variable_dtype=variable_dtype,
+    sequence_id=encoder_sequence_id,
+    position=features.get("inputs_position", None),
+    shared_params=shared_params
+  )
+  targets = _split_candidates(features["targets"])
+  decoder_position = features.get("targets_position", None)
+  return model.decoder.call_simple(
+    inputs=mtf.shift_targets(targets),
+    targets=targets,
+    compute_loss=False,
+    mode=tf.estimator.ModeKeys.PREDICT,
+    variable_dtype=variable_dtype,
+    sequence_id=_split_candidates(features["targets_segmentation"]),
+    position=None if decoder_position is None \
+      else _split_candidates(decoder_position),
+    encoder_output=_add_candidates_dim(
+      mtf.layers.rename_length_to_memory_length(encoder_output)
+    ),
+    encoder_sequence_id=_add_candidates_dim(
+      mtf.layers.rename_length_to_memory_length(encoder_sequence_id)
+    ),
+    encoder_inputs=_add_candidates_dim(
+      mtf.layers.rename_length_to_memory_length(inputs)
+    ),
+    shared_params=shared_params
+  )[0]
+
 import re
 import six
 from tensorflow.python.ops import resources
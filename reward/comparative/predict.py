@@ -58,6 +58,18 @@ def _define_flags():
         default=1280 * 2,
         help="How many tokens of input can each model replica handle?"
     )
+    flags.DEFINE_integer(
+        name="group_size",
+        default=None,
+        help="Score up to this many answers to the same question together, "
+            "encoding the question only once"
+    )
+    flags.DEFINE_boolean(
+        name="in_memory",
+        default=False,
+        help="Score the file in chunks, through a predictor that keeps the "
+            "checkpoint in memory. Needed with group_size. Experimental on TPUs"
+    )
     flags.DEFINE_boolean(
         name="compute_mean",
         default=False,
@@ -87,12 +99,15 @@ def main(_):
         model_parallelism=FLAGS.model_parallelism,
         batch_size=FLAGS.batch_size,
         sequence_length=SEQUENCE_LENGTH,
-        iterations_per_loop=FLAGS.iterations_per_loop
+        iterations_per_loop=FLAGS.iterations_per_loop,
+        group_size=FLAGS.group_size,
+        predict_queue_feed=FLAGS.in_memory
     )
     model.predict_from_file(
         input_path=FLAGS.input_path,
         output_path=FLAGS.output_path,
-        checkpoint_steps=FLAGS.checkpoint_steps
+        checkpoint_steps=FLAGS.checkpoint_steps,
+        in_memory=FLAGS.in_memory
     )
     if FLAGS.compute_mean:
         score_sum = 0
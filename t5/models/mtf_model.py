@@ -19,10 +19,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import functools
 
 import os
 import re
+import threading
+import uuid
 import gin
 import gin.tf
 
@@ -37,6 +40,8 @@ from t5.models.mesh_transformer import mesh_eval_dataset_fn
 from t5.models.mesh_transformer import mesh_train_dataset_fn
 from t5.models.t5_model import T5Model
 
+import numpy as np
+from six.moves import queue
 import tensorflow.compat.v1 as tf
 
 
@@ -62,6 +67,485 @@ def _operative_config_path(model_dir):
   return os.path.join(model_dir, "operative_config.gin")
 
 
+def sample_n_predict_fn(model, features, variable_dtype, num_samples,
+                        decode_length, temperature=1.0,
+                        sampling_keep_top_p=1.0):
+  """Encodes every input once and samples num_samples outputs from it.
+
+  Can be passed (with functools.partial) as the predict_fn of a Bitransformer
+  estimator. The encoder output is broadcast over a new "samples" dimension,
+  so only the decoder runs num_samples times.
+
+  Args:
+    model: a Bitransformer.
+    features: a dict of mtf.Tensor with shape [batch_dim, length_dim].
+    variable_dtype: an mtf.VariableDType.
+    num_samples: int, number of outputs to sample per input.
+    decode_length: int, maximum length of the sampled outputs.
+    temperature: float, sampling temperature.
+    sampling_keep_top_p: float, nucleus sampling threshold.
+
+  Returns:
+    an int32 mtf.Tensor with shape [batch_dim, samples_dim, length_dim].
+  """
+  inputs = features["inputs"]
+  batch_dim = inputs.shape.dims[0]
+  samples_dim = mtf.Dimension("samples", num_samples)
+
+  def _add_samples_dim(x):
+    return mtf.broadcast(
+        x, mtf.Shape([batch_dim, samples_dim] + x.shape.dims[1:]))
+
+  shared_params = model._shared_params(inputs.mesh, variable_dtype)
+  encoder_sequence_id = mtf.minimum(inputs, 1)
+  encoder_layer_outputs = []
+  encoder_output, _ = model.encoder.call_simple(
+      inputs=inputs,
+      targets=None,
+      compute_loss=False,
+      mode=tf.estimator.ModeKeys.PREDICT,
+      variable_dtype=variable_dtype,
+      sequence_id=encoder_sequence_id,
+      shared_params=shared_params,
+      layer_outputs=encoder_layer_outputs)
+  partial_sequences = mtf.zeros(
+      inputs.mesh,
+      mtf.Shape([batch_dim, samples_dim,
+                 mtf.Dimension("length", decode_length)]),
+      dtype=tf.int32)
+  return model.decoder.sample_autoregressive(
+      partial_sequences,
+      temperature=temperature,
+      sampling_keep_top_p=sampling_keep_top_p,
+      variable_dtype=variable_dtype,
+      encoder_output=_add_samples_dim(
+          mtf.layers.rename_length_to_memory_length(encoder_output)),
+      encoder_sequence_id=_add_samples_dim(
+          mtf.layers.rename_length_to_memory_length(encoder_sequence_id)),
+      encoder_inputs=_add_samples_dim(
+          mtf.layers.rename_length_to_memory_length(inputs)),
+      shared_params=shared_params,
+      has_partial_sequences=False,
+      encoder_layer_outputs=[
+          _add_samples_dim(x) for x in encoder_layer_outputs])
+
+
+# Graphs are built from global gin state, so loops build them one at a time,
+# even when different threads predict with different models. Reentrant, so
+# that code holding it while it patches globals can still build graphs
+_GRAPH_BUILD_LOCK = threading.RLock()
+
+# A TPU runs one session at a time: initializing the TPU system for a new
+# session wipes the state of the others. Loops restoring the same checkpoint
+# (e.g. with different decoding parameters) take turns on a master, and the
+# loop holding its session is closed before another one starts. Loops of
+# different checkpoints would restore both checkpoints on every turn, so they
+# need masters of their own.
+_MASTER_LOCKS_LOCK = threading.Lock()
+_MASTER_LOCKS = {}
+_MASTER_OWNERS = {}
+
+
+def _master_lock(master):
+  if not master:
+    return threading.Lock()
+  with _MASTER_LOCKS_LOCK:
+    return _MASTER_LOCKS.setdefault(master, threading.Lock())
+
+
+class _GeneratorFeed(object):
+  """Feeds examples to an input pipeline that runs in this process."""
+
+  def __init__(self, output_types, output_shapes):
+    self._output_types = output_types
+    self._output_shapes = output_shapes
+    self._examples = queue.Queue()
+
+  def dataset(self):
+    def _generator():
+      while True:
+        example = self._examples.get()
+        if example is None:
+          return
+        yield example
+
+    return tf.data.Dataset.from_generator(
+        _generator, self._output_types, self._output_shapes)
+
+  def put(self, examples):
+    for example in examples:
+      self._examples.put(example)
+
+  def close(self):
+    self._examples.put(None)
+
+
+class _QueueFeed(object):
+  """Feeds examples through a queue on a TensorFlow server.
+
+  Dataset.from_generator runs Python in a py_func, so it can only run in this
+  process. Here the input pipeline dequeues from a FIFOQueue on the server
+  (e.g. the host of a remote TPU), and examples are enqueued from a separate
+  session sharing the queue by name.
+  """
+
+  def __init__(self, master, device, session_config, output_types,
+               output_shapes):
+    self._master = master
+    self._device = device
+    self._output_types = output_types
+    self._output_shapes = output_shapes
+    self._shared_name = "warm_predict_loop_{}".format(uuid.uuid4().hex)
+    self._dtypes = tf.nest.flatten(output_types)
+    self._shapes = [tf.TensorShape(shape)
+                    for shape in tf.nest.flatten(output_shapes)]
+    self._names = ["component_{}".format(i) for i in range(len(self._dtypes))]
+    graph = tf.Graph()
+    with graph.as_default():
+      examples_queue = self._queue()
+      self._placeholders = [
+          tf.placeholder(dtype, [None] + shape.as_list())
+          for dtype, shape in zip(self._dtypes, self._shapes)]
+      self._enqueue = examples_queue.enqueue_many(
+          dict(zip(self._names, self._placeholders)))
+      self._close = examples_queue.close()
+    self._session = tf.Session(master, graph=graph, config=session_config)
+
+  def _queue(self):
+    with tf.device(self._device):
+      # Unbounded, since examples are enqueued before their predictions are
+      # requested
+      return tf.queue.FIFOQueue(
+          capacity=-1, dtypes=self._dtypes, shapes=self._shapes,
+          names=self._names, shared_name=self._shared_name)
+
+  def dataset(self):
+    examples_queue = self._queue()
+
+    def _dequeue(_):
+      components = examples_queue.dequeue()
+      return tf.nest.pack_sequence_as(
+          self._output_types, [components[name] for name in self._names])
+
+    # Dequeuing from the closed queue ends the dataset
+    return tf.data.Dataset.from_tensors(0).repeat().map(_dequeue)
+
+  def put(self, examples):
+    components = list(zip(*[tf.nest.flatten(example) for example in examples]))
+    self._session.run(self._enqueue, feed_dict={
+        placeholder: np.array(values, dtype=dtype.as_numpy_dtype)
+        for placeholder, values, dtype in zip(
+            self._placeholders, components, self._dtypes)})
+
+  def close(self):
+    try:
+      self._session.run(self._close)
+    finally:
+      self._session.close()
+
+
+class WarmPredictLoop(object):
+  """Keeps an Estimator.predict generator open across calls.
+
+  Estimator.predict builds the graph and restores the checkpoint when the first
+  prediction is requested, and keeps its session alive for as long as the
+  input_fn keeps producing examples. Feeding the input_fn from a queue lets us
+  restore the checkpoint once and then predict many times.
+
+  Loops of the same checkpoint on the same TPU take turns: when another one
+  predicts on it, this loop's session is closed, and the checkpoint is restored
+  again on its next prediction. Loops of another checkpoint can't use the
+  TPU while this one is open.
+
+  Examples are fed from a Python generator, which only runs in this process.
+  On a remote TPU, they can be fed through a queue on the TPU host instead
+  (queue_feed). That path hasn't been run on TPU hardware yet, so serve from
+  files with MtfModel.predict until it has.
+  """
+
+  def __init__(self, estimator, checkpoint_path, batch_size, output_types,
+               output_shapes, dataset_fn=None, before_first_run=None,
+               queue_feed=False):
+    """Constructor for WarmPredictLoop class.
+
+    Args:
+      estimator: a tf.estimator.Estimator (or TPUEstimator).
+      checkpoint_path: str, the checkpoint to restore.
+      batch_size: int, the global batch size of the estimator.
+      output_types: nested structure of tf.DType, the types of one example.
+      output_shapes: nested structure of tf.TensorShape, the shapes of one
+        example.
+      dataset_fn: an optional function mapping the unbatched dataset of raw
+        examples to the unbatched dataset the model expects, e.g. to tokenize.
+      before_first_run: an optional function to call right before the graph is
+        built, e.g. to bind gin parameters.
+      queue_feed: bool, whether to feed examples through a queue on the master
+        rather than a generator. Needed on a remote master. Experimental.
+
+    Raises:
+      ValueError: if the master is remote and queue_feed is False.
+    """
+    if estimator.config.master and not queue_feed:
+      raise ValueError(
+          "Cannot feed a WarmPredictLoop on {} from a generator. Pass "
+          "queue_feed=True (experimental), or predict from files.".format(
+              estimator.config.master))
+    self._estimator = estimator
+    self._checkpoint_path = checkpoint_path
+    self._batch_size = batch_size
+    self._output_types = output_types
+    self._output_shapes = output_shapes
+    self._dataset_fn = dataset_fn
+    self._before_first_run = before_first_run
+    self._master = estimator.config.master
+    self._master_lock = _master_lock(self._master)
+    self._lock = threading.Lock()
+    self._feed = None
+    self._predictions = None
+    self._started = False
+    self._closed = False
+
+  def predict(self, examples):
+    """Runs the model on a list of examples.
+
+    Args:
+      examples: list of examples matching output_types and output_shapes.
+
+    Returns:
+      a list with one prediction dict per example.
+    """
+    examples = list(examples)
+    if not examples:
+      return []
+    # Pad the last batch with copies of the last example
+    num_padding = -len(examples) % self._batch_size
+    padded_examples = examples + [examples[-1]] * num_padding
+    with self._master_lock, self._lock:
+      if self._closed:
+        raise ValueError("Cannot predict with a closed WarmPredictLoop.")
+      if self._predictions is None:
+        self._start()
+      self._feed.put(padded_examples)
+      if self._started:
+        predictions = [next(self._predictions) for _ in padded_examples]
+      else:
+        with _GRAPH_BUILD_LOCK:
+          if self._before_first_run is not None:
+            self._before_first_run()
+          self._started = True
+          # The graph is built when the first prediction is requested
+          predictions = [next(self._predictions)]
+        predictions += [next(self._predictions) for _ in padded_examples[1:]]
+    return predictions[:len(examples)]
+
+  def close(self):
+    """Ends the input pipeline and releases the estimator session."""
+    with self._master_lock, self._lock:
+      self._closed = True
+      self._stop()
+
+  def _start(self):
+    # Called with the master lock held
+    owner = _MASTER_OWNERS.get(self._master)
+    if owner is not None and owner is not self:
+      if owner._checkpoint_path != self._checkpoint_path:
+        raise ValueError(
+            "{} is predicting with {}, can't restore {} on it as well. Use a "
+            "separate TPU for every model.".format(
+                self._master, owner._checkpoint_path, self._checkpoint_path))
+      with owner._lock:
+        owner._stop()
+    if self._master:
+      _MASTER_OWNERS[self._master] = self
+      tpu_job_name = getattr(
+          getattr(self._estimator.config, "tpu_config", None),
+          "tpu_job_name", None)
+      self._feed = _QueueFeed(
+          self._master,
+          "/job:{}/task:0/device:CPU:0".format(tpu_job_name or "worker"),
+          self._estimator.config.session_config, self._output_types,
+          self._output_shapes)
+    else:
+      self._feed = _GeneratorFeed(self._output_types, self._output_shapes)
+
+    def input_fn(params):
+      # Per-host batch size, for estimators with an input pipeline per host
+      batch_size = (params or {}).get("batch_size", self._batch_size)
+      if self._master and batch_size != self._batch_size:
+        raise ValueError(
+            "The queue feed only supports a single input pipeline, got a "
+            "per-host batch size of {} out of {}.".format(
+                batch_size, self._batch_size))
+      dataset = self._feed.dataset()
+      if self._dataset_fn is not None:
+        dataset = self._dataset_fn(dataset)
+      return dataset.batch(batch_size, drop_remainder=True)
+
+    self._predictions = self._estimator.predict(
+        input_fn=input_fn, checkpoint_path=self._checkpoint_path)
+    self._started = False
+
+  def _stop(self):
+    # Called with the master lock and self._lock held
+    if self._predictions is None:
+      return
+    try:
+      self._feed.close()
+    finally:
+      self._predictions.close()
+      self._feed = None
+      self._predictions = None
+      if _MASTER_OWNERS.get(self._master) is self:
+        del _MASTER_OWNERS[self._master]
+
+
+class MtfPredictor(object):
+  """Decodes batches of strings, restoring the checkpoint weights only once.
+
+  Decoding parameters are baked into the graph, so one WarmPredictLoop is kept
+  per (beam_size, temperature, sampling_keep_top_p, samples_per_example)
+  configuration. At most
+  `max_sampling_configs` loops are kept alive; the least recently used one is
+  closed when a new configuration is requested.
+  """
+
+  def __init__(self, model, checkpoint_steps=-1,
+               sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
+               max_sampling_configs=2):
+    """Constructor for MtfPredictor class.
+
+    Args:
+      model: an MtfModel.
+      checkpoint_steps: int, the checkpoint to restore. If -1, get the latest
+        checkpoint from the model directory.
+      sentencepiece_model_path: str, path to the SentencePiece model file to use
+        for decoding. Must match the one used during training.
+      max_sampling_configs: int, maximum number of decoding configurations to
+        keep warm at the same time.
+    """
+    if checkpoint_steps == -1:
+      checkpoint_steps = _get_latest_checkpoint_from_dir(model._model_dir)
+    self._model = model
+    self._checkpoint_path = os.path.join(
+        model._model_dir, "model.ckpt-{}".format(checkpoint_steps))
+    self._vocabulary = t5.data.SentencePieceVocabulary(sentencepiece_model_path)
+    self._max_sampling_configs = max_sampling_configs
+    self._loops = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def predict(self, inputs, beam_size=1, temperature=1.0,
+              sampling_keep_top_p=1.0):
+    """Predicts targets from a list of input strings.
+
+    Args:
+      inputs: list of str, input prompts to predict from.
+      beam_size: int, a number >= 1 specifying the number of beams to use for
+        beam search.
+      temperature: float, a value between 0 and 1 (must be 0 if beam_size > 1)
+        0.0 means argmax, 1.0 means sample according to predicted distribution.
+      sampling_keep_top_p: float, nucleus sampling threshold.
+
+    Returns:
+      a list of str, one decoded prediction per input.
+    """
+    if not inputs:
+      return []
+    loop = self._get_loop((beam_size, temperature, sampling_keep_top_p, None))
+    predictions = loop.predict(
+        {"inputs": ids} for ids in self._encode_inputs(inputs))
+    return [self._decode_outputs(p["outputs"]) for p in predictions]
+
+  def predict_samples(self, inputs, num_samples, samples_per_example=None,
+                      temperature=1.0, sampling_keep_top_p=1.0):
+    """Samples several targets per input string, encoding each input once.
+
+    Args:
+      inputs: list of str, input prompts to predict from.
+      num_samples: int, number of targets to sample per input.
+      samples_per_example: int, number of targets sampled from one encoding of
+        an input. The decoder batch is samples_per_example times the model's
+        batch size, so lower it if that doesn't fit in memory. Defaults to
+        num_samples. Inputs are encoded ceil(num_samples / samples_per_example)
+        times, and surplus samples dropped, so that calls with different
+        num_samples share one decoding graph.
+      temperature: float, sampling temperature.
+      sampling_keep_top_p: float, nucleus sampling threshold.
+
+    Returns:
+      a list with one list of num_samples str per input.
+    """
+    if not inputs:
+      return []
+    samples_per_example = samples_per_example or num_samples
+    loop = self._get_loop(
+        (1, temperature, sampling_keep_top_p, samples_per_example))
+    input_ids = self._encode_inputs(inputs)
+    samples = [[] for _ in input_ids]
+    for _ in range(-(-num_samples // samples_per_example)):
+      predictions = loop.predict({"inputs": ids} for ids in input_ids)
+      for input_samples, p in zip(samples, predictions):
+        input_samples.extend(self._decode_outputs(x) for x in p["outputs"])
+    return [input_samples[:num_samples] for input_samples in samples]
+
+  def close(self):
+    with self._lock:
+      while self._loops:
+        _, loop = self._loops.popitem()
+        loop.close()
+
+  def _get_loop(self, sampling_config):
+    with self._lock:
+      if sampling_config in self._loops:
+        self._loops.move_to_end(sampling_config)
+        return self._loops[sampling_config]
+      while len(self._loops) >= self._max_sampling_configs:
+        _, stale_loop = self._loops.popitem(last=False)
+        stale_loop.close()
+      (beam_size, temperature, sampling_keep_top_p,
+       samples_per_example) = sampling_config
+      if samples_per_example is None:
+        predict_fn = None
+      else:
+        predict_fn = functools.partial(
+            sample_n_predict_fn,
+            num_samples=samples_per_example,
+            decode_length=self._model._sequence_length["targets"],
+            temperature=temperature,
+            sampling_keep_top_p=sampling_keep_top_p)
+      sequence_length = self._model._sequence_length["inputs"]
+      bind_decode_parameters = functools.partial(
+          self._model._bind_decode_parameters, beam_size, temperature,
+          sampling_keep_top_p)
+      # The estimator reads the model parameters from gin when it is built, so
+      # the operative config must be parsed first. The decode parameters are
+      # bound again when the graph is built, in case another loop has rebound
+      # them since.
+      with _GRAPH_BUILD_LOCK:
+        bind_decode_parameters()
+        estimator = self._model.estimator(
+            self._vocabulary, predict_fn=predict_fn)
+      loop = WarmPredictLoop(
+          estimator=estimator,
+          checkpoint_path=self._checkpoint_path,
+          batch_size=self._model.batch_size,
+          output_types={"inputs": tf.int32},
+          output_shapes={"inputs": tf.TensorShape([sequence_length])},
+          before_first_run=bind_decode_parameters,
+          queue_feed=self._model._predict_queue_feed)
+      self._loops[sampling_config] = loop
+      return loop
+
+  def _encode_inputs(self, inputs):
+    return utils.encode_inputs(
+        list(inputs), self._vocabulary, self._model._model_type, 1,
+        self._model._sequence_length["inputs"])
+
+  def _decode_outputs(self, output_ids):
+    targets_vocabulary = utils.targets_vocabulary(self._vocabulary)
+    return targets_vocabulary.decode([int(x) for x in utils.clean_decodes(
+        list(output_ids), targets_vocabulary.vocab_size)])
+
+
 @gin.configurable
 class MtfModel(T5Model):
   """Wrapper class for Mesh-TF models."""
@@ -87,7 +571,8 @@ class MtfModel(T5Model):
       predict_fn=None,
       variable_filter=None,
       ensemble_inputs=None,
-      iterations_per_loop=100):
+      iterations_per_loop=100,
+      predict_queue_feed=False):
     """Constructor for MtfModel class.
 
     Args:
@@ -124,6 +609,10 @@ class MtfModel(T5Model):
         matches this regex. If None (default), train all trainable variables.
       ensemble_inputs: an integer, see `train_model` docstring for details.
       iterations_per_loop: integer, steps per train loop
+      predict_queue_feed: bool, whether predict_from_strings and
+        sample_from_strings feed a remote TPU through a queue on its host (see
+        WarmPredictLoop). Experimental, it hasn't been run on TPU hardware yet.
+        They only run on local devices otherwise.
     """
 
     mesh_shape = utils.tpu_mesh_shape(tpu_topology, model_parallelism)
@@ -160,6 +649,9 @@ class MtfModel(T5Model):
     self._tpu = tpu
     self._tpu_job_name = tpu_job_name
     self._estimator = None
+    self._predict_queue_feed = predict_queue_feed
+    self._predictors = {}
+    self._predictors_lock = threading.Lock()
 
     # Must be called after _sequence_length, _mesh_shape, and _layout_rules are
     # set.
@@ -178,7 +670,15 @@ class MtfModel(T5Model):
     else:
       self._batch_size = batch_size
 
-  def estimator(self, vocabulary, init_checkpoint=None):
+  def estimator(self, vocabulary, init_checkpoint=None, predict_fn=None):
+    """Returns a TPUEstimator for this model.
+
+    Args:
+      vocabulary: a t5.data.Vocabulary.
+      init_checkpoint: an optional checkpoint path to initialize from.
+      predict_fn: an optional function overriding the predict_fn passed to the
+        constructor, see its docstring.
+    """
     return utils.get_estimator(
         model_type=self._model_type,
         input_vocab_size=utils.inputs_vocabulary(vocabulary).vocab_size,
@@ -193,7 +693,7 @@ class MtfModel(T5Model):
         keep_checkpoint_max=self._keep_checkpoint_max,
         save_checkpoints_steps=self._save_checkpoints_steps,
         optimizer=self._optimizer,
-        predict_fn=self._predict_fn,
+        predict_fn=predict_fn or self._predict_fn,
         variable_filter=self._variable_filter,
         ensemble_inputs=self._ensemble_inputs,
         use_tpu=self._tpu,
@@ -299,19 +799,13 @@ class MtfModel(T5Model):
       sentencepiece_model_path: str, path to the SentencePiece model file to use
         for decoding. Must match the one used during training.
     """
-    # TODO(sharannarang) : It would be nice to have a function like
-    # load_checkpoint that loads the model once and then call decode_from_file
-    # multiple times without having to restore the checkpoint weights again.
-    # This would be particularly useful in colab demo.
+    # To restore the checkpoint weights only once across many calls, use
+    # predictor() instead.
 
     if checkpoint_steps == -1:
       checkpoint_steps = _get_latest_checkpoint_from_dir(self._model_dir)
 
-    with gin.unlock_config():
-      gin.parse_config_file(_operative_config_path(self._model_dir))
-      gin.bind_parameter("Bitransformer.decode.beam_size", beam_size)
-      gin.bind_parameter("Bitransformer.decode.temperature", temperature)
-      gin.bind_parameter("Bitransformer.decode.sampling_keep_top_p", sampling_keep_top_p)
+    self._bind_decode_parameters(beam_size, temperature, sampling_keep_top_p)
 
 
     vocabulary = t5.data.SentencePieceVocabulary(sentencepiece_model_path)
@@ -320,6 +814,98 @@ class MtfModel(T5Model):
                       self._model_type, self._model_dir, checkpoint_steps,
                       input_file, output_file)
 
+  def predict_from_strings(self, inputs, checkpoint_steps=-1, beam_size=1,
+                           temperature=1.0,
+                           sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
+                           sampling_keep_top_p=1.0):
+    """Predicts targets from a list of input strings, without touching disk.
+
+    The checkpoint is restored on the first call, and kept in memory for later
+    calls with the same checkpoint_steps and sentencepiece_model_path.
+
+    Args:
+      inputs: list of str, input prompts to predict from.
+      checkpoint_steps: int, the checkpoint to restore. If -1, get the latest
+        checkpoint from the model directory.
+      beam_size: int, a number >= 1 specifying the number of beams to use for
+        beam search.
+      temperature: float, a value between 0 and 1 (must be 0 if beam_size > 1)
+        0.0 means argmax, 1.0 means sample according to predicted distribution.
+      sentencepiece_model_path: str, path to the SentencePiece model file to use
+        for decoding. Must match the one used during training.
+      sampling_keep_top_p: float, nucleus sampling threshold.
+
+    Returns:
+      a list of str, one decoded prediction per input.
+    """
+    return self._get_predictor(
+        checkpoint_steps, sentencepiece_model_path).predict(
+            inputs, beam_size=beam_size, temperature=temperature,
+            sampling_keep_top_p=sampling_keep_top_p)
+
+  def sample_from_strings(self, inputs, num_samples, checkpoint_steps=-1,
+                          samples_per_example=None, temperature=1.0,
+                          sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
+                          sampling_keep_top_p=1.0):
+    """Samples num_samples targets per input string, without touching disk.
+
+    Unlike calling predict_from_strings with every input repeated num_samples
+    times, every input is encoded only once per samples_per_example samples.
+    The checkpoint is kept in memory as in predict_from_strings.
+
+    Args:
+      inputs: list of str, input prompts to predict from.
+      num_samples: int, number of targets to sample per input.
+      checkpoint_steps: int, the checkpoint to restore. If -1, get the latest
+        checkpoint from the model directory.
+      samples_per_example: int, see MtfPredictor.predict_samples.
+      temperature: float, sampling temperature.
+      sentencepiece_model_path: str, path to the SentencePiece model file to use
+        for decoding. Must match the one used during training.
+      sampling_keep_top_p: float, nucleus sampling threshold.
+
+    Returns:
+      a list with one list of num_samples str per input.
+    """
+    return self._get_predictor(
+        checkpoint_steps, sentencepiece_model_path).predict_samples(
+            inputs, num_samples, samples_per_example=samples_per_example,
+            temperature=temperature, sampling_keep_top_p=sampling_keep_top_p)
+
+  def _get_predictor(self, checkpoint_steps, sentencepiece_model_path):
+    if checkpoint_steps == -1:
+      checkpoint_steps = _get_latest_checkpoint_from_dir(self._model_dir)
+    predictor_key = (checkpoint_steps, sentencepiece_model_path)
+    with self._predictors_lock:
+      if predictor_key not in self._predictors:
+        self._predictors[predictor_key] = self.predictor(
+            checkpoint_steps, sentencepiece_model_path)
+      return self._predictors[predictor_key]
+
+  def predictor(self, checkpoint_steps=-1,
+                sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
+                max_sampling_configs=2):
+    """Returns an MtfPredictor that keeps the checkpoint weights in memory.
+
+    Args:
+      checkpoint_steps: int, the checkpoint to restore. If -1, get the latest
+        checkpoint from the model directory.
+      sentencepiece_model_path: str, path to the SentencePiece model file to use
+        for decoding. Must match the one used during training.
+      max_sampling_configs: int, maximum number of decoding configurations to
+        keep warm at the same time.
+    """
+    return MtfPredictor(self, checkpoint_steps, sentencepiece_model_path,
+                        max_sampling_configs)
+
+  def _bind_decode_parameters(self, beam_size, temperature,
+                              sampling_keep_top_p):
+    with gin.unlock_config():
+      gin.parse_config_file(_operative_config_path(self._model_dir))
+      gin.bind_parameter("Bitransformer.decode.beam_size", beam_size)
+      gin.bind_parameter("Bitransformer.decode.temperature", temperature)
+      gin.bind_parameter("Bitransformer.decode.sampling_keep_top_p", sampling_keep_top_p)
+
   def export(self, export_dir=None, checkpoint_step=-1, beam_size=1,
              temperature=1.0,
              sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH):
@@ -9,15 +9,41 @@ import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-size', type=str, default="small")
+parser.add_argument('-max_batch_size', type=int, default=8,
+                    help='Max number of instances from concurrent requests to decode together')
+parser.add_argument('-max_batch_delay', type=float, default=1.0,
+                    help='Max seconds an instance waits for its batch to fill up')
+parser.add_argument('-max_queue_size', type=int, default=256,
+                    help='Max number of instances waiting to be decoded')
+parser.add_argument('-tmp_dir', type=str, default=None,
+                    help='Where each prediction job gets its own scratch directory. Defaults to the checkpoint dir')
+parser.add_argument('-max_in_flight', type=int, default=None,
+                    help='Max number of instances being decoded or queued before requests get 503s. '
+                         'Defaults to max_queue_size')
+parser.add_argument('-max_client_share', type=float, default=0.75,
+                    help='Max fraction of max_in_flight a client (X-Client-Id header or address) can fill')
+parser.add_argument('-cache_size', type=int, default=10000,
+                    help='Max number of advices kept in the response cache')
+parser.add_argument('-cache_ttl', type=float, default=None,
+                    help='Seconds after which a cached advice expires. Never by default')
+parser.add_argument('-cache_dir', type=str, default=None,
+                    help='Local directory to keep the response cache in across restarts')
 args = parser.parse_args()
 
 
 sys.path.insert(0, '../')
 import logging
+import functools
+import threading
 from datetime import datetime
 import click
+import gevent
 from gevent.pywsgi import WSGIServer
-from data.to_tfrecord_t5 import _fix_reddit_text, _trim_to_desired_length, encoder
+from data.to_tfrecord_t5 import _fix_reddit_texts, _trim_to_desired_length, encoder
+from frontend.batching import MicroBatcher, QueueFullError
+from frontend.admission import AdmissionController, AdmissionRejected
+from frontend.cache import ResponseCache
+from best_of_n.scratch import ScratchNamespace
 import t5
 import re
 
@@ -61,9 +87,6 @@ def load_estimator_and_predict_items(items, date, model_size):
         sequence_length={"inputs": 1280, "targets": 512},
     )
 
-    tmp_input_path = os.path.join(os.path.dirname(ckpt_path), 'tmp_input.txt')
-    tmp_output_path = os.path.join(os.path.dirname(ckpt_path), 'tmp_output.txt')
-
     ctxs = []
     for item in items:
         date_txt = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
@@ -75,7 +98,7 @@ def load_estimator_and_predict_items(items, date, model_size):
         article_pieces['date'] = date_txt
         article_pieces['title'] = item['title']
         article_pieces['selftext'] = _trim_to_desired_length(encoder, item['selftext'], desired_len=1250)
-        ex = {k: _fix_reddit_text(v) for k, v in article_pieces.items()}
+        ex = dict(zip(article_pieces.keys(), _fix_reddit_texts(list(article_pieces.values()))))
         ctx = ''.join(
             ["Subreddit: ", ex['subreddit'], " Date: ", ex['date'], " Title: ", ex['title'], " Selftext: ", ex['selftext']])
         ctxs.append(ctx)
@@ -83,22 +106,73 @@ def load_estimator_and_predict_items(items, date, model_size):
     for _ in range(len(items) % 8):
         ctxs.append(ctxs[-1])
 
-    with tf.io.gfile.GFile(tmp_input_path, 'w') as f:
-        for ctx in ctxs:
-            f.write(ctx + '\n')
-
-    model.predict(
-        input_file=tmp_input_path,
-        output_file=tmp_output_path,
-        checkpoint_steps=ckpt_steps,
-        sampling_keep_top_p=top_p
-    )
-    with tf.io.gfile.GFile(tmp_output_path + f'-{ckpt_steps}', 'r') as f:
-        texts = [re.sub(r'\s+»\s+', '\n\n', text).strip() for text in f.read().splitlines()][:len(items)]
+    # Servers sharing the checkpoint dir must not overwrite each other's files
+    with ScratchNamespace(args.tmp_dir or os.path.dirname(ckpt_path), prefix='predict') as scratch:
+        tmp_input_path = scratch.path('tmp_input.txt')
+        tmp_output_path = scratch.path('tmp_output.txt')
+        with tf.io.gfile.GFile(tmp_input_path, 'w') as f:
+            for ctx in ctxs:
+                f.write(ctx + '\n')
+
+        model.predict(
+            input_file=tmp_input_path,
+            output_file=tmp_output_path,
+            checkpoint_steps=ckpt_steps,
+            sampling_keep_top_p=top_p
+        )
+        with tf.io.gfile.GFile(tmp_output_path + f'-{ckpt_steps}', 'r') as f:
+            texts = [re.sub(r'\s+»\s+', '\n\n', text).strip() for text in f.read().splitlines()][:len(items)]
     return texts
 
-def load_estimator_and_predict_item(subreddit, title, selftext, model_size):
-    return load_estimator_and_predict_items([{'subreddit': subreddit, 'title': title, 'selftext': selftext}], date=datetime.utcnow(), model_size=model_size)[0]
+# One batcher per model size, so that concurrent requests share decoding batches
+batchers = {}
+batchers_lock = threading.Lock()
+gevent.get_hub().threadpool.maxsize = args.max_queue_size
+admission = AdmissionController(max_in_flight_cost=args.max_in_flight or args.max_queue_size,
+                                max_client_share=args.max_client_share)
+response_cache = ResponseCache(max_entries=args.cache_size, ttl_secs=args.cache_ttl, disk_dir=args.cache_dir)
+
+
+def _predict_batch(items, model_size):
+    return load_estimator_and_predict_items(items, date=datetime.utcnow(), model_size=model_size)
+
+
+def predict_items(items, model_size, client_id=None):
+    """
+    Queue the items to be decoded with those of concurrent requests. Only blocks the calling greenlet.
+    Items that were already answered today are served from the response cache.
+    :param items: dicts with subreddit / title / selftext fields
+    :param model_size: model to use
+    :param client_id: who asks, for admission control and fair batching
+    :return: one advice per item
+    """
+    model_id = '{}:p={}'.format(model_types[model_size][0], top_p)
+    date_txt = datetime.utcnow().strftime('%Y-%m-%d')
+    keyed_items = [dict(item, date=date_txt) for item in items]
+    with admission.admit(client_id, len(items)):
+        return response_cache.get_or_compute(keyed_items, model_id,
+                                             functools.partial(_decode_items, model_size=model_size,
+                                                               client_id=client_id))
+
+
+def _client_id():
+    return flask.request.headers.get('X-Client-Id', flask.request.remote_addr)
+
+
+def _rejected(e):
+    return flask.jsonify({'error': str(e)}), e.status, {'Retry-After': str(e.retry_after_secs)}
+
+
+def _decode_items(items, model_size, client_id):
+    with batchers_lock:
+        if model_size not in batchers:
+            batchers[model_size] = MicroBatcher(functools.partial(_predict_batch, model_size=model_size),
+                                                max_batch_size=args.max_batch_size,
+                                                max_delay_secs=args.max_batch_delay,
+                                                max_queue_size=args.max_queue_size,
+                                                name='batcher-{}'.format(model_size))
+        batcher = batchers[model_size]
+    return gevent.get_hub().threadpool.apply(batcher.map, (items,), {'client_id': client_id})
 
 
 # # Problem: this requires model_parallelism = 1.
@@ -131,10 +205,15 @@ def api_ask():
         instance['subreddit'] = 'Advice'
 
     instance['model_size'] = instance.get('model_size', args.size)
-    instance['advice'] = load_estimator_and_predict_item(instance['subreddit'],
-                                                         instance.get('title', ''),
-                                                         instance.get('selftext', ''),
-                                                         model_size=instance['model_size'])
+    try:
+        instance['advice'] = predict_items([{'subreddit': instance['subreddit'],
+                                             'title': instance.get('title', ''),
+                                             'selftext': instance.get('selftext', '')}],
+                                           model_size=instance['model_size'], client_id=_client_id())[0]
+    except AdmissionRejected as e:
+        return _rejected(e)
+    except QueueFullError as e:
+        return flask.jsonify({'error': str(e)}), 503
     with open(f'log.jsonl', 'a+') as logfile:
         logfile.write(json.dumps(instance) + '\n')
 
@@ -159,7 +238,12 @@ def api_askbatch():
     instances = instance['instances']
 
     model_size = instance.get('model_size', args.size)
-    advices = load_estimator_and_predict_items(instances, date=datetime.utcnow(), model_size=model_size)
+    try:
+        advices = predict_items(instances, model_size=model_size, client_id=_client_id())
+    except AdmissionRejected as e:
+        return _rejected(e)
+    except QueueFullError as e:
+        return flask.jsonify({'error': str(e)}), 503
     instance['advice'] = advices
     with open(f'log.jsonl', 'a+') as logfile:
         logfile.write(json.dumps(instance) + '\n')
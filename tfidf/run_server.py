@@ -4,6 +4,12 @@ import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-gpu', type=int, default=2)
+parser.add_argument('-cache_size', type=int, default=10000,
+                    help='Max number of advices kept in the response cache')
+parser.add_argument('-cache_ttl', type=float, default=None,
+                    help='Seconds after which a cached advice expires. Never by default')
+parser.add_argument('-cache_dir', type=str, default=None,
+                    help='Local directory to keep the response cache in across restarts')
 
 args = parser.parse_args()
 GPUID = args.gpu
@@ -35,6 +41,9 @@ import random
 from copy import deepcopy
 import scipy.sparse
 from collections import defaultdict
+
+sys.path.append('../')
+from frontend.cache import ResponseCache
 app = flask.Flask(__name__, template_folder='.')
 CORS(app, resources={r'/api/*': {'origins': '*'}})
 
@@ -118,6 +127,10 @@ else:
 
 
 
+response_cache = ResponseCache(max_entries=args.cache_size, ttl_secs=args.cache_ttl, disk_dir=args.cache_dir)
+# Retrieval doesn't depend on the date, only on the index
+model_id = 'tfidf:n_advice={}:vocab={}'.format(len(advice), len(word_to_idx))
+
 print("READY TO GO!", flush=True)
 def gen_advice(item):
     item_tokenized = [x.lemma_.lower() for x in spacy_model('{} {}'.format(item['title'], item['selftext']))]
@@ -159,8 +172,10 @@ def api_askbatch():
     :return:
     """
     orig_instance = dict(flask.request.json)
+    gens = response_cache.get_or_compute(orig_instance.pop('instances'), model_id,
+                                         lambda instances: [gen_advice(x) for x in instances])
     return flask.jsonify({
-        'gens': [gen_advice(x) for x in orig_instance.pop('instances')],
+        'gens': gens,
     }), 200
 
 